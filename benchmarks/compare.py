@@ -0,0 +1,39 @@
+"""
+media.py の結果の JSON を比較して throughput が下がったベンチマークを探す
+
+sora_sdk に依存しないように media.py から分けている
+"""
+
+import json
+
+
+def result_key(result):
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(baseline, current, threshold):
+    """
+    throughput が threshold の割合以上下がったベンチマークを返す
+    """
+    baseline_results = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = baseline_results.get(result_key(result))
+        if (
+            base is None
+            or not base["throughput_per_sec"]
+            or not result["throughput_per_sec"]
+        ):
+            continue
+        ratio = result["throughput_per_sec"] / base["throughput_per_sec"]
+        if ratio < 1 - threshold:
+            regressions.append(
+                {
+                    "name": result["name"],
+                    "params": result["params"],
+                    "baseline": base["throughput_per_sec"],
+                    "current": result["throughput_per_sec"],
+                    "ratio": ratio,
+                }
+            )
+    return regressions
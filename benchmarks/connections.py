@@ -0,0 +1,94 @@
+"""
+1 つの Sora インスタンスで多数の接続を張った時のスレッド数と接続にかかる時間を計測する
+
+$ python benchmarks/connections.py \\
+    --signaling-url wss://example.com/signaling \\
+    --channel-id bench --connections 100 --io-threads 4
+
+結果は JSON で標準出力に書き出す
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+
+from sora_sdk import Sora
+
+
+def count_native_threads():
+    # Python から見えない C++ のスレッドも数えるため、OS から取得する
+    try:
+        return len(os.listdir("/proc/self/task"))
+    except FileNotFoundError:
+        try:
+            import psutil
+        except ImportError:
+            return threading.active_count()
+        return psutil.Process().num_threads()
+
+
+async def run(args):
+    sora = Sora(io_threads=args.io_threads)
+    threads_before = count_native_threads()
+
+    connections = [
+        sora.create_connection(
+            signaling_url=args.signaling_url,
+            role="recvonly",
+            channel_id=args.channel_id,
+            metadata=args.metadata,
+        )
+        for _ in range(args.connections)
+    ]
+
+    async def connect(conn):
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(conn.connect_async(), args.timeout)
+        except (ConnectionError, asyncio.TimeoutError):
+            return None
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(connect(conn) for conn in connections))
+    elapsed = time.perf_counter() - start
+    threads_connected = count_native_threads()
+
+    await asyncio.gather(*(conn.disconnect_async() for conn in connections))
+
+    succeeded = sorted(x for x in latencies if x is not None)
+    return {
+        "connections": args.connections,
+        "io_threads": args.io_threads,
+        "succeeded": len(succeeded),
+        "failed": args.connections - len(succeeded),
+        "elapsed_sec": elapsed,
+        "connect_p50_sec": (
+            succeeded[len(succeeded) // 2] if succeeded else None
+        ),
+        "connect_max_sec": succeeded[-1] if succeeded else None,
+        "threads_before": threads_before,
+        "threads_connected": threads_connected,
+        "threads_per_connection": (threads_connected - threads_before)
+        / args.connections,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--signaling-url", required=True)
+    parser.add_argument("--channel-id", required=True)
+    parser.add_argument("--metadata", type=json.loads, default=None)
+    parser.add_argument("--connections", type=int, default=100)
+    # 0 の場合は接続ごとにスレッドを作る従来の動作になる
+    parser.add_argument("--io-threads", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
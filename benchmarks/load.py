@@ -0,0 +1,233 @@
+"""
+1 つの Sora インスタンスで sendonly と recvonly の接続を増やしながら、
+CPU 使用率、 RSS 、スレッド数と接続ごとの受信フレームレートを計測する
+
+--signaling-url を省略した場合は benchmarks/signaling_server.py を起動して localhost で接続する
+sendonly と recvonly を 1 組ずつ別のチャネルに接続し、 recvonly では同じ組の sendonly の映像を受信する
+
+$ pip install psutil aiortc websockets
+$ python benchmarks/load.py --connections 1,2,4,8,16 --duration 10
+
+結果は組の数ごとに JSON で標準出力に書き出す
+CPU 使用率、 RSS 、スレッド数はこのプロセスのもので、シグナリングサーバーのものは含まない
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy
+import psutil
+
+from sora_sdk import Sora, SoraVideoSink
+
+
+class Receiver:
+    """
+    recvonly の接続で受信した映像のフレーム数を数える
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.frames = 0
+        self.sink = None
+        conn.on_track = self.on_track
+
+    def on_track(self, track):
+        if track.kind == "video":
+            # 変換はしないので、フォーマットは変換のない I420 にする
+            self.sink = SoraVideoSink(track, format="I420")
+            self.sink.on_frame = self.on_frame
+
+    def on_frame(self, frame):
+        self.frames += 1
+
+
+async def feed(video_source, audio_source, args):
+    # 全ての sendonly の接続で同じ Source を共有し、エンコードは接続ごとに行われる
+    frame = numpy.random.randint(
+        0, 255, (args.height, args.width, 3), dtype=numpy.uint8
+    )
+    audio = numpy.zeros((480, 1), dtype=numpy.int16)
+    interval = 1 / args.fps
+    next_time = time.perf_counter()
+    audio_time = next_time
+    while True:
+        video_source.on_captured(frame)
+        next_time += interval
+        # 映像の間隔の分だけ 10 ms ごとの音声を送る
+        while audio_time < next_time:
+            audio_source.on_data(audio)
+            audio_time += 0.01
+        await asyncio.sleep(max(0, next_time - time.perf_counter()))
+
+
+async def connect(conn, timeout):
+    try:
+        await asyncio.wait_for(conn.connect_async(), timeout)
+        return True
+    except (ConnectionError, asyncio.TimeoutError):
+        return False
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "min": min(values),
+        "mean": sum(values) / len(values),
+        "max": max(values),
+    }
+
+
+async def run_step(sora, video_source, audio_source, pairs, args):
+    process = psutil.Process()
+    senders = []
+    receivers = []
+    for i in range(pairs):
+        channel_id = f"{args.channel_id}-{i}"
+        senders.append(
+            sora.create_connection(
+                signaling_url=args.signaling_url,
+                role="sendonly",
+                channel_id=channel_id,
+                audio_source=audio_source,
+                video_source=video_source,
+                video_codec_type=args.video_codec_type,
+            )
+        )
+        receivers.append(
+            Receiver(
+                sora.create_connection(
+                    signaling_url=args.signaling_url,
+                    role="recvonly",
+                    channel_id=channel_id,
+                    audio=False,
+                    video_codec_type=args.video_codec_type,
+                )
+            )
+        )
+
+    # recvonly は接続した時点の sendonly の Track しか受信できないので、 sendonly を先に接続する
+    sent = await asyncio.gather(
+        *(connect(conn, args.timeout) for conn in senders)
+    )
+    received = await asyncio.gather(
+        *(connect(r.conn, args.timeout) for r in receivers)
+    )
+
+    await asyncio.sleep(args.warmup)
+    frames_before = [r.frames for r in receivers]
+    process.cpu_percent(None)
+    start = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+    cpu_percent = process.cpu_percent(None)
+    rss = process.memory_info().rss
+    threads = process.num_threads()
+    fps = [
+        (r.frames - before) / elapsed
+        for r, before, ok in zip(receivers, frames_before, received)
+        if ok
+    ]
+
+    await asyncio.gather(
+        *(conn.disconnect_async() for conn in senders),
+        *(r.conn.disconnect_async() for r in receivers),
+    )
+    return {
+        "pairs": pairs,
+        "connections": pairs * 2,
+        "connected": sum(sent) + sum(received),
+        "cpu_percent": cpu_percent,
+        "cpu_count": psutil.cpu_count(),
+        "rss_bytes": rss,
+        "threads": threads,
+        "target_fps": args.fps,
+        "received_fps": summarize(fps),
+    }
+
+
+def start_server(args):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                "signaling_server.py",
+            ),
+            "--port",
+            str(args.server_port),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    # 待ち受けを始めたら 1 行出力する
+    line = server.stdout.readline()
+    if not line:
+        raise RuntimeError("failed to start signaling_server.py")
+    return server
+
+
+async def run(args):
+    sora = Sora(io_threads=args.io_threads)
+    video_source = sora.create_video_source(
+        max_queue_size=2, queue_policy="drop_oldest"
+    )
+    # 映像のフレームの間隔でまとめて渡しても、 10 ms ごとに送られるようにする
+    audio_source = sora.create_audio_source(
+        1, 48000, paced=True, max_buffer_ms=200
+    )
+    feeder = asyncio.create_task(feed(video_source, audio_source, args))
+    try:
+        for pairs in args.connections:
+            print(f"running {pairs} pairs", file=sys.stderr)
+            result = await run_step(
+                sora, video_source, audio_source, pairs, args
+            )
+            print(json.dumps(result), flush=True)
+    finally:
+        feeder.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--signaling-url", help="省略した場合は signaling_server.py を起動する"
+    )
+    parser.add_argument("--server-port", type=int, default=8080)
+    parser.add_argument("--channel-id", default="load")
+    parser.add_argument(
+        "--connections",
+        type=lambda value: [int(x) for x in value.split(",")],
+        default=[1, 2, 4, 8],
+        help="sendonly と recvonly の組の数をカンマ区切りで指定する",
+    )
+    parser.add_argument("--io-threads", type=int, default=4)
+    parser.add_argument("--video-codec-type", default="VP8")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    server = None
+    if args.signaling_url is None:
+        server = start_server(args)
+        args.signaling_url = f"ws://127.0.0.1:{args.server_port}/signaling"
+    try:
+        asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
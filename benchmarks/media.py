@@ -0,0 +1,386 @@
+"""
+メディアの処理経路のマイクロベンチマーク
+
+Sora には接続せず、ローカルで作った Source の Track に Sink を繋いで計測する
+
+$ python benchmarks/media.py --output result.json
+$ python benchmarks/media.py --compare result.json --threshold 0.2
+
+計測するもの
+- video_source_on_captured: SoraVideoSource.on_captured の BGR からの変換と送信キューへの追加
+- video_frame_data: SoraVideoSink で受け取った SoraVideoFrame の生成と data() での変換
+- audio_sink_read: SoraAudioSink.read の要求フレーム数と貯まっている量ごとの読み出し
+- audio_source_on_data: 10 ms の倍数ではない長さで SoraAudioSource.on_data を呼ぶ
+- audio_sink_convert: SoraAudioSink のリサンプリングとリミックス
+- video_loopback: SoraVideoSource から VP8 でエンコードとデコードをして SoraVideoSink で受け取るまで
+- audio_loopback: SoraAudioSource から OPUS でエンコードとデコードをして SoraAudioSink で受け取るまで
+
+結果はベンチマークごとに throughput, p50, p99 とメモリ確保の回数を JSON で書き出す
+--compare を指定すると、先の結果より throughput が threshold 以上悪化したものを表示して 1 で終了する
+"""
+
+import argparse
+import gc
+import importlib.metadata
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from sora_sdk import Sora, SoraAudioSink, SoraVideoSink
+
+from compare import compare
+
+RESOLUTIONS = {
+    "480p": (640, 480),
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4K": (3840, 2160),
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p))
+    return sorted_values[index]
+
+
+def measure(name, params, func, iterations, setup=None, units_per_op=1):
+    """
+    func を iterations 回呼んで 1 回ごとの時間を計測する
+    setup は計測に含めずに毎回 func の前に呼ぶ
+    メモリ確保の回数は計測の後に tracemalloc を有効にして別に数える
+    """
+    # 初回のプールの確保などを除くため、先に何回か呼んでおく
+    for _ in range(min(10, iterations)):
+        if setup:
+            setup()
+        func()
+
+    gc.collect()
+    gc.disable()
+    latencies = []
+    try:
+        for _ in range(iterations):
+            if setup:
+                setup()
+            start = time.perf_counter_ns()
+            func()
+            latencies.append(time.perf_counter_ns() - start)
+    finally:
+        gc.enable()
+
+    # tracemalloc は計測を遅くするので、時間とは別に Python から見えるメモリ確保を数える
+    alloc_iterations = min(100, iterations)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for _ in range(alloc_iterations):
+        if setup:
+            setup()
+        func()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    allocated_blocks = sum(
+        stat.count_diff
+        for stat in after.compare_to(before, "filename")
+        if stat.count_diff > 0
+    )
+
+    latencies.sort()
+    total_sec = sum(latencies) / 1e9
+    return {
+        "name": name,
+        "params": params,
+        "iterations": iterations,
+        "throughput_per_sec": (
+            iterations * units_per_op / total_sec if total_sec > 0 else None
+        ),
+        "p50_us": percentile(latencies, 0.50) / 1000,
+        "p99_us": percentile(latencies, 0.99) / 1000,
+        "max_us": latencies[-1] / 1000,
+        "py_alloc_blocks_per_op": allocated_blocks / alloc_iterations,
+        "py_alloc_peak_bytes": peak,
+    }
+
+
+def bench_video_source_on_captured(sora, iterations):
+    results = []
+    for label, (width, height) in RESOLUTIONS.items():
+        # 送信キューが溢れた分は捨てて、on_captured がブロックしないようにする
+        source = sora.create_video_source(
+            max_queue_size=4, queue_policy="drop_oldest"
+        )
+        frame = numpy.random.randint(
+            0, 255, (height, width, 3), dtype=numpy.uint8
+        )
+        result = measure(
+            "video_source_on_captured",
+            {"resolution": label, "format": "BGR"},
+            lambda: source.on_captured(frame),
+            iterations,
+        )
+        result["native"] = source.metrics
+        results.append(result)
+    return results
+
+
+def bench_video_frame_data(sora, iterations):
+    results = []
+    for label, (width, height) in RESOLUTIONS.items():
+        for format in ("BGR", "I420"):
+            source = sora.create_video_source()
+            sink = SoraVideoSink(
+                source, format=format, queue_size=1, drop_policy="keep_latest"
+            )
+            frame = numpy.random.randint(
+                0, 255, (height, width, 3), dtype=numpy.uint8
+            )
+            received = []
+
+            def setup():
+                source.on_captured(frame)
+                success, video_frame = sink.read(timeout=1)
+                received[:] = [video_frame] if success else []
+
+            def func():
+                if received:
+                    received[0].data()
+
+            result = measure(
+                "video_frame_data",
+                {"resolution": label, "format": format},
+                func,
+                iterations,
+                setup=setup,
+            )
+            result["native"] = sink.metrics
+            results.append(result)
+            del sink
+    return results
+
+
+def push_audio(source, frames, channels, sample_rate):
+    # 10 ms ごとに送り、 Sink 側に貯める
+    chunk = sample_rate // 100
+    data = numpy.zeros((chunk, channels), dtype=numpy.int16)
+    for _ in range(max(1, frames // chunk)):
+        source.on_data(data)
+
+
+def bench_audio_sink_read(sora, iterations):
+    results = []
+    sample_rate = 48000
+    channels = 2
+    for frames in (480, 960, 4800):
+        for backlog_ms in (100, 1000, 5000):
+            source = sora.create_audio_source(channels, sample_rate)
+            sink = SoraAudioSink(source, -1, 0)
+            backlog = sample_rate * backlog_ms // 1000
+            push_audio(source, backlog, channels, sample_rate)
+
+            def setup():
+                # 読み出す分を補充して貯まっている量を一定に保つ
+                push_audio(source, frames, channels, sample_rate)
+
+            result = measure(
+                "audio_sink_read",
+                {"frames": frames, "backlog_ms": backlog_ms},
+                lambda: sink.read(frames, timeout=0),
+                iterations,
+                setup=setup,
+                units_per_op=frames,
+            )
+            result["native"] = sink.metrics
+            results.append(result)
+            del sink
+    return results
+
+
+def bench_audio_source_on_data(sora, iterations):
+    results = []
+    sample_rate = 48000
+    channels = 2
+    for chunk_ms in (7, 10, 15, 33):
+        source = sora.create_audio_source(channels, sample_rate)
+        sink = SoraAudioSink(source, -1, 0, max_buffer_ms=100)
+        frames = sample_rate * chunk_ms // 1000
+        data = numpy.zeros((frames, channels), dtype=numpy.int16)
+        result = measure(
+            "audio_source_on_data",
+            {"chunk_ms": chunk_ms},
+            lambda: source.on_data(data),
+            iterations,
+            units_per_op=frames,
+        )
+        result["native"] = source.metrics
+        results.append(result)
+        del sink
+    return results
+
+
+def bench_audio_sink_convert(sora, iterations):
+    results = []
+    sample_rate = 48000
+    cases = [
+        # (入力のチャンネル数, 出力のサンプリングレート, 出力のチャンネル数)
+        (2, -1, 0),
+        (2, 16000, 0),
+        (2, -1, 1),
+        (2, 16000, 1),
+        (1, 44100, 2),
+    ]
+    for in_channels, out_rate, out_channels in cases:
+        source = sora.create_audio_source(in_channels, sample_rate)
+        sink = SoraAudioSink(source, out_rate, out_channels, max_buffer_ms=100)
+        frames = sample_rate // 100
+        data = numpy.zeros((frames, in_channels), dtype=numpy.int16)
+        # on_data の中で Sink の OnData が呼ばれるので、変換の時間も含まれる
+        result = measure(
+            "audio_sink_convert",
+            {
+                "input_channels": in_channels,
+                "output_frequency": out_rate,
+                "output_channels": out_channels,
+            },
+            lambda: source.on_data(data),
+            iterations,
+            units_per_op=frames,
+        )
+        result["native"] = sink.metrics
+        results.append(result)
+        del sink
+    return results
+
+
+def bench_video_loopback(sora, iterations):
+    results = []
+    for label, (width, height) in RESOLUTIONS.items():
+        source = sora.create_video_source()
+        loopback = sora.create_video_loopback(source, codec_type="VP8")
+        sink = SoraVideoSink(
+            loopback, format="BGR", queue_size=1, drop_policy="keep_latest"
+        )
+        frame = numpy.random.randint(
+            0, 255, (height, width, 3), dtype=numpy.uint8
+        )
+
+        def func():
+            # 送信のスレッドでエンコードとデコードをして Sink に届くまでを計測する
+            source.on_captured(frame)
+            success, video_frame = sink.read(timeout=5)
+            if success:
+                video_frame.data()
+
+        result = measure(
+            "video_loopback",
+            {"resolution": label, "codec_type": "VP8"},
+            func,
+            iterations,
+        )
+        result["native"] = {
+            "source": source.metrics,
+            "loopback": loopback.metrics,
+            "sink": sink.metrics,
+        }
+        results.append(result)
+        del sink
+        del loopback
+    return results
+
+
+def bench_audio_loopback(sora, iterations):
+    results = []
+    channels = 2
+    for sample_rate in (16000, 48000):
+        source = sora.create_audio_source(channels, sample_rate)
+        loopback = sora.create_audio_loopback(source, codec_type="OPUS")
+        sink = SoraAudioSink(loopback, -1, 0, max_buffer_ms=100)
+        # Opus は 20 ms ごとにエンコードするので、 20 ms ずつ渡す
+        frames = sample_rate // 50
+        data = numpy.zeros((frames, channels), dtype=numpy.int16)
+        result = measure(
+            "audio_loopback",
+            {"input_frequency": sample_rate, "codec_type": "OPUS"},
+            lambda: source.on_data(data),
+            iterations,
+            units_per_op=frames,
+        )
+        result["native"] = {"loopback": loopback.metrics, "sink": sink.metrics}
+        results.append(result)
+        del sink
+        del loopback
+    return results
+
+
+BENCHMARKS = {
+    "video_source_on_captured": bench_video_source_on_captured,
+    "video_frame_data": bench_video_frame_data,
+    "audio_sink_read": bench_audio_sink_read,
+    "audio_source_on_data": bench_audio_source_on_data,
+    "audio_sink_convert": bench_audio_sink_convert,
+    "video_loopback": bench_video_loopback,
+    "audio_loopback": bench_audio_loopback,
+}
+
+
+def sdk_version():
+    try:
+        return importlib.metadata.version("sora_sdk")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--only", choices=sorted(BENCHMARKS), action="append")
+    parser.add_argument(
+        "--output", help="結果を書き出す JSON ファイル、省略時は標準出力"
+    )
+    parser.add_argument("--compare", help="比較する先の結果の JSON ファイル")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    sora = Sora()
+    results = []
+    for name in args.only or BENCHMARKS:
+        print(f"running {name}", file=sys.stderr)
+        results.extend(BENCHMARKS[name](sora, args.iterations))
+
+    report = {
+        "sdk_version": sdk_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "iterations": args.iterations,
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.threshold)
+        for r in regressions:
+            print(
+                f"regression: {r['name']} {r['params']} "
+                f"{r['baseline']:.1f} -> {r['current']:.1f} /s "
+                f"({r['ratio']:.2f}x)",
+                file=sys.stderr,
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+負荷試験用に Sora の代わりをするローカルのシグナリングサーバー
+
+Sora のシグナリングのうち、接続に必要な connect, offer, answer, candidate, ping, disconnect だけを扱う
+サーバー側の WebRTC は aiortc を使い、sendonly の接続から受け取った映像と音声を
+同じチャネルの recvonly の接続に中継する
+
+$ pip install aiortc websockets
+$ python benchmarks/signaling_server.py --port 8080
+# ws://127.0.0.1:8080/signaling に接続する
+
+制限
+- 中継は aiortc がデコードしてから接続ごとにエンコードし直すため、このサーバーの CPU 使用率は Sora とは比較できない
+- recvonly の接続には、接続した時点で同じチャネルにいる sendonly の Track だけを送り、 re-offer は送らない
+- simulcast, spotlight, データチャネル経由のシグナリングには対応しない
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import secrets
+
+import websockets
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+from aiortc.sdp import candidate_from_sdp
+
+logger = logging.getLogger("signaling_server")
+
+
+def random_id():
+    # Sora の client_id, connection_id と同じく 26 文字にする
+    return secrets.token_hex(13).upper()
+
+
+class Channel:
+    def __init__(self):
+        # sendonly の接続から受け取った Track 、 recvonly の接続へはこれを relay して送る
+        self.tracks = []
+
+
+class StandInServer:
+    def __init__(self, ping_interval):
+        self.ping_interval = ping_interval
+        self.channels = {}
+        self.relay = MediaRelay()
+
+    async def handle(self, websocket, path=None):
+        pc = None
+        pending_candidates = []
+        ping_task = None
+        try:
+            message = json.loads(await websocket.recv())
+            if message.get("type") != "connect":
+                await websocket.close(
+                    code=4000, reason="first message must be connect"
+                )
+                return
+            role = message.get("role")
+            if role not in ("sendonly", "recvonly"):
+                await websocket.close(
+                    code=4000, reason=f"unsupported role: {role}"
+                )
+                return
+            channel = self.channels.setdefault(
+                message["channel_id"], Channel()
+            )
+            client_id = message.get("client_id") or random_id()
+            connection_id = random_id()
+
+            pc = RTCPeerConnection()
+            if role == "sendonly":
+                pc.addTransceiver("audio", direction="recvonly")
+                pc.addTransceiver("video", direction="recvonly")
+
+                @pc.on("track")
+                def on_track(track):
+                    channel.tracks.append(track)
+
+                    @track.on("ended")
+                    def on_ended():
+                        if track in channel.tracks:
+                            channel.tracks.remove(track)
+
+            else:
+                for track in list(channel.tracks):
+                    pc.addTrack(self.relay.subscribe(track))
+
+            # aiortc は setLocalDescription で候補を集め終わるので、 offer の SDP に候補が含まれる
+            await pc.setLocalDescription(await pc.createOffer())
+            await websocket.send(
+                json.dumps(
+                    {
+                        "type": "offer",
+                        "sdp": pc.localDescription.sdp,
+                        "client_id": client_id,
+                        "connection_id": connection_id,
+                        "config": {
+                            "iceServers": [],
+                            "iceTransportPolicy": "all",
+                        },
+                    }
+                )
+            )
+            if self.ping_interval > 0:
+                ping_task = asyncio.create_task(self.ping(websocket))
+
+            async for raw in websocket:
+                message = json.loads(raw)
+                message_type = message.get("type")
+                if message_type == "answer":
+                    await pc.setRemoteDescription(
+                        RTCSessionDescription(
+                            sdp=message["sdp"], type="answer"
+                        )
+                    )
+                    for candidate in pending_candidates:
+                        await pc.addIceCandidate(candidate)
+                    pending_candidates = []
+                elif message_type == "candidate":
+                    candidate = parse_candidate(message["candidate"])
+                    if candidate is None:
+                        continue
+                    if pc.remoteDescription is None:
+                        pending_candidates.append(candidate)
+                    else:
+                        await pc.addIceCandidate(candidate)
+                elif message_type == "disconnect":
+                    break
+                elif message_type in ("pong", "stats"):
+                    pass
+                else:
+                    logger.info("ignored message: %s", message_type)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if ping_task is not None:
+                ping_task.cancel()
+            if pc is not None:
+                await pc.close()
+
+    async def ping(self, websocket):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            await websocket.send(json.dumps({"type": "ping", "stats": False}))
+
+
+def parse_candidate(value):
+    if not value:
+        return None
+    if value.startswith("candidate:"):
+        value = value[len("candidate:") :]
+    candidate = candidate_from_sdp(value)
+    # BUNDLE で 1 つのトランスポートにまとめるので、最初の m-line に追加する
+    candidate.sdpMLineIndex = 0
+    return candidate
+
+
+async def serve(host, port, ping_interval):
+    server = StandInServer(ping_interval)
+    async with websockets.serve(server.handle, host, port):
+        print(f"listening on ws://{host}:{port}/signaling", flush=True)
+        await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--ping-interval", type=float, default=5)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING
+    )
+    try:
+        asyncio.run(serve(args.host, args.port, args.ping_interval))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -96,11 +96,9 @@ class LogoStreamer:
                 frame.flags.writeable = True
                 # PIL から numpy に画像を戻す
                 frame = np.array(pil_image)
-                # 色の順序をもとに戻す
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
 
-                # WebRTC に渡す
-                self.video_source.on_captured(frame)
+                # RGB のまま WebRTC に渡す
+                self.video_source.on_captured(frame, format="RGB")
 
         self.connection.disconnect()
         self.video_capture.release()
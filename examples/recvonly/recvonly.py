@@ -1,4 +1,3 @@
-import queue
 import signal
 import time
 
@@ -30,7 +29,6 @@ class Recvonly:
 
         self.audio_sink = None
         self.video_sink = None
-        self.q_out = queue.Queue()
 
         self.connection.on_track = self.on_track
 
@@ -38,16 +36,14 @@ class Recvonly:
         self.disconnected = True
         print(message)
 
-    def on_frame(self, frame):
-        self.q_out.put(frame)
-
     def on_track(self, track):
         if track.kind == "audio":
             self.audio_sink = SoraAudioSink(
                 track, self.output_frequency, self.output_channels)
         if track.kind == "video":
-            self.video_sink = SoraVideoSink(track)
-            self.video_sink.on_frame = self.on_frame
+            # 表示が間に合わない場合は古いフレームを捨てて最新のフレームだけを残す
+            self.video_sink = SoraVideoSink(
+                track, queue_size=1, drop_policy="keep_latest")
 
     def callback(self, outdata, frames, time, status):
         if self.audio_sink is not None:
@@ -74,11 +70,13 @@ class Recvonly:
             self.connection.connect()
 
             while True:
-                # Windows 環境の場合 timeout を入れておかないと Queue.get() で
+                if self.video_sink is None:
+                    time.sleep(0.01)
+                    continue
+                # Windows 環境の場合 timeout を入れておかないと read() で
                 # ブロックしたときに脱出方法がなくなる。
-                try:
-                    frame = self.q_out.get(timeout=1)
-                except queue.Empty:
+                success, frame = self.video_sink.read(timeout=1)
+                if not success:
                     continue
                 cv2.imshow('frame', frame.data())
                 # これは削除してよさそう
@@ -1,6 +1,5 @@
+import asyncio
 import math
-import signal
-import time
 
 import numpy as np
 import whispercpp as whisper
@@ -49,8 +48,6 @@ class RealTimeRecognition:
         self.channel_id = channel_id
         self.access_token = access_token
 
-        self.running = True
-        self.disconnected = False
         self.audio_sink = None
 
     def initialize_whisper(self):
@@ -74,79 +71,52 @@ class RealTimeRecognition:
             role="recvonly",
             channel_id=self.channel_id,
             client_id="recvonly",
-            metadata={'access_token': self.access_token}
+            metadata={'access_token': self.access_token},
+            # 音声認識には映像を使わないので、映像はネゴシエーションせずデコードもしない
+            video=False
         )
 
-        signal.signal(signal.SIGINT, self.handler)
-
-        self.connection.on_disconnect = self.on_disconnect
-        self.connection.on_track = self.on_track
-
-    def handler(self, signum, frame):
-        self.running = False
-
-    def on_disconnect(self, ec, message):
-        self.disconnected = True
-        print(message)
-
-    def on_track(self, track):
-        if track.kind == "audio":
-            self.audio_sink = SoraAudioSink(track, self.sample_rate, 1)
-            print("### 認識開始 ###")
-
     def run(self):
         self.initialize_whisper()
         self.initialize_sora()
+        try:
+            asyncio.run(self.recognize())
+        except KeyboardInterrupt:
+            pass
 
+    async def recognize(self):
         print("### 接続中... ###")
-        self.connection.connect()
-
-        # 以下を参考に実装した
-        # https://github.com/ggerganov/whisper.cpp/blob/478289a4b393904b91df06e0b1ec7552ba25a338/examples/stream/stream.cpp
-
-        new_data = None
-        keep_data = None
-        while self.running and not self.disconnected:
-            if self.audio_sink is None:
-                time.sleep(0.01)
-                continue
-            success, input_data = self.audio_sink.read()
-            if not success:
-                time.sleep(0.01)
-                continue
-            if new_data is None:
-                new_data = input_data
-            else:
-                new_data = np.concatenate([new_data, input_data])
-
-            if not self.running or self.disconnected:
-                break
-            if new_data.shape[0] < self.n_samples_step:
-                time.sleep(0.01)
-                continue
-            if new_data.shape[0] > 2 * self.n_samples_step:
-                print("リアルタイムで処理できる性能が無いため処理ができませんでした")
-                new_data = None
-                keep_data = None
-                continue
-
-        n_samples_new = new_data.shape[0]
-        new_data_transformed = new_data.flatten().astype(np.float32) / 32768.0
-
-        if keep_data is not None:
-            n_samples_take = min([keep_data.shape[0], max(
-                [0, self.n_samples_keep + self.n_samples_length - n_samples_new])])
-            new_data_transformed = np.concatenate(
-                [keep_data[0 - n_samples_take:], new_data_transformed])
-        text = self.w.transcribe(new_data_transformed)
-        print("認識結果:", text)
-        keep_data = new_data_transformed[0 - self.n_samples_keep:].copy()
-        new_data = None
-
-        self.connection.disconnect()
-
-        while not self.disconnected:
-            time.sleep(0.01)
+        await self.connection.connect_async()
+        try:
+            track = await self.connection.wait_track("audio")
+            # whisper は float32 を要求するので、正規化はコピーの際に SDK で行う
+            self.audio_sink = SoraAudioSink(
+                track, self.sample_rate, 1, output_dtype="float32", chunk_ms=100)
+            print("### 認識開始 ###")
+
+            # 以下を参考に実装した
+            # https://github.com/ggerganov/whisper.cpp/blob/478289a4b393904b91df06e0b1ec7552ba25a338/examples/stream/stream.cpp
+
+            loop = asyncio.get_running_loop()
+            keep_data = None
+            # step_ms 分の音声が貯まるごとに起こされるので、ポーリングは不要
+            async for new_data in self.audio_sink.chunks(self.step_ms):
+                n_samples_new = new_data.shape[0]
+                new_data_transformed = new_data.flatten()
+
+                if keep_data is not None:
+                    n_samples_take = min([keep_data.shape[0], max(
+                        [0, self.n_samples_keep + self.n_samples_length - n_samples_new])])
+                    new_data_transformed = np.concatenate(
+                        [keep_data[0 - n_samples_take:], new_data_transformed])
+                # 認識の間もイベントループを止めないように別スレッドで実行する
+                text = await loop.run_in_executor(
+                    None, self.w.transcribe, new_data_transformed)
+                print("認識結果:", text)
+                keep_data = new_data_transformed[0 - self.n_samples_keep:].copy()
+        finally:
+            ec, message = await self.connection.disconnect_async()
+            print(message)
 
 
 if __name__ == "__main__":
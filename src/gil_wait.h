@@ -0,0 +1,55 @@
+#ifndef GIL_WAIT_H_
+#define GIL_WAIT_H_
+
+#include <algorithm>
+#include <chrono>
+#include <condition_variable>
+#include <mutex>
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+namespace nb = nanobind;
+
+/*
+ * GIL を解放した状態で pred が true になるか timeout 秒が経つまで待つ
+ * lock はロックした状態で渡し、ロックした状態で返る
+ * Ctrl+C などを処理できるように一定間隔で GIL を取り直して PyErr_CheckSignals を呼び、
+ * シグナルハンドラが例外を投げた場合は nb::python_error を送出する
+ * 他のスレッドが GIL を待ちながらロックを取ることがないように、
+ * GIL を取り直す時は必ずロックを外しておく
+ */
+template <typename Predicate>
+bool WaitWithGilReleased(std::unique_lock<std::mutex>& lock,
+                         std::condition_variable& cond,
+                         float timeout,
+                         Predicate pred) {
+  const std::chrono::nanoseconds kSignalCheckInterval =
+      std::chrono::milliseconds(100);
+  const auto deadline =
+      std::chrono::steady_clock::now() +
+      std::chrono::nanoseconds(
+          // Python の流儀に合わせて秒を float で受け取っているので換算
+          (int64_t)((double)timeout * 1000. * 1000. * 1000.));
+  while (!pred()) {
+    auto now = std::chrono::steady_clock::now();
+    if (now >= deadline) {
+      return false;
+    }
+    std::chrono::nanoseconds wait = std::min<std::chrono::nanoseconds>(
+        deadline - now, kSignalCheckInterval);
+    lock.unlock();
+    {
+      nb::gil_scoped_release release;
+      std::unique_lock<std::mutex> wait_lock(*lock.mutex());
+      cond.wait_for(wait_lock, wait, pred);
+    }
+    if (PyErr_CheckSignals() != 0) {
+      throw nb::python_error();
+    }
+    lock.lock();
+  }
+  return true;
+}
+
+#endif
@@ -0,0 +1,82 @@
+#ifndef RING_BUFFER_H_
+#define RING_BUFFER_H_
+
+#include <algorithm>
+#include <cstring>
+#include <vector>
+
+/*
+ * 容量固定のリングバッファ
+ * 読み書きは要求された要素数分のコピーだけで済み、容量を超えてメモリが増えることはない
+ * スレッドセーフではないので、排他は利用する側で行う
+ */
+template <typename T>
+class RingBuffer {
+ public:
+  RingBuffer() : head_(0), size_(0) {}
+
+  // 容量を変更する。保持していたデータは捨てる
+  void Reset(size_t capacity) {
+    buffer_.assign(capacity, T());
+    head_ = 0;
+    size_ = 0;
+  }
+  void Clear() {
+    head_ = 0;
+    size_ = 0;
+  }
+
+  size_t capacity() const { return buffer_.size(); }
+  size_t size() const { return size_; }
+  size_t available() const { return buffer_.size() - size_; }
+
+  // 空いている分だけ書き込み、書き込んだ要素数を返す
+  size_t Write(const T* data, size_t count) {
+    count = std::min(count, available());
+    if (count == 0) {
+      return 0;
+    }
+    size_t tail = (head_ + size_) % capacity();
+    size_t first = std::min(count, capacity() - tail);
+    memcpy(buffer_.data() + tail, data, first * sizeof(T));
+    memcpy(buffer_.data(), data + first, (count - first) * sizeof(T));
+    size_ += count;
+    return count;
+  }
+
+  // 先頭から読み出し、読み出した要素数を返す
+  size_t Read(T* data, size_t count) {
+    return Consume(count, [&data](const T* p, size_t n) {
+      memcpy(data, p, n * sizeof(T));
+      data += n;
+    });
+  }
+
+  // 先頭から捨て、捨てた要素数を返す
+  size_t Discard(size_t count) {
+    return Consume(count, [](const T*, size_t) {});
+  }
+
+  // 先頭から最大 count 要素を連続した領域ごとに func(ptr, n) に渡して取り除く
+  template <typename F>
+  size_t Consume(size_t count, F&& func) {
+    count = std::min(count, size_);
+    size_t first = std::min(count, capacity() - head_);
+    if (first > 0) {
+      func(buffer_.data() + head_, first);
+    }
+    if (count > first) {
+      func(buffer_.data(), count - first);
+    }
+    head_ = count == 0 ? head_ : (head_ + count) % capacity();
+    size_ -= count;
+    return count;
+  }
+
+ private:
+  std::vector<T> buffer_;
+  size_t head_;
+  size_t size_;
+};
+
+#endif
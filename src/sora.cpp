@@ -1,7 +1,18 @@
 #include "sora.h"
 
-Sora::Sora(bool use_hardware_encoder) {
+// WebRTC
+#include <api/video_codecs/builtin_video_encoder_factory.h>
+
+Sora::Sora(bool use_hardware_encoder,
+           bool use_callback_thread,
+           size_t io_threads) {
   factory_.reset(new SoraFactory(use_hardware_encoder));
+  if (use_callback_thread) {
+    dispatcher_ = std::make_shared<SoraCallbackDispatcher>();
+  }
+  if (io_threads > 0) {
+    io_context_pool_.reset(new SoraIoContextPool(io_threads));
+  }
 }
 
 Sora::~Sora() {
@@ -15,8 +26,32 @@ std::shared_ptr<SoraConnection> Sora::CreateConnection(
     const std::string& client_id,
     const nb::handle& metadata,
     SoraTrackInterface* audio_source,
-    SoraTrackInterface* video_source) {
-  std::shared_ptr<SoraConnection> conn = std::make_shared<SoraConnection>(this);
+    SoraTrackInterface* video_source,
+    bool audio,
+    bool video,
+    const std::string& audio_codec_type,
+    const std::string& video_codec_type,
+    int audio_bit_rate,
+    int video_bit_rate) {
+  if (audio_codec_type != "OPUS" && audio_codec_type != "LYRA") {
+    throw nb::value_error(
+        ("Invalid audio_codec_type: " + audio_codec_type).c_str());
+  }
+  if (video_codec_type != "VP8" && video_codec_type != "VP9" &&
+      video_codec_type != "AV1" && video_codec_type != "H264") {
+    throw nb::value_error(
+        ("Invalid video_codec_type: " + video_codec_type).c_str());
+  }
+  if (audio_bit_rate < 0 || video_bit_rate < 0) {
+    throw nb::value_error("bit_rate must not be negative");
+  }
+  if ((!audio && audio_source) || (!video && video_source)) {
+    throw nb::value_error(
+        "audio_source and video_source require audio and video to be enabled");
+  }
+
+  std::shared_ptr<SoraConnection> conn =
+      std::make_shared<SoraConnection>(this, dispatcher_);
   sora::SoraSignalingConfig config;
   config.pc_factory = factory_->GetPeerConnectionFactory();
   config.observer = conn;
@@ -24,16 +59,21 @@ std::shared_ptr<SoraConnection> Sora::CreateConnection(
   config.role = role;
   config.channel_id = channel_id;
   config.client_id = client_id;
-  config.video = true;
-  config.audio = true;
-  config.video_codec_type = "VP8";
-  config.audio_codec_type = "OPUS";
+  // 受信だけの場合も false にしたメディアはネゴシエーションされず、デコードもされない
+  config.video = video;
+  config.audio = audio;
+  config.video_codec_type = video_codec_type;
+  config.audio_codec_type = audio_codec_type;
+  // 0 の場合は Sora の設定に従う
+  config.video_bit_rate = video_bit_rate;
+  config.audio_bit_rate = audio_bit_rate;
   config.metadata = CovertJsonValue(metadata);
   config.network_manager =
       factory_->GetConnectionContext()->default_network_manager();
   config.socket_factory =
       factory_->GetConnectionContext()->default_socket_factory();
-  conn->Init(config);
+  conn->Init(config, io_context_pool_ ? io_context_pool_->Next() : nullptr,
+             factory_->GetConnectionContext()->signaling_thread());
   if (audio_source) {
     conn->SetAudioTrack(audio_source);
   }
@@ -43,19 +83,29 @@ std::shared_ptr<SoraConnection> Sora::CreateConnection(
   return conn;
 }
 
-SoraAudioSource* Sora::CreateAudioSource(size_t channels, int sample_rate) {
+SoraAudioSource* Sora::CreateAudioSource(size_t channels,
+                                         int sample_rate,
+                                         bool paced,
+                                         int max_buffer_ms) {
+  if (paced && max_buffer_ms <= 0) {
+    throw nb::value_error("max_buffer_ms must be positive");
+  }
   auto source =
       rtc::make_ref_counted<SoraAudioSourceInterface>(channels, sample_rate);
 
   std::string track_id = rtc::CreateRandomString(16);
   auto track = factory_->GetPeerConnectionFactory()->CreateAudioTrack(
       track_id, source.get());
-  SoraAudioSource* audio_source =
-      new SoraAudioSource(this, source, track, channels, sample_rate);
+  SoraAudioSource* audio_source = new SoraAudioSource(
+      this, source, track, channels, sample_rate, paced, max_buffer_ms);
+  audio_source->SetCallbackDispatcher(dispatcher_);
   return audio_source;
 }
 
-SoraVideoSource* Sora::CreateVideoSource() {
+SoraVideoSource* Sora::CreateVideoSource(size_t max_queue_size,
+                                         const std::string& queue_policy,
+                                         bool scheduled,
+                                         const std::string& late_frame_policy) {
   sora::ScalableVideoTrackSourceConfig config;
   auto source = rtc::make_ref_counted<sora::ScalableVideoTrackSource>(config);
 
@@ -63,10 +113,91 @@ SoraVideoSource* Sora::CreateVideoSource() {
   auto track = factory_->GetPeerConnectionFactory()->CreateVideoTrack(
       track_id, source.get());
 
-  SoraVideoSource* video_source = new SoraVideoSource(this, source, track);
+  SoraVideoSource* video_source =
+      new SoraVideoSource(this, source, track, max_queue_size, queue_policy,
+                          scheduled, late_frame_policy);
+  video_source->SetCallbackDispatcher(dispatcher_);
   return video_source;
 }
 
+SoraVideoLoopback* Sora::CreateVideoLoopback(SoraVideoSource* source,
+                                             const std::string& codec_type,
+                                             int bit_rate) {
+  if (!source->GetTrack()) {
+    throw nb::value_error("source is already disposed");
+  }
+  if (bit_rate < 0) {
+    throw nb::value_error("bit_rate must not be negative");
+  }
+  if (codec_type.empty()) {
+    // エンコードしない場合は入力の Track に直接 Sink を繋ぐ
+    SoraVideoLoopback* loopback = new SoraVideoLoopback(
+        source, nullptr, source->GetTrack(), codec_type, bit_rate);
+    loopback->SetCallbackDispatcher(dispatcher_);
+    return loopback;
+  }
+  if (codec_type != "VP8" && codec_type != "VP9" && codec_type != "AV1" &&
+      codec_type != "H264") {
+    throw nb::value_error(("Invalid codec_type: " + codec_type).c_str());
+  }
+  // ハードウェアのエンコーダーは使わず、どの環境でも同じ結果になるソフトウェアのものを使う
+  bool supported = false;
+  for (const auto& format :
+       webrtc::CreateBuiltinVideoEncoderFactory()->GetSupportedFormats()) {
+    supported |= format.name == codec_type;
+  }
+  if (!supported) {
+    throw nb::value_error(("Unsupported codec_type: " + codec_type).c_str());
+  }
+
+  sora::ScalableVideoTrackSourceConfig config;
+  auto output = rtc::make_ref_counted<sora::ScalableVideoTrackSource>(config);
+  std::string track_id = rtc::CreateRandomString(16);
+  auto track = factory_->GetPeerConnectionFactory()->CreateVideoTrack(
+      track_id, output.get());
+  SoraVideoLoopback* loopback = new SoraVideoLoopback(
+      source, output, track, codec_type, bit_rate == 0 ? 1000 : bit_rate);
+  loopback->SetCallbackDispatcher(dispatcher_);
+  return loopback;
+}
+
+SoraAudioLoopback* Sora::CreateAudioLoopback(SoraAudioSource* source,
+                                             const std::string& codec_type,
+                                             int bit_rate) {
+  if (!source->GetTrack()) {
+    throw nb::value_error("source is already disposed");
+  }
+  if (bit_rate < 0) {
+    throw nb::value_error("bit_rate must not be negative");
+  }
+  if (codec_type.empty()) {
+    // エンコードしない場合は入力の Track に直接 Sink を繋ぐ
+    SoraAudioLoopback* loopback =
+        new SoraAudioLoopback(source, nullptr, source->GetTrack(), codec_type,
+                              source->channels(), bit_rate);
+    loopback->SetCallbackDispatcher(dispatcher_);
+    return loopback;
+  }
+  if (codec_type != "OPUS") {
+    throw nb::value_error(("Invalid codec_type: " + codec_type).c_str());
+  }
+  if (source->channels() != 1 && source->channels() != 2) {
+    throw nb::value_error("OPUS supports only 1 or 2 channels");
+  }
+
+  // Opus のデコーダーは 48000 Hz で出力する
+  auto output = rtc::make_ref_counted<SoraAudioSourceInterface>(
+      source->channels(), 48000);
+  std::string track_id = rtc::CreateRandomString(16);
+  auto track = factory_->GetPeerConnectionFactory()->CreateAudioTrack(
+      track_id, output.get());
+  SoraAudioLoopback* loopback =
+      new SoraAudioLoopback(source, output, track, codec_type,
+                            source->channels(), bit_rate == 0 ? 64 : bit_rate);
+  loopback->SetCallbackDispatcher(dispatcher_);
+  return loopback;
+}
+
 boost::json::value Sora::CovertJsonValue(nb::handle value) {
   if (value.is_none()) {
     return nullptr;
@@ -6,14 +6,17 @@
 
 #include "dispose_listener.h"
 #include "sora_audio_source.h"
+#include "sora_callback_dispatcher.h"
 #include "sora_connection.h"
 #include "sora_factory.h"
+#include "sora_io_context_pool.h"
+#include "sora_loopback.h"
 #include "sora_track_interface.h"
 #include "sora_video_source.h"
 
 class Sora : public DisposePublisher {
  public:
-  Sora(bool use_hardware_encoder);
+  Sora(bool use_hardware_encoder, bool use_callback_thread, size_t io_threads);
   ~Sora();
 
   std::shared_ptr<SoraConnection> CreateConnection(
@@ -23,14 +26,36 @@ class Sora : public DisposePublisher {
       const std::string& client_id,
       const nb::handle& metadata,
       SoraTrackInterface* audio_source,
-      SoraTrackInterface* video_source);
+      SoraTrackInterface* video_source,
+      bool audio,
+      bool video,
+      const std::string& audio_codec_type,
+      const std::string& video_codec_type,
+      int audio_bit_rate,
+      int video_bit_rate);
 
-  SoraAudioSource* CreateAudioSource(size_t channels, int sample_rate);
-  SoraVideoSource* CreateVideoSource();
+  SoraAudioSource* CreateAudioSource(size_t channels,
+                                     int sample_rate,
+                                     bool paced,
+                                     int max_buffer_ms);
+  SoraVideoSource* CreateVideoSource(size_t max_queue_size,
+                                     const std::string& queue_policy,
+                                     bool scheduled,
+                                     const std::string& late_frame_policy);
+  SoraVideoLoopback* CreateVideoLoopback(SoraVideoSource* source,
+                                         const std::string& codec_type,
+                                         int bit_rate);
+  SoraAudioLoopback* CreateAudioLoopback(SoraAudioSource* source,
+                                         const std::string& codec_type,
+                                         int bit_rate);
 
  private:
   boost::json::value CovertJsonValue(nb::handle value);
 
   std::unique_ptr<SoraFactory> factory_;
+  // use_callback_thread が有効な場合のみ作る
+  std::shared_ptr<SoraCallbackDispatcher> dispatcher_;
+  // io_threads が指定された場合のみ作り、全ての接続で共有する
+  std::unique_ptr<SoraIoContextPool> io_context_pool_;
 };
 #endif
\ No newline at end of file
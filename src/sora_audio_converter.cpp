@@ -0,0 +1,134 @@
+#include "sora_audio_converter.h"
+
+#include <algorithm>
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+// WebRTC
+#include <common_audio/include/audio_util.h>
+#include <modules/audio_mixer/audio_frame_manipulator.h>
+
+namespace nb = nanobind;
+
+SoraAudioConverter::SoraAudioConverter(size_t channels, int sample_rate)
+    : channels_(channels),
+      sample_rate_(sample_rate),
+      input_channels_(0),
+      input_sample_rate_(0),
+      input_block_frames_(0),
+      output_block_frames_(0),
+      audio_frame_(std::make_unique<webrtc::AudioFrame>()) {}
+
+bool SoraAudioConverter::IsPassthrough(size_t channels, int sample_rate) const {
+  return channels == channels_ && sample_rate == sample_rate_;
+}
+
+void SoraAudioConverter::Convert(const int16_t* data,
+                                 size_t samples_per_channel,
+                                 size_t channels,
+                                 int sample_rate,
+                                 std::vector<int16_t>& out) {
+  Reset(channels, sample_rate);
+  if (channels != channels_) {
+    remixed_.clear();
+    Remix(data, samples_per_channel, remixed_);
+    data = remixed_.data();
+  }
+  if (sample_rate != sample_rate_) {
+    Resample(data, samples_per_channel, out);
+  } else {
+    out.insert(out.end(), data, data + samples_per_channel * channels_);
+  }
+}
+
+void SoraAudioConverter::Convert(const float* data,
+                                 size_t samples_per_channel,
+                                 size_t channels,
+                                 int sample_rate,
+                                 std::vector<int16_t>& out) {
+  // 範囲外の値は飽和させる
+  int16_buffer_.resize(samples_per_channel * channels);
+  webrtc::FloatToS16(data, int16_buffer_.size(), int16_buffer_.data());
+  Convert(int16_buffer_.data(), samples_per_channel, channels, sample_rate,
+          out);
+}
+
+void SoraAudioConverter::Reset(size_t channels, int sample_rate) {
+  if (channels == input_channels_ && sample_rate == input_sample_rate_) {
+    return;
+  }
+  input_channels_ = channels;
+  input_sample_rate_ = sample_rate;
+  pending_.clear();
+  resamplers_.clear();
+  if (sample_rate == sample_rate_) {
+    return;
+  }
+  // 22050 Hz など 10 ms が整数のフレーム数にならないレートもあるので、
+  // 入力と出力がどちらも整数になる最短の長さをブロックにする
+  input_block_frames_ = 0;
+  for (int ms = 10; ms <= 1000; ms += 10) {
+    if ((int64_t)sample_rate * ms % 1000 == 0 &&
+        (int64_t)sample_rate_ * ms % 1000 == 0) {
+      input_block_frames_ = (int64_t)sample_rate * ms / 1000;
+      output_block_frames_ = (int64_t)sample_rate_ * ms / 1000;
+      break;
+    }
+  }
+  if (input_block_frames_ == 0) {
+    input_channels_ = 0;
+    input_sample_rate_ = 0;
+    throw nb::value_error(
+        ("Invalid sample_rate: " + std::to_string(sample_rate)).c_str());
+  }
+  for (size_t i = 0; i < channels_; i++) {
+    resamplers_.push_back(std::make_unique<webrtc::PushSincResampler>(
+        input_block_frames_, output_block_frames_));
+  }
+  channel_in_.resize(input_block_frames_);
+  channel_out_.resize(output_block_frames_);
+}
+
+void SoraAudioConverter::Remix(const int16_t* data,
+                               size_t samples_per_channel,
+                               std::vector<int16_t>& out) {
+  // AudioFrame に収まる長さずつ SoraAudioSinkImpl と同じ RemixFrame でチャンネル数を変える
+  const size_t max_frames = webrtc::AudioFrame::kMaxDataSizeSamples /
+                            std::max(input_channels_, channels_);
+  for (size_t offset = 0; offset < samples_per_channel; offset += max_frames) {
+    size_t frames = std::min(max_frames, samples_per_channel - offset);
+    audio_frame_->UpdateFrame(0, data + offset * input_channels_, frames,
+                              input_sample_rate_,
+                              webrtc::AudioFrame::kNormalSpeech,
+                              webrtc::AudioFrame::kVadUnknown, input_channels_);
+    webrtc::RemixFrame(channels_, audio_frame_.get());
+    out.insert(out.end(), audio_frame_->data(),
+               audio_frame_->data() + frames * channels_);
+  }
+}
+
+void SoraAudioConverter::Resample(const int16_t* data,
+                                  size_t samples_per_channel,
+                                  std::vector<int16_t>& out) {
+  pending_.insert(pending_.end(), data, data + samples_per_channel * channels_);
+  const size_t block_size = input_block_frames_ * channels_;
+  size_t offset = 0;
+  while (pending_.size() - offset >= block_size) {
+    size_t out_offset = out.size();
+    out.resize(out_offset + output_block_frames_ * channels_);
+    // PushSincResampler は 1 チャンネルずつ処理するので、分けてから戻す
+    for (size_t ch = 0; ch < channels_; ch++) {
+      for (size_t i = 0; i < input_block_frames_; i++) {
+        channel_in_[i] = pending_[offset + i * channels_ + ch];
+      }
+      resamplers_[ch]->Resample(channel_in_.data(), input_block_frames_,
+                                channel_out_.data(), output_block_frames_);
+      for (size_t i = 0; i < output_block_frames_; i++) {
+        out[out_offset + i * channels_ + ch] = channel_out_[i];
+      }
+    }
+    offset += block_size;
+  }
+  pending_.erase(pending_.begin(), pending_.begin() + offset);
+}
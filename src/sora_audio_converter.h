@@ -0,0 +1,63 @@
+#ifndef SORA_AUDIO_CONVERTER_H_
+#define SORA_AUDIO_CONVERTER_H_
+
+#include <memory>
+#include <vector>
+
+// WebRTC
+#include <api/audio/audio_frame.h>
+#include <common_audio/resampler/push_sinc_resampler.h>
+
+/*
+ * SoraAudioSource に渡された音声を Source のサンプリングレートとチャンネル数の int16 に変換する
+ * float32 は -1.0 から 1.0 の範囲を int16 の範囲に変換する
+ * リサンプリングはブロック単位で行うので、ブロックに満たない残りは次の呼び出しまで持ち越す
+ * スレッドセーフではないので、排他は利用する側で行う
+ */
+class SoraAudioConverter {
+ public:
+  SoraAudioConverter(size_t channels, int sample_rate);
+
+  // 入力のフォーマットが出力と同じで変換が不要な場合は true を返す
+  bool IsPassthrough(size_t channels, int sample_rate) const;
+
+  // 変換した結果を out の末尾に追加する
+  void Convert(const int16_t* data,
+               size_t samples_per_channel,
+               size_t channels,
+               int sample_rate,
+               std::vector<int16_t>& out);
+  void Convert(const float* data,
+               size_t samples_per_channel,
+               size_t channels,
+               int sample_rate,
+               std::vector<int16_t>& out);
+
+ private:
+  void Reset(size_t channels, int sample_rate);
+  void Remix(const int16_t* data,
+             size_t samples_per_channel,
+             std::vector<int16_t>& out);
+  void Resample(const int16_t* data,
+                size_t samples_per_channel,
+                std::vector<int16_t>& out);
+
+  const size_t channels_;
+  const int sample_rate_;
+  // 直前の入力のフォーマット、変わった場合は持ち越した残りを捨てて作り直す
+  size_t input_channels_;
+  int input_sample_rate_;
+  // 入力と出力のどちらも整数のフレーム数になるリサンプリングのブロック
+  size_t input_block_frames_;
+  size_t output_block_frames_;
+  std::vector<std::unique_ptr<webrtc::PushSincResampler>> resamplers_;
+  std::unique_ptr<webrtc::AudioFrame> audio_frame_;
+  std::vector<int16_t> int16_buffer_;
+  std::vector<int16_t> remixed_;
+  // ブロックに満たずに持ち越した、出力のチャンネル数にした入力
+  std::vector<int16_t> pending_;
+  std::vector<int16_t> channel_in_;
+  std::vector<int16_t> channel_out_;
+};
+
+#endif
@@ -1,19 +1,41 @@
 #include "sora_audio_sink.h"
 
-#include <chrono>
+#include <algorithm>
+#include <memory>
+#include <vector>
 
 // WebRTC
 #include <api/audio/channel_layout.h>
+#include <common_audio/include/audio_util.h>
 #include <modules/audio_mixer/audio_frame_manipulator.h>
 
 SoraAudioSinkImpl::SoraAudioSinkImpl(SoraTrackInterface* track,
                                      int output_sample_rate,
-                                     size_t output_channels)
+                                     size_t output_channels,
+                                     int max_buffer_ms,
+                                     const std::string& overflow_policy,
+                                     const std::string& output_dtype,
+                                     int chunk_ms)
     : track_(track),
+      dispatcher_(track->GetCallbackDispatcher()),
       output_sample_rate_(output_sample_rate),
       output_channels_(output_channels),
+      max_buffer_ms_(max_buffer_ms),
+      overflow_policy_(ParseOverflowPolicy(overflow_policy)),
+      output_type_(ParseSampleType(output_dtype)),
+      chunk_ms_(chunk_ms),
+      chunk_channels_(0),
       sample_rate_(0),
-      number_of_channels_(0) {
+      number_of_channels_(0),
+      overrun_frames_(0),
+      underrun_count_(0),
+      notify_frames_(0) {
+  if (max_buffer_ms_ <= 0) {
+    throw nb::value_error("max_buffer_ms must be positive");
+  }
+  if (chunk_ms_ <= 0) {
+    throw nb::value_error("chunk_ms must be positive");
+  }
   audio_frame_ = std::make_unique<webrtc::AudioFrame>();
   track_->AddSubscriber(this);
   webrtc::AudioTrackInterface* audio_track =
@@ -30,6 +52,10 @@ void SoraAudioSinkImpl::Del() {
     track_->RemoveSubscriber(this);
   }
   Disposed();
+  if (dispatcher_) {
+    // Sink を外した後なので、これ以上コールバックが積まれることはない
+    dispatcher_->Cancel(this);
+  }
 }
 
 void SoraAudioSinkImpl::Disposed() {
@@ -52,6 +78,7 @@ void SoraAudioSinkImpl::OnData(
     size_t number_of_channels,
     size_t number_of_frames,
     absl::optional<int64_t> absolute_capture_timestamp_ms) {
+  frames_in_.Add(number_of_frames);
   if (absolute_capture_timestamp_ms) {
     audio_frame_->set_absolute_capture_timestamp_ms(
         *absolute_capture_timestamp_ms);
@@ -60,10 +87,15 @@ void SoraAudioSinkImpl::OnData(
   bool need_resample =
       output_sample_rate_ != -1 && sample_rate != output_sample_rate_;
   if (need_resample) {
-    int samples_per_channel_int = resampler_.Resample10Msec(
-        static_cast<const int16_t*>(audio_data), sample_rate,
-        output_sample_rate_, number_of_channels,
-        webrtc::AudioFrame::kMaxDataSizeSamples, audio_frame_->mutable_data());
+    int samples_per_channel_int;
+    {
+      SoraLatencyTimer timer(resample_latency_);
+      samples_per_channel_int = resampler_.Resample10Msec(
+          static_cast<const int16_t*>(audio_data), sample_rate,
+          output_sample_rate_, number_of_channels,
+          webrtc::AudioFrame::kMaxDataSizeSamples,
+          audio_frame_->mutable_data());
+    }
     if (samples_per_channel_int < 0) {
       return;
     }
@@ -78,6 +110,7 @@ void SoraAudioSinkImpl::OnData(
   bool need_remix =
       output_channels_ != 0 && number_of_channels != output_channels_;
   if (need_remix) {
+    SoraLatencyTimer timer(remix_latency_);
     if (!need_resample) {
       audio_frame_->UpdateFrame(
           audio_frame_->timestamp_, static_cast<const int16_t*>(audio_data),
@@ -100,6 +133,8 @@ void SoraAudioSinkImpl::AppendData(const int16_t* audio_data,
                                    int sample_rate,
                                    size_t number_of_channels,
                                    size_t number_of_frames) {
+  bool format_changed = false;
+  bool notify = false;
   {
     std::unique_lock<std::mutex> lock(buffer_mtx_);
 
@@ -108,54 +143,170 @@ void SoraAudioSinkImpl::AppendData(const int16_t* audio_data,
       /* 実行中にフォーマットが変更されることは想定しないはずなので、その場合はエラーに落とすようにする */
       sample_rate_ = sample_rate;
       number_of_channels_ = number_of_channels;
-      if (on_format_) {
-        on_format_(sample_rate_, number_of_channels_);
-      }
+      // バッファの容量は max_buffer_ms 分で固定し、これ以上メモリを使わないようにする
+      buffer_.Reset((size_t)sample_rate_ * max_buffer_ms_ / 1000 *
+                    number_of_channels_);
+      format_changed = true;
     }
 
-    const size_t num_elements = number_of_channels_ * number_of_frames;
-    buffer_.AppendData(num_elements, [&](rtc::ArrayView<int16_t> buf) {
-      memcpy(buf.data(), audio_data, num_elements * sizeof(int16_t));
-      return num_elements;
-    });
+    const int16_t* data = audio_data;
+    size_t num_elements = number_of_channels_ * number_of_frames;
+    if (num_elements > buffer_.available()) {
+      if (overflow_policy_ == OverflowPolicy::kDropOldest) {
+        // 古いデータを捨てて新しいデータを入れる
+        if (num_elements > buffer_.capacity()) {
+          size_t skip = num_elements - buffer_.capacity();
+          data += skip;
+          num_elements -= skip;
+          overrun_frames_ += skip / number_of_channels_;
+        }
+        size_t discard = num_elements - buffer_.available();
+        buffer_.Discard(discard);
+        overrun_frames_ += discard / number_of_channels_;
+      } else {
+        // 入りきらない新しいデータを捨てる
+        overrun_frames_ +=
+            (num_elements - buffer_.available()) / number_of_channels_;
+      }
+    }
+    const size_t notify_elements = notify_frames_ * number_of_channels_;
+    const bool below = buffer_.size() < notify_elements;
+    buffer_.Write(data, num_elements);
+    // 貯まった量が notify_frames_ を超えた時だけ呼び、超えている間は呼ばない
+    notify = below && buffer_.size() >= notify_elements;
 
     buffer_cond_.notify_all();
   }
+  if (notify) {
+    CallNotify();
+  }
 
-  if (on_data_) {
-    size_t shape[2] = {number_of_frames, number_of_channels_};
-    auto data = nb::ndarray<nb::numpy, int16_t, nb::shape<nb::any, nb::any>>(
-        (void*)audio_data, 2, shape);
-    /* まだ使ったことながない。現状 Python 側で on_frame と同じ感覚でコールバックの外に値を持ち出すと落ちるはず。 */
-    on_data_(data);
+  // コールバックはロックの外で呼ぶ。 GIL を待つ間に read() がロックを取れなくなるため
+  if (format_changed && on_data_ && chunk_ && !chunk_->empty()) {
+    // フォーマットが変わる前の分は短くても先に渡す
+    DeliverChunk(std::move(chunk_), chunk_channels_);
+  }
+  if (format_changed && on_format_) {
+    if (dispatcher_) {
+      dispatcher_->Post(this, [this, sample_rate, number_of_channels]() {
+        if (on_format_) {
+          on_format_(sample_rate, number_of_channels);
+        }
+      });
+    } else {
+      on_format_(sample_rate, number_of_channels);
+    }
+  }
+
+  if (!on_data_) {
+    // コールバックが外された場合は貯めていたデータを捨てる
+    chunk_ = nullptr;
+    return;
+  }
+  // chunk_ms 分が貯まるごとに 1 回だけ on_data を呼ぶ
+  const size_t chunk_elements =
+      std::max<size_t>((size_t)sample_rate * chunk_ms_ / 1000, 1) *
+      number_of_channels;
+  const int16_t* data = audio_data;
+  size_t remaining = number_of_frames * number_of_channels;
+  while (remaining > 0) {
+    if (!chunk_) {
+      chunk_ = std::make_shared<std::vector<int16_t>>();
+      chunk_->reserve(chunk_elements);
+      chunk_channels_ = number_of_channels;
+    }
+    size_t copy = std::min(remaining, chunk_elements - chunk_->size());
+    chunk_->insert(chunk_->end(), data, data + copy);
+    data += copy;
+    remaining -= copy;
+    if (chunk_->size() == chunk_elements) {
+      DeliverChunk(std::move(chunk_), chunk_channels_);
+    }
   }
 }
 
+void SoraAudioSinkImpl::DeliverChunk(
+    std::shared_ptr<std::vector<int16_t>> samples,
+    size_t number_of_channels) {
+  if (output_type_ == SampleType::kFloat32) {
+    // read() と同じく [-1, 1) に正規化した float32 で渡す
+    // GIL を取る前に変換しておく
+    auto converted = std::make_shared<std::vector<float>>(samples->size());
+    webrtc::S16ToFloat(samples->data(), samples->size(), converted->data());
+    PostChunk(std::move(converted), number_of_channels);
+  } else {
+    PostChunk(std::move(samples), number_of_channels);
+  }
+}
+
+template <typename T>
+void SoraAudioSinkImpl::PostChunk(std::shared_ptr<std::vector<T>> samples,
+                                  size_t number_of_channels) {
+  // コールバックに渡す ndarray は samples を所有するので、コールバックの外に持ち出してもよい
+  auto call = [this, samples, number_of_channels]() {
+    if (!on_data_) {
+      return;
+    }
+    auto* holder = new std::shared_ptr<std::vector<T>>(samples);
+    nb::capsule owner(holder, [](void* p) noexcept {
+      delete reinterpret_cast<std::shared_ptr<std::vector<T>>*>(p);
+    });
+    size_t shape[2] = {samples->size() / number_of_channels,
+                       number_of_channels};
+    SoraLatencyTimer timer(callback_latency_);
+    on_data_(nb::ndarray<nb::numpy, nb::shape<nb::any, nb::any>>(
+        samples->data(), 2, shape, owner, nullptr, nb::dtype<T>()));
+  };
+  if (dispatcher_) {
+    dispatcher_->Post(this, std::move(call));
+  } else {
+    // capsule を作るので GIL を取ってから呼ぶ
+    nb::gil_scoped_acquire acquire;
+    call();
+  }
+}
+
+void SoraAudioSinkImpl::CallNotify() {
+  auto call = [this]() {
+    if (notify_) {
+      notify_();
+    }
+  };
+  if (dispatcher_) {
+    dispatcher_->Post(this, std::move(call));
+  } else {
+    // notify_ は Python から差し替えられるので、 GIL を取ってから触る
+    nb::gil_scoped_acquire acquire;
+    call();
+  }
+}
+
+bool SoraAudioSinkImpl::SetNotify(std::function<void()> notify, size_t frames) {
+  notify_ = std::move(notify);
+  std::lock_guard<std::mutex> lock(buffer_mtx_);
+  notify_frames_ = notify_ ? std::max<size_t>(frames, 1) : 0;
+  return notify_frames_ > 0 && number_of_channels_ > 0 &&
+         buffer_.size() >= notify_frames_ * number_of_channels_;
+}
+
 nb::tuple SoraAudioSinkImpl::Read(size_t frames, float timeout) {
   std::unique_lock<std::mutex> lock(buffer_mtx_);
+  if (frames > 0 && number_of_channels_ > 0) {
+    CheckCapacity(frames * number_of_channels_);
+  }
 
   if (buffer_.size() == 0) {
     // 返すものがない時は即座に返す
+    if (frames > 0) {
+      underrun_count_++;
+    }
     return nb::make_tuple(false, nb::none());
   }
   size_t num_of_samples;
   if (frames > 0) {
     // フレーム数のリクエストがある場合はリクエスト分が貯まるまで待つ
     num_of_samples = frames * number_of_channels_;
-    if (!buffer_cond_.wait_for(
-            lock,
-            std::chrono::nanoseconds(
-                // Python の流儀に合わせて秒を float で受け取っているので換算
-                (int64_t)((double)timeout * 1000. * 1000. * 1000.)),
-            [&] {
-              return buffer_.size() >= num_of_samples ||
-                     PyErr_CheckSignals() != 0;
-            })) {
-      // タイムアウトで返す
-      return nb::make_tuple(false, nb::none());
-    }
-    if (PyErr_CheckSignals() != 0) {
-      // Signals で wait を抜けた時は返す
+    if (!WaitSamples(lock, num_of_samples, timeout)) {
       return nb::make_tuple(false, nb::none());
     }
   } else {
@@ -163,19 +314,162 @@ nb::tuple SoraAudioSinkImpl::Read(size_t frames, float timeout) {
     num_of_samples = buffer_.size();
   }
 
+  size_t shape[2] = {num_of_samples / number_of_channels_, number_of_channels_};
+  if (output_type_ == SampleType::kFloat32) {
+    float* output_data = new float[num_of_samples];
+    CopySamples(output_data, output_type_, num_of_samples);
+    nb::capsule deleter(output_data, [](void* p) noexcept {
+      float* data = reinterpret_cast<float*>(p);
+      delete[] data;
+    });
+    auto output = nb::ndarray<nb::numpy, float, nb::shape<nb::any, nb::any>>(
+        output_data, 2, shape, deleter);
+    return nb::make_tuple(true, output);
+  }
+
   int16_t* output_data = new int16_t[num_of_samples];
-  memcpy((void*)output_data, buffer_.data(), num_of_samples * sizeof(int16_t));
-  memmove(buffer_.data(), buffer_.data() + num_of_samples,
-          (buffer_.size() - num_of_samples) * sizeof(int16_t));
-  buffer_.SetSize(buffer_.size() - num_of_samples);
+  CopySamples(output_data, output_type_, num_of_samples);
 
   nb::capsule deleter(output_data, [](void* p) noexcept {
     int16_t* data = reinterpret_cast<int16_t*>(p);
     delete[] data;
   });
 
-  size_t shape[2] = {num_of_samples / number_of_channels_, number_of_channels_};
   auto output = nb::ndarray<nb::numpy, int16_t, nb::shape<nb::any, nb::any>>(
       (int16_t*)output_data, 2, shape, deleter);
   return nb::make_tuple(true, output);
 }
+
+size_t SoraAudioSinkImpl::ReadInto(
+    nb::ndarray<nb::c_contig, nb::device::cpu> out,
+    float timeout) {
+  SampleType type;
+  if (out.dtype() == nb::dtype<int16_t>()) {
+    type = SampleType::kInt16;
+  } else if (out.dtype() == nb::dtype<float>()) {
+    type = SampleType::kFloat32;
+  } else {
+    throw nb::type_error("out must be an int16 or float32 ndarray");
+  }
+  if (out.ndim() != 1 && out.ndim() != 2) {
+    throw nb::value_error("out must be a 1 or 2 dimensional ndarray");
+  }
+  const size_t frames = out.shape(0);
+  const size_t channels = out.ndim() == 2 ? out.shape(1) : 1;
+
+  std::unique_lock<std::mutex> lock(buffer_mtx_);
+  if (number_of_channels_ == 0) {
+    // まだ音声を受信していない
+    underrun_count_++;
+    return 0;
+  }
+  if (channels != number_of_channels_) {
+    throw nb::value_error("The number of channels of out does not match");
+  }
+  CheckCapacity(frames * number_of_channels_);
+
+  // 要求分が貯まるまで待ち、タイムアウトした場合はあるだけ書き込む
+  WaitSamples(lock, frames * number_of_channels_, timeout);
+  size_t num_of_samples =
+      std::min(frames * number_of_channels_, buffer_.size());
+  CopySamples(out.data(), type, num_of_samples);
+  return num_of_samples / number_of_channels_;
+}
+
+void SoraAudioSinkImpl::CheckCapacity(size_t num_of_samples) {
+  // バッファの容量を超える量は貯まることがなく、待っても必ずタイムアウトする
+  if (num_of_samples > buffer_.capacity()) {
+    throw nb::value_error(
+        ("frames must not exceed max_buffer_ms (" +
+         std::to_string(buffer_.capacity() / number_of_channels_) + " frames)")
+            .c_str());
+  }
+}
+
+bool SoraAudioSinkImpl::WaitSamples(std::unique_lock<std::mutex>& lock,
+                                    size_t num_of_samples,
+                                    float timeout) {
+  // 待っている間は GIL を解放し、他の Python スレッドを止めないようにする
+  if (!WaitWithGilReleased(lock, buffer_cond_, timeout,
+                           [&] { return buffer_.size() >= num_of_samples; })) {
+    // タイムアウトで返す
+    underrun_count_++;
+    return false;
+  }
+  return true;
+}
+
+void SoraAudioSinkImpl::CopySamples(void* dst,
+                                    SampleType type,
+                                    size_t num_of_samples) {
+  frames_out_.Add(num_of_samples / number_of_channels_);
+  // リングバッファなので読み出した分のコピーだけで済み、残りを詰め直す必要はない
+  if (type == SampleType::kFloat32) {
+    // float32 の場合はコピーしながら [-1, 1) に正規化する
+    float* p = static_cast<float*>(dst);
+    buffer_.Consume(num_of_samples, [&p](const int16_t* src, size_t n) {
+      webrtc::S16ToFloat(src, n, p);
+      p += n;
+    });
+  } else {
+    buffer_.Read(static_cast<int16_t*>(dst), num_of_samples);
+  }
+}
+
+uint64_t SoraAudioSinkImpl::GetOverrunFrames() {
+  std::lock_guard<std::mutex> lock(buffer_mtx_);
+  return overrun_frames_;
+}
+
+uint64_t SoraAudioSinkImpl::GetUnderrunCount() {
+  std::lock_guard<std::mutex> lock(buffer_mtx_);
+  return underrun_count_;
+}
+
+int SoraAudioSinkImpl::GetSampleRate() {
+  std::lock_guard<std::mutex> lock(buffer_mtx_);
+  return sample_rate_;
+}
+
+size_t SoraAudioSinkImpl::GetChannels() {
+  std::lock_guard<std::mutex> lock(buffer_mtx_);
+  return number_of_channels_;
+}
+
+nb::dict SoraAudioSinkImpl::GetMetrics() {
+  nb::dict metrics;
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_out"] = nb::cast(frames_out_.Get());
+  {
+    std::lock_guard<std::mutex> lock(buffer_mtx_);
+    metrics["overrun_frames"] = nb::cast(overrun_frames_);
+    metrics["underrun_count"] = nb::cast(underrun_count_);
+    metrics["buffered_frames"] = nb::cast(
+        number_of_channels_ > 0 ? buffer_.size() / number_of_channels_ : 0);
+  }
+  metrics["resample_latency"] = resample_latency_.ToDict();
+  metrics["remix_latency"] = remix_latency_.ToDict();
+  metrics["callback_latency"] = callback_latency_.ToDict();
+  return metrics;
+}
+
+SoraAudioSinkImpl::OverflowPolicy SoraAudioSinkImpl::ParseOverflowPolicy(
+    const std::string& overflow_policy) {
+  if (overflow_policy == "drop_oldest") {
+    return OverflowPolicy::kDropOldest;
+  } else if (overflow_policy == "drop_newest") {
+    return OverflowPolicy::kDropNewest;
+  }
+  throw nb::value_error(
+      ("Invalid overflow_policy: " + overflow_policy).c_str());
+}
+
+SoraAudioSinkImpl::SampleType SoraAudioSinkImpl::ParseSampleType(
+    const std::string& dtype) {
+  if (dtype == "int16") {
+    return SampleType::kInt16;
+  } else if (dtype == "float32") {
+    return SampleType::kFloat32;
+  }
+  throw nb::value_error(("Invalid dtype: " + dtype).c_str());
+}
@@ -2,7 +2,10 @@
 #define SORA_AUDIO_SINK_H_
 
 #include <condition_variable>
+#include <memory>
 #include <mutex>
+#include <string>
+#include <vector>
 
 // nonobind
 #include <nanobind/nanobind.h>
@@ -13,8 +16,10 @@
 #include <api/media_stream_interface.h>
 #include <api/scoped_refptr.h>
 #include <modules/audio_coding/acm2/acm_resampler.h>
-#include <rtc_base/buffer.h>
 
+#include "gil_wait.h"
+#include "ring_buffer.h"
+#include "sora_metrics.h"
 #include "sora_track_interface.h"
 
 namespace nb = nanobind;
@@ -24,7 +29,11 @@ class SoraAudioSinkImpl : public webrtc::AudioTrackSinkInterface,
  public:
   SoraAudioSinkImpl(SoraTrackInterface* track,
                     int output_sample_rate,
-                    size_t output_channels);
+                    size_t output_channels,
+                    int max_buffer_ms,
+                    const std::string& overflow_policy,
+                    const std::string& output_dtype,
+                    int chunk_ms);
   ~SoraAudioSinkImpl();
 
   void Del();
@@ -38,29 +47,81 @@ class SoraAudioSinkImpl : public webrtc::AudioTrackSinkInterface,
               size_t number_of_frames,
               absl::optional<int64_t> absolute_capture_timestamp_ms) override;
 
-  std::function<void(
-      nb::ndarray<nb::numpy, int16_t, nb::shape<nb::any, nb::any>>)>
+  // output_dtype に合わせて int16 か float32 の ndarray を渡す
+  std::function<void(nb::ndarray<nb::numpy, nb::shape<nb::any, nb::any>>)>
       on_data_;
   std::function<void(int, size_t)> on_format_;
+  // GIL を持っている間だけ触る
+  std::function<void()> notify_;
 
   nb::tuple Read(size_t frames, float timeout);
+  // out は C-contiguous な int16 か float32 の ndarray でなければならず、それ以外は TypeError になる
+  size_t ReadInto(nb::ndarray<nb::c_contig, nb::device::cpu> out,
+                  float timeout);
+  int GetSampleRate();
+  size_t GetChannels();
+  // バッファに貯まったフレーム数が frames 以上になった時に notify を呼ぶ、データは渡さないので read で読む
+  // 既に frames 以上貯まっている場合は notify を呼ばずに true を返す
+  bool SetNotify(std::function<void()> notify, size_t frames);
+  uint64_t GetOverrunFrames();
+  uint64_t GetUnderrunCount();
+  nb::dict GetMetrics();
 
  private:
+  enum class OverflowPolicy {
+    kDropOldest,
+    kDropNewest,
+  };
+  enum class SampleType {
+    kInt16,
+    kFloat32,
+  };
+  static OverflowPolicy ParseOverflowPolicy(const std::string& overflow_policy);
+  static SampleType ParseSampleType(const std::string& dtype);
+  void CheckCapacity(size_t num_of_samples);
+  bool WaitSamples(std::unique_lock<std::mutex>& lock,
+                   size_t num_of_samples,
+                   float timeout);
+  void CopySamples(void* dst, SampleType type, size_t num_of_samples);
+
   void AppendData(const int16_t* audio_data,
                   int sample_rate,
                   size_t number_of_channels,
                   size_t number_of_frames);
+  void DeliverChunk(std::shared_ptr<std::vector<int16_t>> samples,
+                    size_t number_of_channels);
+  template <typename T>
+  void PostChunk(std::shared_ptr<std::vector<T>> samples,
+                 size_t number_of_channels);
+  void CallNotify();
 
   SoraTrackInterface* track_;
+  std::shared_ptr<SoraCallbackDispatcher> dispatcher_;
   const int output_sample_rate_;
   const size_t output_channels_;
+  const int max_buffer_ms_;
+  const OverflowPolicy overflow_policy_;
+  const SampleType output_type_;
+  const int chunk_ms_;
+  // on_data に渡すために貯めているデータ、 OnData を呼ぶスレッドからしか触らない
+  std::shared_ptr<std::vector<int16_t>> chunk_;
+  size_t chunk_channels_;
   std::unique_ptr<webrtc::AudioFrame> audio_frame_;
   webrtc::acm2::ACMResampler resampler_;
   std::mutex buffer_mtx_;
   std::condition_variable buffer_cond_;
-  rtc::BufferT<int16_t> buffer_;
+  RingBuffer<int16_t> buffer_;
   int sample_rate_;
   size_t number_of_channels_;
+  uint64_t overrun_frames_;
+  uint64_t underrun_count_;
+  // notify を呼ぶフレーム数、 0 の場合は呼ばない
+  size_t notify_frames_;
+  SoraCounter frames_in_;
+  SoraCounter frames_out_;
+  SoraLatencyHistogram resample_latency_;
+  SoraLatencyHistogram remix_latency_;
+  SoraLatencyHistogram callback_latency_;
 };
 
 #endif
\ No newline at end of file
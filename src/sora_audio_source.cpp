@@ -1,5 +1,10 @@
 #include "sora_audio_source.h"
 
+#include <algorithm>
+#include <vector>
+
+#include "gil_wait.h"
+
 SoraAudioSourceInterface::SoraAudioSourceInterface(size_t channels,
                                                    int sample_rate)
     : channels_(channels),
@@ -18,6 +23,9 @@ SoraAudioSourceInterface::~SoraAudioSourceInterface() {
 void SoraAudioSourceInterface::OnData(const int16_t* data,
                                       size_t samples_per_channel,
                                       absl::optional<int64_t> timestamp) {
+  // GIL を解放して呼ばれるので、複数のスレッドから呼ばれても 10 ms 未満の残りが壊れないようにする
+  webrtc::MutexLock lock(&data_lock_);
+  frames_in_.Add(samples_per_channel);
   size_t size = samples_per_channel * channels_;
   if (buffer_used_ > 0) {
     // 先に 10 ms に満たず残したデータを新たなデータと繋げて 10 ms を超える場合は送る
@@ -36,6 +44,7 @@ void SoraAudioSourceInterface::OnData(const int16_t* data,
       } else {
         // 非連続と判定した場合、後続のデータをバッファに貯め込むことを阻害しないように 0 にする
         last_timestamp_ = 0;
+        dropped_frames_.Add(buffer_used_ / channels_);
       }
     }
 
@@ -120,10 +129,19 @@ void SoraAudioSourceInterface::Add10MsData(const int16_t* data,
   if (timestamp) {
     last_timestamp_ = *timestamp;
   }
+  SoraLatencyTimer timer(deliver_latency_);
   webrtc::MutexLock lock(&sink_lock_);
   for (auto* sink : sinks_) {
     sink->OnData(data, 16, sample_rate_, channels_, buffer_samples_, timestamp);
   }
+  frames_sent_.Add(buffer_samples_);
+}
+
+void SoraAudioSourceInterface::AddMetrics(nb::dict& metrics) {
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_sent"] = nb::cast(frames_sent_.Get());
+  metrics["dropped_frames"] = nb::cast(dropped_frames_.Get());
+  metrics["deliver_latency"] = deliver_latency_.ToDict();
 }
 
 SoraAudioSource::SoraAudioSource(
@@ -131,22 +149,71 @@ SoraAudioSource::SoraAudioSource(
     rtc::scoped_refptr<SoraAudioSourceInterface> source,
     rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
     size_t channels,
-    int sample_rate)
-    : SoraTrackInterface(publisher, track), source_(source) {
+    int sample_rate,
+    bool paced,
+    int max_buffer_ms)
+    : SoraTrackInterface(publisher, track),
+      source_(source),
+      channels_(channels),
+      sample_rate_(sample_rate),
+      converter_(channels, sample_rate),
+      paced_(paced),
+      flush_(false),
+      finished_(false) {
+  if (paced_) {
+    // 10 ms 未満の容量では送れないので、最低でも 10 ms 分は確保する
+    size_t frames =
+        std::max((size_t)sample_rate_ / 100,
+                 (size_t)((int64_t)sample_rate_ * max_buffer_ms / 1000));
+    pending_.Reset(frames * channels_);
+    thread_.reset(new std::thread([this]() { PacingProcess(); }));
+  }
   publisher_->AddSubscriber(this);
 }
 
+SoraAudioSource::~SoraAudioSource() {
+  // Disposed で publisher_ が消えるので、先に Sora から外す
+  if (publisher_) {
+    publisher_->RemoveSubscriber(this);
+  }
+  Disposed();
+}
+
+void SoraAudioSource::Disposed() {
+  std::unique_lock<std::mutex> lock(pending_mtx_);
+  if (!finished_) {
+    finished_ = true;
+    lock.unlock();
+    pending_cond_.notify_all();
+    if (thread_) {
+      // 送信のスレッドが Sink のコールバックで GIL を待っているかもしれないので、解放してから待つ
+      if (PyGILState_Check()) {
+        nb::gil_scoped_release release;
+        thread_->join();
+      } else {
+        thread_->join();
+      }
+      thread_ = nullptr;
+    }
+  }
+  SoraTrackInterface::Disposed();
+}
+
+void SoraAudioSource::PubliserDisposed() {
+  Disposed();
+}
+
 void SoraAudioSource::OnData(const int16_t* data,
                              size_t samples_per_channel,
                              double timestamp) {
   if (!track_) {
     return;
   }
-  source_->OnData(data, samples_per_channel, (int64_t)(timestamp * 1000));
+  OnDataNative(data, samples_per_channel, (int64_t)(timestamp * 1000));
 }
 
 void SoraAudioSource::OnData(const int16_t* data, size_t samples_per_channel) {
-  source_->OnData(data, samples_per_channel, absl::nullopt);
+  OnDataNative(data, samples_per_channel, absl::nullopt);
 }
 
 void SoraAudioSource::OnData(nb::ndarray<int16_t,
@@ -157,8 +224,7 @@ void SoraAudioSource::OnData(nb::ndarray<int16_t,
   if (!track_) {
     return;
   }
-  source_->OnData(ndarray.data(), ndarray.shape(0),
-                  (int64_t)(timestamp * 1000));
+  OnDataNative(ndarray.data(), ndarray.shape(0), (int64_t)(timestamp * 1000));
 }
 
 void SoraAudioSource::OnData(nb::ndarray<int16_t,
@@ -168,5 +234,200 @@ void SoraAudioSource::OnData(nb::ndarray<int16_t,
   if (!track_) {
     return;
   }
-  source_->OnData(ndarray.data(), ndarray.shape(0), absl::nullopt);
+  OnDataNative(ndarray.data(), ndarray.shape(0), absl::nullopt);
+}
+
+void SoraAudioSource::OnData(
+    nb::ndarray<nb::shape<nb::any, nb::any>, nb::c_contig, nb::device::cpu>
+        ndarray,
+    int sample_rate,
+    std::optional<double> timestamp) {
+  if (!track_) {
+    return;
+  }
+  bool is_float = ndarray.dtype() == nb::dtype<float>();
+  if (!is_float && ndarray.dtype() != nb::dtype<int16_t>()) {
+    throw nb::type_error("ndarray must be an int16 or float32 ndarray");
+  }
+  if (sample_rate == 0) {
+    sample_rate = sample_rate_;
+  }
+  if (sample_rate < 0) {
+    throw nb::value_error(
+        ("Invalid sample_rate: " + std::to_string(sample_rate)).c_str());
+  }
+  size_t channels = ndarray.shape(1);
+  // RemixFrame が扱えるのは 8 チャンネルまで
+  if (channels == 0 || channels > 8) {
+    throw nb::value_error(
+        ("Invalid channels: " + std::to_string(channels)).c_str());
+  }
+  size_t samples_per_channel = ndarray.shape(0);
+  // リサンプリングするとブロックに満たない分を持ち越すので、 timestamp はデータと対応しなくなる
+  absl::optional<int64_t> timestamp_ms;
+  if (timestamp && sample_rate == sample_rate_) {
+    timestamp_ms = (int64_t)(*timestamp * 1000);
+  }
+  if (!is_float && converter_.IsPassthrough(channels, sample_rate)) {
+    OnDataNative(static_cast<const int16_t*>(ndarray.data()),
+                 samples_per_channel, timestamp_ms);
+    return;
+  }
+
+  std::vector<int16_t> converted;
+  {
+    nb::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(convert_mtx_);
+    SoraLatencyTimer timer(convert_latency_);
+    if (is_float) {
+      converter_.Convert(static_cast<const float*>(ndarray.data()),
+                         samples_per_channel, channels, sample_rate, converted);
+    } else {
+      converter_.Convert(static_cast<const int16_t*>(ndarray.data()),
+                         samples_per_channel, channels, sample_rate, converted);
+    }
+  }
+  if (converted.empty()) {
+    return;
+  }
+  OnDataNative(converted.data(), converted.size() / channels_, timestamp_ms);
+}
+
+void SoraAudioSource::OnDataNative(const int16_t* data,
+                                   size_t samples_per_channel,
+                                   absl::optional<int64_t> timestamp) {
+  SoraLatencyTimer timer(on_data_latency_);
+  if (paced_) {
+    // 送る時刻は送信のスレッドが決めるので timestamp は使わない
+    Enqueue(data, samples_per_channel);
+    return;
+  }
+  // data は呼び出し元が保持しているので GIL を解放しても参照できる
+  nb::gil_scoped_release release;
+  source_->OnData(data, samples_per_channel, timestamp);
+}
+
+void SoraAudioSource::Enqueue(const int16_t* data, size_t samples_per_channel) {
+  size_t remaining = samples_per_channel * channels_;
+  std::unique_lock<std::mutex> lock(pending_mtx_);
+  while (remaining > 0 && !finished_) {
+    size_t written = pending_.Write(data, remaining);
+    data += written;
+    remaining -= written;
+    if (remaining == 0) {
+      break;
+    }
+    // バッファが一杯の場合は、送信が進んで空くまで GIL を解放して待つ
+    pending_cond_.notify_all();
+    WaitWithGilReleased(lock, pending_cond_, 1.0f, [this]() {
+      return pending_.available() > 0 || finished_;
+    });
+  }
+  lock.unlock();
+  pending_cond_.notify_all();
+}
+
+void SoraAudioSource::Flush() {
+  if (!paced_) {
+    return;
+  }
+  {
+    std::lock_guard<std::mutex> lock(pending_mtx_);
+    flush_ = true;
+  }
+  pending_cond_.notify_all();
+}
+
+void SoraAudioSource::PacingProcess() {
+  const size_t samples_per_channel = sample_rate_ / 100;
+  const size_t frame_size = samples_per_channel * channels_;
+  const std::chrono::milliseconds kFrameDuration(10);
+  // これ以上遅れた場合は、遅れを取り戻すためにまとめて送らずに今から数え直す
+  const std::chrono::milliseconds kMaxLateness(100);
+  // 10 ms に満たない場合に、続きのデータを待つ時間
+  const std::chrono::milliseconds kUnderrunTimeout(100);
+  std::vector<int16_t> frame(frame_size);
+  auto next = std::chrono::steady_clock::now();
+  bool waiting = true;
+  while (true) {
+    {
+      std::unique_lock<std::mutex> lock(pending_mtx_);
+      if (waiting) {
+        // データが無くなった後は、次のデータが来た時刻から数え始める
+        pending_cond_.wait(
+            lock, [this]() { return pending_.size() > 0 || finished_; });
+        next = std::chrono::steady_clock::now();
+        waiting = false;
+      } else {
+        pending_cond_.wait_until(lock, next, [this]() { return finished_; });
+      }
+      if (finished_) {
+        break;
+      }
+      if (pending_.size() == 0) {
+        // flush で送り切った後は、次のデータから 10 ms 分が揃うのを待つ
+        flush_ = false;
+      }
+      if (pending_.size() < frame_size && !flush_) {
+        // 少しずつ渡される場合に途中で無音を挟まないように、10 ms 分が揃うまで待つ
+        underrun_count_.Add();
+        pending_cond_.wait_for(lock, kUnderrunTimeout, [&]() {
+          return pending_.size() >= frame_size || finished_ || flush_;
+        });
+        if (finished_) {
+          break;
+        }
+        if (pending_.size() == 0) {
+          flush_ = false;
+          waiting = true;
+          continue;
+        }
+        // 待った分を取り戻そうとまとめて送らないように、今から数え直す
+        next = std::chrono::steady_clock::now();
+      }
+      // 10 ms に満たないまま待ちきれなかった場合や flush の場合だけ、無音で埋めて送る
+      size_t read = pending_.Read(frame.data(), frame_size);
+      std::fill(frame.begin() + read, frame.end(), 0);
+    }
+    pending_cond_.notify_all();
+
+    auto now = std::chrono::steady_clock::now();
+    pacing_lateness_.Record(now - next);
+    source_->OnData(frame.data(), samples_per_channel, absl::nullopt);
+    next += kFrameDuration;
+    if (now - next > kMaxLateness) {
+      next = now;
+    }
+  }
+
+  // 破棄する時は残っているデータを待たずに送り、最後の 10 ms に満たない分は無音で埋める
+  std::vector<int16_t> rest;
+  {
+    std::lock_guard<std::mutex> lock(pending_mtx_);
+    rest.resize(pending_.size());
+    pending_.Read(rest.data(), rest.size());
+  }
+  for (size_t offset = 0; offset < rest.size(); offset += frame_size) {
+    size_t size = std::min(frame_size, rest.size() - offset);
+    std::copy(rest.begin() + offset, rest.begin() + offset + size,
+              frame.begin());
+    std::fill(frame.begin() + size, frame.end(), 0);
+    source_->OnData(frame.data(), samples_per_channel, absl::nullopt);
+  }
+}
+
+nb::dict SoraAudioSource::GetMetrics() {
+  nb::dict metrics;
+  source_->AddMetrics(metrics);
+  metrics["on_data_latency"] = on_data_latency_.ToDict();
+  metrics["convert_latency"] = convert_latency_.ToDict();
+  if (paced_) {
+    {
+      std::lock_guard<std::mutex> lock(pending_mtx_);
+      metrics["buffered_frames"] = nb::cast(pending_.size() / channels_);
+    }
+    metrics["underrun_count"] = nb::cast(underrun_count_.Get());
+    metrics["pacing_lateness"] = pacing_lateness_.ToDict();
+  }
+  return metrics;
 }
\ No newline at end of file
@@ -1,10 +1,17 @@
 #ifndef SORA_AUDIO_SOURCE_H_
 #define SORA_AUDIO_SOURCE_H_
 
+#include <chrono>
+#include <condition_variable>
 #include <list>
+#include <memory>
+#include <mutex>
+#include <optional>
+#include <thread>
 
 // nonobind
 #include <nanobind/ndarray.h>
+#include <nanobind/stl/optional.h>
 
 // WebRTC
 #include <absl/types/optional.h>
@@ -14,6 +21,9 @@
 #include <api/scoped_refptr.h>
 #include <rtc_base/synchronization/mutex.h>
 
+#include "ring_buffer.h"
+#include "sora_audio_converter.h"
+#include "sora_metrics.h"
 #include "sora_track_interface.h"
 
 namespace nb = nanobind;
@@ -39,10 +49,13 @@ class SoraAudioSourceInterface
   void AddSink(webrtc::AudioTrackSinkInterface* sink) override;
   void RemoveSink(webrtc::AudioTrackSinkInterface* sink) override;
 
+  void AddMetrics(nb::dict& metrics);
+
  private:
   void Add10MsData(const int16_t* data, absl::optional<int64_t> timestamp);
 
   std::list<AudioObserver*> audio_observers_;
+  webrtc::Mutex data_lock_;
   webrtc::Mutex sink_lock_;
   std::list<webrtc::AudioTrackSinkInterface*> sinks_;
 
@@ -53,6 +66,10 @@ class SoraAudioSourceInterface
   size_t buffer_used_;
   int16_t* buffer_;
   int64_t last_timestamp_;
+  SoraCounter frames_in_;
+  SoraCounter frames_sent_;
+  SoraCounter dropped_frames_;
+  SoraLatencyHistogram deliver_latency_;
 };
 
 class SoraAudioSource : public SoraTrackInterface {
@@ -61,7 +78,13 @@ class SoraAudioSource : public SoraTrackInterface {
                   rtc::scoped_refptr<SoraAudioSourceInterface> source,
                   rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
                   size_t channels,
-                  int sample_rate);
+                  int sample_rate,
+                  bool paced,
+                  int max_buffer_ms);
+  ~SoraAudioSource();
+
+  void Disposed() override;
+  void PubliserDisposed() override;
 
   void OnData(const int16_t* data,
               size_t samples_per_channel,
@@ -76,9 +99,50 @@ class SoraAudioSource : public SoraTrackInterface {
                           nb::shape<nb::any, nb::any>,
                           nb::c_contig,
                           nb::device::cpu> ndarray);
+  // float32 か int16 の任意のサンプリングレート、チャンネル数のデータを変換して送る
+  // sample_rate が 0 の場合は Source のサンプリングレートとして扱う
+  void OnData(
+      nb::ndarray<nb::shape<nb::any, nb::any>, nb::c_contig, nb::device::cpu>
+          ndarray,
+      int sample_rate,
+      std::optional<double> timestamp);
+
+  // paced の場合に、バッファに残っている 10 ms に満たないデータを無音で埋めて送らせる
+  void Flush();
+
+  size_t channels() const { return channels_; }
+  nb::dict GetMetrics();
 
  private:
+  void OnDataNative(const int16_t* data,
+                    size_t samples_per_channel,
+                    absl::optional<int64_t> timestamp);
+  void Enqueue(const int16_t* data, size_t samples_per_channel);
+  void PacingProcess();
+
   rtc::scoped_refptr<SoraAudioSourceInterface> source_;
+  const size_t channels_;
+  const int sample_rate_;
+  SoraLatencyHistogram on_data_latency_;
+
+  // converter_ は GIL を解放して使うので、 GIL を解放している間だけ convert_mtx_ を取る
+  std::mutex convert_mtx_;
+  SoraAudioConverter converter_;
+  SoraLatencyHistogram convert_latency_;
+
+  // paced の場合は on_data で受け取ったデータを pending_ に貯め、
+  // thread_ から 10 ms ごとに実時間に合わせて送る
+  const bool paced_;
+  std::mutex pending_mtx_;
+  std::condition_variable pending_cond_;
+  RingBuffer<int16_t> pending_;
+  // Flush が呼ばれてから pending_ が空になるまでは、10 ms 分が揃うのを待たずに送る
+  bool flush_;
+  bool finished_;
+  std::unique_ptr<std::thread> thread_;
+  SoraCounter underrun_count_;
+  // 10 ms ごとの送信予定時刻からの遅れ
+  SoraLatencyHistogram pacing_lateness_;
 };
 
 #endif
\ No newline at end of file
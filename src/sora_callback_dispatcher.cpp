@@ -0,0 +1,111 @@
+#include "sora_callback_dispatcher.h"
+
+#include <algorithm>
+#include <iterator>
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+namespace nb = nanobind;
+
+SoraCallbackDispatcher::SoraCallbackDispatcher()
+    : state_(std::make_shared<State>()) {
+  thread_ = std::thread([state = state_]() { Run(state); });
+}
+
+SoraCallbackDispatcher::~SoraCallbackDispatcher() {
+  {
+    std::lock_guard<std::mutex> lock(state_->mtx);
+    state_->finished = true;
+  }
+  state_->cond.notify_all();
+  if (std::this_thread::get_id() == thread_.get_id()) {
+    // コールバックの中で最後の参照が外れた場合は自身を join できない
+    thread_.detach();
+    return;
+  }
+  // 実行中のコールバックが GIL を待っているかもしれないので解放してから待つ
+  if (PyGILState_Check()) {
+    nb::gil_scoped_release release;
+    thread_.join();
+  } else {
+    thread_.join();
+  }
+}
+
+void SoraCallbackDispatcher::Post(const void* owner,
+                                  std::function<void()> callback) {
+  {
+    std::lock_guard<std::mutex> lock(state_->mtx);
+    if (state_->finished) {
+      return;
+    }
+    state_->queue.emplace_back(owner, std::move(callback));
+  }
+  state_->cond.notify_all();
+}
+
+void SoraCallbackDispatcher::Cancel(const void* owner) {
+  // 取り除いたコールバックはロックの外で破棄する
+  std::deque<std::pair<const void*, std::function<void()>>> removed;
+  std::unique_lock<std::mutex> lock(state_->mtx);
+  auto& queue = state_->queue;
+  auto it = std::stable_partition(
+      queue.begin(), queue.end(),
+      [owner](const auto& item) { return item.first != owner; });
+  std::move(it, queue.end(), std::back_inserter(removed));
+  queue.erase(it, queue.end());
+  if (state_->running_owner != owner ||
+      std::this_thread::get_id() == thread_.get_id()) {
+    return;
+  }
+  lock.unlock();
+  // 実行中のコールバックが GIL を待っているかもしれないので解放してから待つ
+  auto wait = [&] {
+    std::unique_lock<std::mutex> wait_lock(state_->mtx);
+    state_->cond.wait(wait_lock,
+                      [&] { return state_->running_owner != owner; });
+  };
+  if (PyGILState_Check()) {
+    nb::gil_scoped_release release;
+    wait();
+  } else {
+    wait();
+  }
+}
+
+void SoraCallbackDispatcher::Run(std::shared_ptr<State> state) {
+  while (true) {
+    std::function<void()> callback;
+    {
+      std::unique_lock<std::mutex> lock(state->mtx);
+      state->cond.wait(
+          lock, [&] { return !state->queue.empty() || state->finished; });
+      if (state->finished) {
+        break;
+      }
+      state->running_owner = state->queue.front().first;
+      callback = std::move(state->queue.front().second);
+      state->queue.pop_front();
+    }
+    {
+      // Python 側でコールバックを差し替えるのと競合しないよう GIL を取ってから呼ぶ
+      nb::gil_scoped_acquire acquire;
+      try {
+        callback();
+      } catch (nb::python_error& e) {
+        e.restore();
+        PyErr_WriteUnraisable(nullptr);
+      }
+      callback = nullptr;
+    }
+    {
+      std::lock_guard<std::mutex> lock(state->mtx);
+      state->running_owner = nullptr;
+    }
+    state->cond.notify_all();
+  }
+  // 残ったコールバックはここで破棄する
+  std::lock_guard<std::mutex> lock(state->mtx);
+  state->queue.clear();
+}
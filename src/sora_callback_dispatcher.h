@@ -0,0 +1,43 @@
+#ifndef SORA_CALLBACK_DISPATCHER_H_
+#define SORA_CALLBACK_DISPATCHER_H_
+
+#include <condition_variable>
+#include <deque>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <thread>
+#include <utility>
+
+/*
+ * Python のコールバックを SDK が持つ 1 本のスレッドから呼び出す
+ * WebRTC のデコードや音声のスレッドはコールバックを積むだけで GIL を待たない
+ * コールバックは積んだ側のオブジェクト (owner) に紐付け、
+ * owner が破棄される前に Cancel で取り除く
+ */
+class SoraCallbackDispatcher {
+ public:
+  SoraCallbackDispatcher();
+  ~SoraCallbackDispatcher();
+
+  void Post(const void* owner, std::function<void()> callback);
+  // owner のコールバックを取り除き、実行中であれば終わるまで待つ
+  void Cancel(const void* owner);
+
+ private:
+  // コールバックの中で最後の参照が外れてもスレッドが参照できるように、
+  // スレッドと共有する状態は shared_ptr で持つ
+  struct State {
+    std::mutex mtx;
+    std::condition_variable cond;
+    std::deque<std::pair<const void*, std::function<void()>>> queue;
+    const void* running_owner = nullptr;
+    bool finished = false;
+  };
+  static void Run(std::shared_ptr<State> state);
+
+  std::shared_ptr<State> state_;
+  std::thread thread_;
+};
+
+#endif
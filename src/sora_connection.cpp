@@ -1,17 +1,115 @@
 #include "sora_connection.h"
 
 #include <chrono>
+#include <future>
+#include <stdexcept>
 
 // Boost
 #include <boost/asio/signal_set.hpp>
 
+// Boost
+#include <boost/json.hpp>
+
 // nonobind
 #include <nanobind/nanobind.h>
 
+// WebRTC
+#include <api/units/time_delta.h>
+
 namespace nb = nanobind;
 
-SoraConnection::SoraConnection(DisposePublisher* publisher)
-    : publisher_(publisher) {
+namespace {
+
+// GetStats の結果を受け取る、 WebRTC のシグナリングスレッドから呼ばれる
+class StatsCallback : public webrtc::RTCStatsCollectorCallback {
+ public:
+  StatsCallback(std::function<void(std::string)> on_stats)
+      : on_stats_(std::move(on_stats)) {}
+
+  void OnStatsDelivered(
+      const rtc::scoped_refptr<const webrtc::RTCStatsReport>& report) override {
+    on_stats_(report->ToJson());
+  }
+
+ private:
+  std::function<void(std::string)> on_stats_;
+};
+
+// コールバックが投げた例外を、他のコールバックや WebRTC のスレッドに伝えずに表示する
+// GIL を取った状態で呼ぶ
+template <class F>
+void CallAndReportError(F f) {
+  try {
+    f();
+  } catch (nb::python_error& e) {
+    e.restore();
+    PyErr_WriteUnraisable(nullptr);
+  } catch (const std::exception& e) {
+    PyErr_SetString(PyExc_RuntimeError, e.what());
+    PyErr_WriteUnraisable(nullptr);
+  }
+}
+
+// str に変換できる UTF-8 の文字列かどうか、 GIL を取った状態で呼ぶ
+bool IsValidUtf8(const std::string& data) {
+  PyObject* str = PyUnicode_DecodeUTF8(data.data(), data.size(), "strict");
+  if (str == nullptr) {
+    PyErr_Clear();
+    return false;
+  }
+  Py_DECREF(str);
+  return true;
+}
+
+// Sora::CovertJsonValue の逆で、 JSON を Python のオブジェクトに変換する
+// GIL を取った状態で呼ぶ
+nb::object ConvertJsonValue(const boost::json::value& value) {
+  switch (value.kind()) {
+    case boost::json::kind::null:
+      return nb::none();
+    case boost::json::kind::bool_:
+      return nb::cast(value.get_bool());
+    case boost::json::kind::int64:
+      return nb::cast(value.get_int64());
+    case boost::json::kind::uint64:
+      return nb::cast(value.get_uint64());
+    case boost::json::kind::double_:
+      return nb::cast(value.get_double());
+    case boost::json::kind::string:
+      return nb::str(value.get_string().data(), value.get_string().size());
+    case boost::json::kind::array: {
+      nb::list list;
+      for (const auto& v : value.get_array()) {
+        list.append(ConvertJsonValue(v));
+      }
+      return list;
+    }
+    case boost::json::kind::object: {
+      nb::dict dict;
+      for (const auto& [k, v] : value.get_object()) {
+        dict[nb::str(k.data(), k.size())] = ConvertJsonValue(v);
+      }
+      return dict;
+    }
+  }
+  return nb::none();
+}
+
+nb::list ConvertStatsJson(const std::string& json) {
+  boost::system::error_code ec;
+  boost::json::value value = boost::json::parse(json, ec);
+  if (ec || !value.is_array()) {
+    return nb::list();
+  }
+  return nb::borrow<nb::list>(ConvertJsonValue(value));
+}
+
+}  // namespace
+
+SoraConnection::SoraConnection(
+    DisposePublisher* publisher,
+    std::shared_ptr<SoraCallbackDispatcher> dispatcher)
+    : publisher_(publisher), dispatcher_(dispatcher) {
   publisher_->AddSubscriber(this);
 }
 
@@ -25,6 +123,10 @@ SoraConnection::~SoraConnection() {
 void SoraConnection::Disposed() {
   DisposePublisher::Disposed();
   Disconnect();
+  if (dispatcher_) {
+    // 切断した後なので、まだ呼ばれていないコールバックは捨てる
+    dispatcher_->Cancel(this);
+  }
   publisher_ = nullptr;
 }
 
@@ -32,25 +134,59 @@ void SoraConnection::PubliserDisposed() {
   Disposed();
 }
 
-void SoraConnection::Init(sora::SoraSignalingConfig& config) {
-  ioc_.reset(new boost::asio::io_context(1));
-  config.io_context = ioc_.get();
+void SoraConnection::Init(sora::SoraSignalingConfig& config,
+                          boost::asio::io_context* shared_ioc,
+                          rtc::Thread* signaling_thread) {
+  signaling_thread_ = signaling_thread;
+  if (shared_ioc) {
+    config.io_context = shared_ioc;
+  } else {
+    ioc_.reset(new boost::asio::io_context(1));
+    config.io_context = ioc_.get();
+  }
   conn_ = sora::SoraSignaling::Create(config);
 }
 
 void SoraConnection::Connect() {
+  {
+    std::lock_guard<std::mutex> lock(disconnect_mtx_);
+    connected_ = true;
+    disconnected_ = false;
+  }
   conn_->Connect();
 
-  thread_.reset(new std::thread([this]() { ioc_->run(); }));
+  if (ioc_) {
+    thread_.reset(new std::thread([this]() { ioc_->run(); }));
+  }
+
+  if (stats_interval_ > 0 && !stats_state_) {
+    // 統計情報は WebRTC のシグナリングスレッドで取得し、 Python のスレッドは使わない
+    stats_state_ = std::make_shared<StatsState>();
+    stats_state_->conn = this;
+    ScheduleStats(stats_state_, signaling_thread_,
+                  webrtc::TimeDelta::Millis((int64_t)(stats_interval_ * 1000)));
+  }
 }
 
 void SoraConnection::Disconnect() {
+  StopStats();
   if (thread_) {
     // Disconnect の中で OnDisconnect が呼ばれるので GIL をリリースする
     nb::gil_scoped_release release;
     conn_->Disconnect();
     thread_->join();
     thread_ = nullptr;
+  } else if (!ioc_ && conn_) {
+    std::unique_lock<std::mutex> lock(disconnect_mtx_);
+    if (connected_) {
+      lock.unlock();
+      // 共有している io_context のスレッドで OnDisconnect が呼ばれるので GIL をリリースする
+      nb::gil_scoped_release release;
+      conn_->Disconnect();
+      std::unique_lock<std::mutex> wait_lock(disconnect_mtx_);
+      disconnect_cond_.wait(wait_lock, [this] { return disconnected_; });
+      connected_ = false;
+    }
   }
   // Connection から生成したものは、ここで消す
   audio_sender_ = nullptr;
@@ -58,6 +194,111 @@ void SoraConnection::Disconnect() {
   conn_ = nullptr;
 }
 
+nb::list SoraConnection::GetStats() {
+  rtc::scoped_refptr<webrtc::PeerConnectionInterface> pc =
+      conn_ ? conn_->GetPeerConnection() : nullptr;
+  if (!pc) {
+    return nb::list();
+  }
+  // 結果はシグナリングスレッドから渡されるので、そのスレッドで呼ばれたコールバックの中で待つと終わらない
+  if (signaling_thread_ && signaling_thread_->IsCurrent()) {
+    throw std::runtime_error(
+        "get_stats cannot be called on the signaling thread, use on_stats or "
+        "Sora(use_callback_thread=True)");
+  }
+  std::string json;
+  {
+    // 結果はシグナリングスレッドから渡されるので、待つ間は GIL を解放する
+    nb::gil_scoped_release release;
+    std::promise<std::string> promise;
+    std::future<std::string> future = promise.get_future();
+    pc->GetStats(
+        rtc::make_ref_counted<StatsCallback>([&promise](std::string json) {
+          promise.set_value(std::move(json));
+        }).get());
+    json = future.get();
+  }
+  return ConvertStatsJson(json);
+}
+
+bool SoraConnection::SendData(const std::string& label, nb::handle data) {
+  // 別のスレッドから disconnect されても送信中は破棄されないように参照を持つ
+  std::shared_ptr<sora::SoraSignaling> conn = conn_;
+  if (!conn) {
+    return false;
+  }
+  // bytes に変換せずにバッファを直接参照する、連続していないバッファは BufferError になる
+  Py_buffer view;
+  if (PyObject_GetBuffer(data.ptr(), &view, PyBUF_SIMPLE) != 0) {
+    throw nb::python_error();
+  }
+  // GIL を取り直した後に解放する
+  std::unique_ptr<Py_buffer, decltype(&PyBuffer_Release)> view_guard(
+      &view, PyBuffer_Release);
+  // バッファは PyBuffer_Release まで解放されないので、GIL を解放しても参照できる
+  nb::gil_scoped_release release;
+  // Sora C++ SDK の送信は std::string を受け取るので、ここでの 1 回だけコピーする
+  return conn->SendDataChannel(
+      label, std::string(static_cast<const char*>(view.buf), view.len));
+}
+
+void SoraConnection::ScheduleStats(std::shared_ptr<StatsState> state,
+                                   rtc::Thread* thread,
+                                   webrtc::TimeDelta interval) {
+  thread->PostDelayedTask(
+      [state, thread, interval]() {
+        std::lock_guard<std::mutex> lock(state->mtx);
+        if (!state->conn) {
+          return;
+        }
+        rtc::scoped_refptr<webrtc::PeerConnectionInterface> pc =
+            state->conn->conn_ ? state->conn->conn_->GetPeerConnection()
+                               : nullptr;
+        if (pc) {
+          pc->GetStats(
+              rtc::make_ref_counted<StatsCallback>([state](std::string json) {
+                std::lock_guard<std::mutex> lock(state->mtx);
+                if (state->conn) {
+                  state->conn->DeliverStats(std::move(json));
+                }
+              }).get());
+        }
+        ScheduleStats(state, thread, interval);
+      },
+      interval);
+}
+
+void SoraConnection::StopStats() {
+  if (!stats_state_) {
+    return;
+  }
+  {
+    // 統計情報のコールバックが GIL を待ちながらロックを持っているかもしれないので解放してから取る
+    nb::gil_scoped_release release;
+    std::lock_guard<std::mutex> lock(stats_state_->mtx);
+    stats_state_->conn = nullptr;
+  }
+  stats_state_ = nullptr;
+}
+
+void SoraConnection::DeliverStats(std::string json) {
+  if (!on_stats_) {
+    return;
+  }
+  auto callback = [this, json]() {
+    if (on_stats_) {
+      on_stats_(ConvertStatsJson(json));
+    }
+  };
+  if (dispatcher_) {
+    dispatcher_->Post(this, std::move(callback));
+  } else {
+    // dict を作るので GIL を取ってから呼ぶ
+    nb::gil_scoped_acquire acquire;
+    callback();
+  }
+}
+
 void SoraConnection::SetAudioTrack(SoraTrackInterface* audio_source) {
   if (audio_sender_) {
     audio_sender_->SetTrack(audio_source->GetTrack().get());
@@ -98,53 +339,96 @@ void SoraConnection::OnSetOffer(std::string offer) {
       video_sender_ = video_result.value();
     }
   }
-  if (on_set_offer_) {
-    on_set_offer_(offer);
-  }
+  Dispatch([this, offer]() {
+    if (on_set_offer_) {
+      on_set_offer_(offer);
+    }
+  });
 }
 
 void SoraConnection::OnDisconnect(sora::SoraSignalingErrorCode ec,
                                   std::string message) {
-  ioc_->stop();
-  if (on_disconnect_) {
-    on_disconnect_(ec, message);
+  if (ioc_) {
+    ioc_->stop();
+  }
+  {
+    std::lock_guard<std::mutex> lock(disconnect_mtx_);
+    disconnected_ = true;
   }
+  disconnect_cond_.notify_all();
+  Dispatch([this, ec, message]() {
+    if (on_disconnect_) {
+      on_disconnect_(ec, message);
+    }
+  });
 }
 
 void SoraConnection::OnNotify(std::string text) {
-  if (on_set_offer_) {
-    on_set_offer_(text);
-  }
+  Dispatch([this, text]() {
+    if (on_notify_) {
+      on_notify_(text);
+    }
+  });
 }
 
 void SoraConnection::OnPush(std::string text) {
-  if (on_push_) {
-    on_push_(text);
-  }
+  Dispatch([this, text]() {
+    if (on_push_) {
+      on_push_(text);
+    }
+  });
 }
 
 void SoraConnection::OnMessage(std::string label, std::string data) {
-  if (on_message_) {
-    on_message_(label, data);
-  }
+  Dispatch([this, label, data]() {
+    // bytes を作るので GIL を取ってから呼ぶ
+    // 片方のコールバックが例外を投げても、もう片方は呼ぶ
+    nb::gil_scoped_acquire acquire;
+    // バイナリのメッセージは str にできない場合があるので、その場合は on_message_bytes だけに渡す
+    if (on_message_ && IsValidUtf8(data)) {
+      CallAndReportError([&]() { on_message_(label, data); });
+    }
+    if (on_message_bytes_) {
+      CallAndReportError([&]() {
+        on_message_bytes_(label, nb::bytes(data.data(), data.size()));
+      });
+    }
+  });
 }
 
 void SoraConnection::OnTrack(
     rtc::scoped_refptr<webrtc::RtpTransceiverInterface> transceiver) {
-  if (on_track_) {
-    // shared_ptr になってないのでリークする
-    auto track = std::make_shared<SoraTrackInterface>(
-        this, transceiver->receiver()->track());
-    AddSubscriber(track.get());
-    on_track_(track);
+  if (!on_track_) {
+    return;
   }
+  // shared_ptr になってないのでリークする
+  auto track = std::make_shared<SoraTrackInterface>(
+      this, transceiver->receiver()->track());
+  // この Track に繋いだ Sink のコールバックも同じ Dispatcher から呼ぶ
+  track->SetCallbackDispatcher(dispatcher_);
+  AddSubscriber(track.get());
+  Dispatch([this, track]() {
+    if (on_track_) {
+      on_track_(track);
+    }
+  });
 }
 
 void SoraConnection::OnRemoveTrack(
     rtc::scoped_refptr<webrtc::RtpReceiverInterface> receiver) {}
 
 void SoraConnection::OnDataChannel(std::string label) {
-  if (on_data_channel_) {
-    on_data_channel_(label);
+  Dispatch([this, label]() {
+    if (on_data_channel_) {
+      on_data_channel_(label);
+    }
+  });
+}
+
+void SoraConnection::Dispatch(std::function<void()> callback) {
+  if (dispatcher_) {
+    dispatcher_->Post(this, std::move(callback));
+  } else {
+    callback();
   }
 }
@@ -1,41 +1,56 @@
 #ifndef SORA_CONNECTION_H_
 #define SORA_CONNECTION_H_
 
+#include <condition_variable>
 #include <memory>
+#include <mutex>
 #include <thread>
 
 // nonobind
 #include <nanobind/nanobind.h>
 #include <nanobind/stl/shared_ptr.h>
 
+namespace nb = nanobind;
+
 // Boost
 #include <boost/asio/io_context.hpp>
 
 // WebRTC
 #include <api/media_stream_interface.h>
 #include <api/rtp_sender_interface.h>
+#include <api/stats/rtc_stats_collector_callback.h>
+#include <rtc_base/thread.h>
 
 // Sora
 #include <sora/sora_signaling.h>
 
 #include "dispose_listener.h"
+#include "sora_callback_dispatcher.h"
 #include "sora_track_interface.h"
 
 class SoraConnection : public sora::SoraSignalingObserver,
                        public DisposePublisher,
                        public DisposeSubscriber {
  public:
-  SoraConnection(DisposePublisher* publisher);
+  SoraConnection(DisposePublisher* publisher,
+                 std::shared_ptr<SoraCallbackDispatcher> dispatcher);
   ~SoraConnection();
 
   void Disposed() override;
   void PubliserDisposed() override;
 
-  void Init(sora::SoraSignalingConfig& config);
+  // io_context を渡した場合はそれを共有し、渡さない場合は接続ごとに作る
+  void Init(sora::SoraSignalingConfig& config,
+            boost::asio::io_context* shared_ioc,
+            rtc::Thread* signaling_thread);
   void Connect();
   void Disconnect();
   void SetAudioTrack(SoraTrackInterface* audio_source);
   void SetVideoTrack(SoraTrackInterface* video_source);
+  // PeerConnection の統計情報を RTCStats の dict の list で返す
+  nb::list GetStats();
+  // バッファプロトコルに対応したオブジェクトをそのまま DataChannel で送る
+  bool SendData(const std::string& label, nb::handle data);
 
   // sora::SoraSignalingObserver
   void OnSetOffer(std::string offer) override;
@@ -54,15 +69,45 @@ class SoraConnection : public sora::SoraSignalingObserver,
   std::function<void(sora::SoraSignalingErrorCode, std::string)> on_disconnect_;
   std::function<void(std::string)> on_notify_;
   std::function<void(std::string)> on_push_;
+  // UTF-8 として正しくないメッセージでは呼ばれない
   std::function<void(std::string, std::string)> on_message_;
+  // on_message と同じメッセージをデコードせずに bytes で渡す、 on_message とは独立して呼ばれる
+  std::function<void(std::string, nb::bytes)> on_message_bytes_;
   std::function<void(std::shared_ptr<SoraTrackInterface>)> on_track_;
   std::function<void(std::string)> on_data_channel_;
+  std::function<void(nb::list)> on_stats_;
+  // on_stats を呼ぶ間隔の秒数、 0 の場合は呼ばない。 connect の前に設定する
+  double stats_interval_ = 0;
 
  private:
+  // 定期的な統計情報の取得と切断の間で共有する状態
+  // 切断後は conn を nullptr にし、WebRTC のシグナリングスレッドに残ったタスクは何もしない
+  struct StatsState {
+    std::mutex mtx;
+    SoraConnection* conn = nullptr;
+  };
+  static void ScheduleStats(std::shared_ptr<StatsState> state,
+                            rtc::Thread* thread,
+                            webrtc::TimeDelta interval);
+  void StopStats();
+  void DeliverStats(std::string json);
+
+  // Dispatcher があればコールバックをそのスレッドで呼び、なければその場で呼ぶ
+  void Dispatch(std::function<void()> callback);
+
   DisposePublisher* publisher_;
+  std::shared_ptr<SoraCallbackDispatcher> dispatcher_;
   std::unique_ptr<boost::asio::io_context> ioc_;
   std::shared_ptr<sora::SoraSignaling> conn_;
   std::unique_ptr<std::thread> thread_;
+  // io_context を共有している場合は thread_ を join できないので、
+  // OnDisconnect が呼ばれたことを待つ
+  std::mutex disconnect_mtx_;
+  std::condition_variable disconnect_cond_;
+  bool connected_ = false;
+  bool disconnected_ = false;
+  rtc::Thread* signaling_thread_ = nullptr;
+  std::shared_ptr<StatsState> stats_state_;
   SoraTrackInterface* audio_source_;
   SoraTrackInterface* video_source_;
   rtc::scoped_refptr<webrtc::RtpSenderInterface> audio_sender_;
@@ -0,0 +1,41 @@
+#include "sora_io_context_pool.h"
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+namespace nb = nanobind;
+
+SoraIoContextPool::SoraIoContextPool(size_t num_threads) : next_(0) {
+  for (size_t i = 0; i < num_threads; i++) {
+    io_contexts_.push_back(std::make_unique<boost::asio::io_context>(1));
+    // 接続がない間も run が終わらないようにする
+    work_guards_.push_back(std::make_unique<WorkGuard>(
+        boost::asio::make_work_guard(*io_contexts_.back())));
+  }
+  for (auto& ioc : io_contexts_) {
+    threads_.emplace_back([ioc = ioc.get()]() { ioc->run(); });
+  }
+}
+
+SoraIoContextPool::~SoraIoContextPool() {
+  work_guards_.clear();
+  for (auto& ioc : io_contexts_) {
+    ioc->stop();
+  }
+  auto join = [this]() {
+    for (auto& thread : threads_) {
+      thread.join();
+    }
+  };
+  // 実行中のハンドラが GIL を待っているかもしれないので解放してから待つ
+  if (PyGILState_Check()) {
+    nb::gil_scoped_release release;
+    join();
+  } else {
+    join();
+  }
+}
+
+boost::asio::io_context* SoraIoContextPool::Next() {
+  return io_contexts_[next_++ % io_contexts_.size()].get();
+}
@@ -0,0 +1,38 @@
+#ifndef SORA_IO_CONTEXT_POOL_H_
+#define SORA_IO_CONTEXT_POOL_H_
+
+#include <atomic>
+#include <memory>
+#include <thread>
+#include <vector>
+
+// Boost
+#include <boost/asio/executor_work_guard.hpp>
+#include <boost/asio/io_context.hpp>
+
+/*
+ * 複数の SoraConnection でシグナリング用の io_context を共有するためのプール
+ * io_context ごとに 1 本のスレッドで run するので、
+ * 1 つの接続のハンドラが複数のスレッドで同時に実行されることはない
+ * 接続数が増えてもスレッド数は num_threads から増えない
+ */
+class SoraIoContextPool {
+ public:
+  SoraIoContextPool(size_t num_threads);
+  ~SoraIoContextPool();
+
+  // 接続に割り当てる io_context を順番に返す
+  boost::asio::io_context* Next();
+  size_t size() const { return io_contexts_.size(); }
+
+ private:
+  using WorkGuard =
+      boost::asio::executor_work_guard<boost::asio::io_context::executor_type>;
+
+  std::vector<std::unique_ptr<boost::asio::io_context>> io_contexts_;
+  std::vector<std::unique_ptr<WorkGuard>> work_guards_;
+  std::vector<std::thread> threads_;
+  std::atomic<size_t> next_;
+};
+
+#endif
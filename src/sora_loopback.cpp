@@ -0,0 +1,364 @@
+#include "sora_loopback.h"
+
+#include <algorithm>
+
+// WebRTC
+#include <api/audio_codecs/builtin_audio_decoder_factory.h>
+#include <api/audio_codecs/builtin_audio_encoder_factory.h>
+#include <api/video/video_bitrate_allocation.h>
+#include <api/video_codecs/builtin_video_decoder_factory.h>
+#include <api/video_codecs/builtin_video_encoder_factory.h>
+#include <api/video_codecs/video_codec.h>
+#include <modules/video_coding/include/video_codec_interface.h>
+#include <modules/video_coding/include/video_error_codes.h>
+
+namespace {
+
+// RTP の映像のタイムスタンプは 90kHz
+constexpr int64_t kMsToRtpTimestamp = 90;
+// 入力の音声を揃えるサンプリングレート、 Opus は 48000 Hz でエンコードする
+constexpr int kOpusSampleRate = 48000;
+// Opus の 1 パケットの最大の長さは 120 ms
+constexpr size_t kMaxOpusFrameSamples = kOpusSampleRate * 120 / 1000;
+constexpr int kOpusPayloadType = 111;
+
+// 入力の Track を外している間に Sink のコールバックが GIL を待っているとデッドロックするので、
+// GIL を持っている場合は解放してから呼ぶ
+template <class F>
+void WithoutGil(F f) {
+  if (PyGILState_Check()) {
+    nb::gil_scoped_release release;
+    f();
+  } else {
+    f();
+  }
+}
+
+}  // namespace
+
+SoraVideoLoopback::SoraVideoLoopback(
+    SoraTrackInterface* input,
+    rtc::scoped_refptr<sora::ScalableVideoTrackSource> source,
+    rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
+    const std::string& codec_type,
+    int bit_rate)
+    : SoraTrackInterface(input, track),
+      input_(input),
+      source_(source),
+      codec_type_(codec_type),
+      bit_rate_(bit_rate),
+      width_(0),
+      height_(0),
+      need_key_frame_(true),
+      timestamp_us_(0) {
+  publisher_->AddSubscriber(this);
+  if (source_) {
+    webrtc::VideoTrackInterface* video_track =
+        static_cast<webrtc::VideoTrackInterface*>(input_->GetTrack().get());
+    video_track->AddOrUpdateSink(this, rtc::VideoSinkWants());
+  }
+}
+
+SoraVideoLoopback::~SoraVideoLoopback() {
+  // Disposed で publisher_ が消えるので、先に入力の Track から外す
+  if (publisher_) {
+    publisher_->RemoveSubscriber(this);
+  }
+  Disposed();
+}
+
+void SoraVideoLoopback::Disposed() {
+  if (input_ && source_ && input_->GetTrack()) {
+    webrtc::VideoTrackInterface* video_track =
+        static_cast<webrtc::VideoTrackInterface*>(input_->GetTrack().get());
+    // RemoveSink から戻った後は OnFrame が呼ばれることはない
+    WithoutGil([this, video_track]() { video_track->RemoveSink(this); });
+  }
+  input_ = nullptr;
+  SoraTrackInterface::Disposed();
+}
+
+void SoraVideoLoopback::PubliserDisposed() {
+  Disposed();
+}
+
+bool SoraVideoLoopback::InitCodec(int width, int height) {
+  webrtc::VideoCodecType codec_type =
+      webrtc::PayloadStringToCodecType(codec_type_);
+  webrtc::SdpVideoFormat format(codec_type_);
+  encoder_ =
+      webrtc::CreateBuiltinVideoEncoderFactory()->CreateVideoEncoder(format);
+  decoder_ =
+      webrtc::CreateBuiltinVideoDecoderFactory()->CreateVideoDecoder(format);
+  if (!encoder_ || !decoder_) {
+    encoder_ = nullptr;
+    decoder_ = nullptr;
+    return false;
+  }
+
+  webrtc::VideoCodec codec;
+  codec.codecType = codec_type;
+  codec.width = width;
+  codec.height = height;
+  codec.startBitrate = bit_rate_;
+  codec.maxBitrate = bit_rate_;
+  codec.minBitrate = std::min(bit_rate_, 30);
+  codec.maxFramerate = 30;
+  codec.qpMax = 56;
+  codec.numberOfSimulcastStreams = 1;
+  codec.simulcastStream[0].width = width;
+  codec.simulcastStream[0].height = height;
+  codec.simulcastStream[0].maxBitrate = bit_rate_;
+  codec.simulcastStream[0].targetBitrate = bit_rate_;
+  codec.simulcastStream[0].minBitrate = codec.minBitrate;
+  codec.simulcastStream[0].maxFramerate = 30;
+  codec.simulcastStream[0].numberOfTemporalLayers = 1;
+  codec.simulcastStream[0].qpMax = codec.qpMax;
+  codec.simulcastStream[0].active = true;
+  if (codec_type == webrtc::kVideoCodecVP8) {
+    *codec.VP8() = webrtc::VideoEncoder::GetDefaultVp8Settings();
+  } else if (codec_type == webrtc::kVideoCodecVP9) {
+    *codec.VP9() = webrtc::VideoEncoder::GetDefaultVp9Settings();
+  } else if (codec_type == webrtc::kVideoCodecH264) {
+    *codec.H264() = webrtc::VideoEncoder::GetDefaultH264Settings();
+  }
+  webrtc::VideoEncoder::Settings settings(
+      webrtc::VideoEncoder::Capabilities(false), 1, 1200);
+  if (encoder_->InitEncode(&codec, settings) != WEBRTC_VIDEO_CODEC_OK) {
+    encoder_ = nullptr;
+    decoder_ = nullptr;
+    return false;
+  }
+  encoder_->RegisterEncodeCompleteCallback(this);
+  webrtc::VideoBitrateAllocation allocation;
+  allocation.SetBitrate(0, 0, bit_rate_ * 1000);
+  encoder_->SetRates(
+      webrtc::VideoEncoder::RateControlParameters(allocation, 30));
+
+  webrtc::VideoDecoder::Settings decoder_settings;
+  decoder_settings.set_codec_type(codec_type);
+  decoder_settings.set_max_render_resolution({width, height});
+  decoder_settings.set_number_of_cores(1);
+  if (!decoder_->Configure(decoder_settings)) {
+    encoder_->Release();
+    encoder_ = nullptr;
+    decoder_ = nullptr;
+    return false;
+  }
+  decoder_->RegisterDecodeCompleteCallback(this);
+
+  width_ = width;
+  height_ = height;
+  need_key_frame_ = true;
+  return true;
+}
+
+void SoraVideoLoopback::OnFrame(const webrtc::VideoFrame& frame) {
+  frames_in_.Add();
+  if (frame.width() != width_ || frame.height() != height_ || !encoder_) {
+    // 解像度が変わった場合はエンコーダーとデコーダーを作り直す
+    if (encoder_) {
+      encoder_->Release();
+      decoder_->Release();
+    }
+    if (!InitCodec(frame.width(), frame.height())) {
+      codec_errors_.Add();
+      return;
+    }
+  }
+
+  // ScalableVideoTrackSource を通るとタイムスタンプは timestamp_us だけになるので、
+  // 送信時と同じように RTP のタイムスタンプを付け直す
+  webrtc::VideoFrame input =
+      webrtc::VideoFrame::Builder()
+          .set_video_frame_buffer(frame.video_frame_buffer())
+          .set_timestamp_us(frame.timestamp_us())
+          .set_timestamp_rtp(
+              (uint32_t)(kMsToRtpTimestamp * frame.timestamp_us() / 1000))
+          .set_rotation(frame.rotation())
+          .build();
+  std::vector<webrtc::VideoFrameType> frame_types{
+      need_key_frame_ ? webrtc::VideoFrameType::kVideoFrameKey
+                      : webrtc::VideoFrameType::kVideoFrameDelta};
+  need_key_frame_ = false;
+  // 組み込みのエンコーダーとデコーダーは同期で処理するので、
+  // Encode から戻るまでに OnEncodedImage と Decoded が呼ばれる
+  timestamp_us_ = frame.timestamp_us();
+  int32_t result;
+  {
+    SoraLatencyTimer timer(encode_latency_);
+    result = encoder_->Encode(input, &frame_types);
+  }
+  if (result != WEBRTC_VIDEO_CODEC_OK) {
+    codec_errors_.Add();
+    need_key_frame_ = true;
+  }
+}
+
+webrtc::EncodedImageCallback::Result SoraVideoLoopback::OnEncodedImage(
+    const webrtc::EncodedImage& encoded_image,
+    const webrtc::CodecSpecificInfo* codec_specific_info) {
+  encoded_bytes_.Add(encoded_image.size());
+  int32_t result;
+  {
+    SoraLatencyTimer timer(decode_latency_);
+    result = decoder_->Decode(encoded_image, false, timestamp_us_ / 1000);
+  }
+  if (result != WEBRTC_VIDEO_CODEC_OK) {
+    codec_errors_.Add();
+    need_key_frame_ = true;
+  }
+  return webrtc::EncodedImageCallback::Result(
+      webrtc::EncodedImageCallback::Result::OK);
+}
+
+int32_t SoraVideoLoopback::Decoded(webrtc::VideoFrame& decoded_image) {
+  frames_out_.Add();
+  // デコーダーはタイムスタンプを RTP のものしか残さないので、入力のものに戻して渡す
+  source_->OnCapturedFrame(
+      webrtc::VideoFrame::Builder()
+          .set_video_frame_buffer(decoded_image.video_frame_buffer())
+          .set_timestamp_us(timestamp_us_)
+          .set_rotation(decoded_image.rotation())
+          .build());
+  return WEBRTC_VIDEO_CODEC_OK;
+}
+
+nb::dict SoraVideoLoopback::GetMetrics() {
+  nb::dict metrics;
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_out"] = nb::cast(frames_out_.Get());
+  metrics["encoded_bytes"] = nb::cast(encoded_bytes_.Get());
+  metrics["codec_errors"] = nb::cast(codec_errors_.Get());
+  metrics["encode_latency"] = encode_latency_.ToDict();
+  metrics["decode_latency"] = decode_latency_.ToDict();
+  return metrics;
+}
+
+SoraAudioLoopback::SoraAudioLoopback(
+    SoraTrackInterface* input,
+    rtc::scoped_refptr<SoraAudioSourceInterface> source,
+    rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
+    const std::string& codec_type,
+    size_t channels,
+    int bit_rate)
+    : SoraTrackInterface(input, track),
+      input_(input),
+      source_(source),
+      channels_(channels),
+      rtp_timestamp_(0) {
+  if (source_) {
+    webrtc::SdpAudioFormat format(
+        "opus", kOpusSampleRate, 2,
+        {{"stereo", channels_ == 2 ? "1" : "0"},
+         {"maxaveragebitrate", std::to_string(bit_rate * 1000)}});
+    encoder_ = webrtc::CreateBuiltinAudioEncoderFactory()->MakeAudioEncoder(
+        kOpusPayloadType, format, absl::nullopt);
+    decoder_ = webrtc::CreateBuiltinAudioDecoderFactory()->MakeAudioDecoder(
+        format, absl::nullopt);
+    if (!encoder_ || !decoder_) {
+      throw nb::value_error(("Unsupported codec_type: " + codec_type).c_str());
+    }
+    resampled_.resize(kOpusSampleRate / 100 * channels_);
+    decoded_.resize(kMaxOpusFrameSamples * channels_);
+  }
+  publisher_->AddSubscriber(this);
+  if (source_) {
+    webrtc::AudioTrackInterface* audio_track =
+        static_cast<webrtc::AudioTrackInterface*>(input_->GetTrack().get());
+    audio_track->AddSink(this);
+  }
+}
+
+SoraAudioLoopback::~SoraAudioLoopback() {
+  // Disposed で publisher_ が消えるので、先に入力の Track から外す
+  if (publisher_) {
+    publisher_->RemoveSubscriber(this);
+  }
+  Disposed();
+}
+
+void SoraAudioLoopback::Disposed() {
+  if (input_ && source_ && input_->GetTrack()) {
+    webrtc::AudioTrackInterface* audio_track =
+        static_cast<webrtc::AudioTrackInterface*>(input_->GetTrack().get());
+    // RemoveSink から戻った後は OnData が呼ばれることはない
+    WithoutGil([this, audio_track]() { audio_track->RemoveSink(this); });
+  }
+  input_ = nullptr;
+  SoraTrackInterface::Disposed();
+}
+
+void SoraAudioLoopback::PubliserDisposed() {
+  Disposed();
+}
+
+void SoraAudioLoopback::OnData(
+    const void* audio_data,
+    int bits_per_sample,
+    int sample_rate,
+    size_t number_of_channels,
+    size_t number_of_frames,
+    absl::optional<int64_t> absolute_capture_timestamp_ms) {
+  frames_in_.Add(number_of_frames);
+  if (number_of_channels != channels_) {
+    codec_errors_.Add();
+    return;
+  }
+  // SoraAudioSourceInterface から 10 ms ごとに呼ばれるので、 48000 Hz に揃えてからエンコードする
+  const int16_t* data = static_cast<const int16_t*>(audio_data);
+  if (sample_rate != kOpusSampleRate) {
+    int samples = resampler_.Resample10Msec(
+        data, sample_rate, kOpusSampleRate, number_of_channels,
+        resampled_.size(), resampled_.data());
+    if (samples < 0) {
+      codec_errors_.Add();
+      return;
+    }
+    data = resampled_.data();
+  }
+
+  webrtc::AudioEncoder::EncodedInfo info;
+  {
+    SoraLatencyTimer timer(encode_latency_);
+    info = encoder_->Encode(
+        rtp_timestamp_,
+        rtc::ArrayView<const int16_t>(data, kOpusSampleRate / 100 * channels_),
+        &encoded_);
+  }
+  rtp_timestamp_ += kOpusSampleRate / 100;
+  // Opus は 20 ms ごとにパケットを作るので、エンコードされなかった場合は次を待つ
+  if (info.encoded_bytes == 0) {
+    return;
+  }
+  encoded_bytes_.Add(info.encoded_bytes);
+
+  int decoded_samples;
+  {
+    SoraLatencyTimer timer(decode_latency_);
+    webrtc::AudioDecoder::SpeechType speech_type;
+    decoded_samples = decoder_->Decode(
+        encoded_.data(), encoded_.size(), kOpusSampleRate,
+        decoded_.size() * sizeof(int16_t), decoded_.data(), &speech_type);
+  }
+  encoded_.Clear();
+  if (decoded_samples <= 0) {
+    codec_errors_.Add();
+    return;
+  }
+  size_t samples_per_channel = decoded_samples / channels_;
+  frames_out_.Add(samples_per_channel);
+  // 出力の Source が 10 ms ごとに分けて、この Track に繋いだ Sink に渡す
+  source_->OnData(decoded_.data(), samples_per_channel, absl::nullopt);
+}
+
+nb::dict SoraAudioLoopback::GetMetrics() {
+  nb::dict metrics;
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_out"] = nb::cast(frames_out_.Get());
+  metrics["encoded_bytes"] = nb::cast(encoded_bytes_.Get());
+  metrics["codec_errors"] = nb::cast(codec_errors_.Get());
+  metrics["encode_latency"] = encode_latency_.ToDict();
+  metrics["decode_latency"] = decode_latency_.ToDict();
+  return metrics;
+}
@@ -0,0 +1,136 @@
+#ifndef SORA_LOOPBACK_H_
+#define SORA_LOOPBACK_H_
+
+#include <cstdint>
+#include <memory>
+#include <string>
+#include <vector>
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+// WebRTC
+#include <api/audio_codecs/audio_decoder.h>
+#include <api/audio_codecs/audio_encoder.h>
+#include <api/media_stream_interface.h>
+#include <api/scoped_refptr.h>
+#include <api/video/video_frame.h>
+#include <api/video/video_sink_interface.h>
+#include <api/video_codecs/video_decoder.h>
+#include <api/video_codecs/video_encoder.h>
+#include <modules/audio_coding/acm2/acm_resampler.h>
+#include <rtc_base/buffer.h>
+
+// Sora
+#include <sora/scalable_track_source.h>
+
+#include "sora_audio_source.h"
+#include "sora_metrics.h"
+#include "sora_track_interface.h"
+
+namespace nb = nanobind;
+
+/*
+ * Sora を経由せずに、ローカルの SoraVideoSource の映像を Sink に渡す Track
+ * codec_type を指定した場合は、送信と同じようにエンコードしてからデコードしたフレームを渡す
+ * codec_type が空の場合は入力の Track をそのまま使うので、変換は行わない
+ */
+class SoraVideoLoopback : public SoraTrackInterface,
+                          public rtc::VideoSinkInterface<webrtc::VideoFrame>,
+                          public webrtc::EncodedImageCallback,
+                          public webrtc::DecodedImageCallback {
+ public:
+  SoraVideoLoopback(SoraTrackInterface* input,
+                    rtc::scoped_refptr<sora::ScalableVideoTrackSource> source,
+                    rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
+                    const std::string& codec_type,
+                    int bit_rate);
+  ~SoraVideoLoopback();
+
+  void Disposed() override;
+  void PubliserDisposed() override;
+
+  nb::dict GetMetrics();
+
+  // rtc::VideoSinkInterface
+  void OnFrame(const webrtc::VideoFrame& frame) override;
+
+  // webrtc::EncodedImageCallback
+  webrtc::EncodedImageCallback::Result OnEncodedImage(
+      const webrtc::EncodedImage& encoded_image,
+      const webrtc::CodecSpecificInfo* codec_specific_info) override;
+
+  // webrtc::DecodedImageCallback
+  int32_t Decoded(webrtc::VideoFrame& decoded_image) override;
+
+ private:
+  bool InitCodec(int width, int height);
+
+  SoraTrackInterface* input_;
+  rtc::scoped_refptr<sora::ScalableVideoTrackSource> source_;
+  const std::string codec_type_;
+  const int bit_rate_;
+  std::unique_ptr<webrtc::VideoEncoder> encoder_;
+  std::unique_ptr<webrtc::VideoDecoder> decoder_;
+  int width_;
+  int height_;
+  bool need_key_frame_;
+  // エンコード中のフレームの timestamp_us 、デコードしたフレームに付け直す
+  int64_t timestamp_us_;
+  SoraCounter frames_in_;
+  SoraCounter frames_out_;
+  SoraCounter encoded_bytes_;
+  SoraCounter codec_errors_;
+  SoraLatencyHistogram encode_latency_;
+  SoraLatencyHistogram decode_latency_;
+};
+
+/*
+ * Sora を経由せずに、ローカルの SoraAudioSource の音声を Sink に渡す Track
+ * codec_type に OPUS を指定した場合は、エンコードしてからデコードした音声を 48000 Hz で渡す
+ * codec_type が空の場合は入力の Track をそのまま使うので、変換は行わない
+ */
+class SoraAudioLoopback : public SoraTrackInterface,
+                          public webrtc::AudioTrackSinkInterface {
+ public:
+  SoraAudioLoopback(SoraTrackInterface* input,
+                    rtc::scoped_refptr<SoraAudioSourceInterface> source,
+                    rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
+                    const std::string& codec_type,
+                    size_t channels,
+                    int bit_rate);
+  ~SoraAudioLoopback();
+
+  void Disposed() override;
+  void PubliserDisposed() override;
+
+  nb::dict GetMetrics();
+
+  // webrtc::AudioTrackSinkInterface
+  void OnData(const void* audio_data,
+              int bits_per_sample,
+              int sample_rate,
+              size_t number_of_channels,
+              size_t number_of_frames,
+              absl::optional<int64_t> absolute_capture_timestamp_ms) override;
+
+ private:
+  SoraTrackInterface* input_;
+  rtc::scoped_refptr<SoraAudioSourceInterface> source_;
+  const size_t channels_;
+  std::unique_ptr<webrtc::AudioEncoder> encoder_;
+  std::unique_ptr<webrtc::AudioDecoder> decoder_;
+  webrtc::acm2::ACMResampler resampler_;
+  std::vector<int16_t> resampled_;
+  std::vector<int16_t> decoded_;
+  rtc::Buffer encoded_;
+  uint32_t rtp_timestamp_;
+  SoraCounter frames_in_;
+  SoraCounter frames_out_;
+  SoraCounter encoded_bytes_;
+  SoraCounter codec_errors_;
+  SoraLatencyHistogram encode_latency_;
+  SoraLatencyHistogram decode_latency_;
+};
+
+#endif
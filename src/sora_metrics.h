@@ -0,0 +1,91 @@
+#ifndef SORA_METRICS_H_
+#define SORA_METRICS_H_
+
+#include <array>
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+namespace nb = nanobind;
+
+/*
+ * 処理時間をマイクロ秒で記録するヒストグラム
+ * バケットは 2 のべき乗ごとに区切り、i 番目のバケットは 2^i マイクロ秒未満の値を数える
+ * 最後のバケットはそれ以上の値も数える
+ * メディアのスレッドから呼ばれるのでロックは使わず、全て atomic で記録する
+ */
+class SoraLatencyHistogram {
+ public:
+  static constexpr size_t kNumBuckets = 32;
+
+  void Record(std::chrono::steady_clock::duration duration) {
+    int64_t us =
+        std::chrono::duration_cast<std::chrono::microseconds>(duration).count();
+    RecordMicros(us < 0 ? 0 : (uint64_t)us);
+  }
+
+  void RecordMicros(uint64_t us) {
+    size_t index = 0;
+    while (index < kNumBuckets - 1 && (us >> index) != 0) {
+      index++;
+    }
+    buckets_[index].fetch_add(1, std::memory_order_relaxed);
+    count_.fetch_add(1, std::memory_order_relaxed);
+    sum_us_.fetch_add(us, std::memory_order_relaxed);
+    uint64_t max = max_us_.load(std::memory_order_relaxed);
+    while (us > max &&
+           !max_us_.compare_exchange_weak(max, us, std::memory_order_relaxed)) {
+    }
+  }
+
+  // Prometheus の histogram に合わせて、バケットは上限 (le) ごとの累積値で返す
+  nb::dict ToDict() const {
+    nb::dict buckets;
+    uint64_t cumulative = 0;
+    for (size_t i = 0; i < kNumBuckets; i++) {
+      cumulative += buckets_[i].load(std::memory_order_relaxed);
+      buckets[nb::cast((uint64_t)1 << i)] = nb::cast(cumulative);
+    }
+    nb::dict dict;
+    dict["count"] = nb::cast(count_.load(std::memory_order_relaxed));
+    dict["sum_us"] = nb::cast(sum_us_.load(std::memory_order_relaxed));
+    dict["max_us"] = nb::cast(max_us_.load(std::memory_order_relaxed));
+    dict["buckets"] = buckets;
+    return dict;
+  }
+
+ private:
+  std::array<std::atomic<uint64_t>, kNumBuckets> buckets_{};
+  std::atomic<uint64_t> count_{0};
+  std::atomic<uint64_t> sum_us_{0};
+  std::atomic<uint64_t> max_us_{0};
+};
+
+// スコープを抜けるまでの時間を SoraLatencyHistogram に記録する
+class SoraLatencyTimer {
+ public:
+  explicit SoraLatencyTimer(SoraLatencyHistogram& histogram)
+      : histogram_(histogram), start_(std::chrono::steady_clock::now()) {}
+  ~SoraLatencyTimer() {
+    histogram_.Record(std::chrono::steady_clock::now() - start_);
+  }
+
+ private:
+  SoraLatencyHistogram& histogram_;
+  const std::chrono::steady_clock::time_point start_;
+};
+
+// カウンター、メディアのスレッドから更新して Python のスレッドから読む
+class SoraCounter {
+ public:
+  void Add(uint64_t n = 1) { value_.fetch_add(n, std::memory_order_relaxed); }
+  uint64_t Get() const { return value_.load(std::memory_order_relaxed); }
+
+ private:
+  std::atomic<uint64_t> value_{0};
+};
+
+#endif
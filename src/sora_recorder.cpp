@@ -0,0 +1,457 @@
+#include "sora_recorder.h"
+
+#include <algorithm>
+#include <cmath>
+#include <cstring>
+#include <numeric>
+#include <stdexcept>
+
+// WebRTC
+#include <api/audio/channel_layout.h>
+#include <modules/audio_mixer/audio_frame_manipulator.h>
+#include <rtc_base/byte_io.h>
+
+namespace {
+
+// 書き込みのシステムコールの回数を減らすため、ファイルへは 1 MiB ずつまとめて書く
+constexpr size_t kWriteBufferSize = 1024 * 1024;
+constexpr size_t kWavHeaderSize = 44;
+// 一度もデータを受け取らずに閉じた場合のヘッダーのフォーマット
+constexpr int kDefaultSampleRate = 48000;
+constexpr size_t kDefaultChannels = 1;
+
+// 書き込みのスレッドは GIL を使わないが、書き終えるまで他の Python のスレッドを止めないように、
+// GIL を持っている場合は解放してから呼ぶ
+template <class F>
+void WithoutGil(F f) {
+  if (PyGILState_Check()) {
+    nb::gil_scoped_release release;
+    f();
+  } else {
+    f();
+  }
+}
+
+}  // namespace
+
+SoraFileWriter::SoraFileWriter(const std::string& path, size_t buffer_size)
+    : file_(nullptr),
+      buffer_(new char[buffer_size]),
+      bytes_written_(0),
+      failed_(false) {
+  file_ = std::fopen(path.c_str(), "wb");
+  if (file_ == nullptr) {
+    throw std::runtime_error("Failed to open file: " + path);
+  }
+  std::setvbuf(file_, buffer_.get(), _IOFBF, buffer_size);
+}
+
+SoraFileWriter::~SoraFileWriter() {
+  // setvbuf に渡した buffer_ を解放する前に閉じる
+  Close();
+}
+
+bool SoraFileWriter::Write(const void* data, size_t size) {
+  if (file_ == nullptr || failed_) {
+    return false;
+  }
+  if (std::fwrite(data, 1, size, file_) != size) {
+    failed_ = true;
+    return false;
+  }
+  bytes_written_ += size;
+  return true;
+}
+
+bool SoraFileWriter::WriteAt(long offset, const void* data, size_t size) {
+  if (file_ == nullptr || failed_) {
+    return false;
+  }
+  if (std::fseek(file_, offset, SEEK_SET) != 0 ||
+      std::fwrite(data, 1, size, file_) != size ||
+      std::fseek(file_, 0, SEEK_END) != 0) {
+    failed_ = true;
+    return false;
+  }
+  return true;
+}
+
+bool SoraFileWriter::Close() {
+  if (file_ == nullptr) {
+    return !failed_;
+  }
+  if (std::fclose(file_) != 0) {
+    failed_ = true;
+  }
+  file_ = nullptr;
+  return !failed_;
+}
+
+SoraAudioRecorderImpl::SoraAudioRecorderImpl(SoraTrackInterface* track,
+                                             const std::string& path,
+                                             int output_sample_rate,
+                                             size_t output_channels,
+                                             int max_queue_ms)
+    : track_(track),
+      closed_(false),
+      sample_rate_(output_sample_rate),
+      channels_(output_channels),
+      header_written_(false),
+      data_bytes_(0) {
+  if (max_queue_ms <= 0) {
+    throw nb::value_error("max_queue_ms must be positive");
+  }
+  audio_frame_ = std::make_unique<webrtc::AudioFrame>();
+  file_.reset(new SoraFileWriter(path, kWriteBufferSize));
+  // OnData は 10 ms ごとに呼ばれるので、キューの 1 つは 10 ms 分になる
+  writer_.reset(new SoraWriterThread<std::vector<int16_t>>(
+      std::max(1, max_queue_ms / 10),
+      [this](std::vector<int16_t>& samples) { Write(samples); }));
+  track_->AddSubscriber(this);
+  webrtc::AudioTrackInterface* audio_track =
+      static_cast<webrtc::AudioTrackInterface*>(track_->GetTrack().get());
+  audio_track->AddSink(this);
+}
+
+SoraAudioRecorderImpl::~SoraAudioRecorderImpl() {
+  Del();
+}
+
+void SoraAudioRecorderImpl::Del() {
+  if (track_) {
+    track_->RemoveSubscriber(this);
+  }
+  Close();
+  track_ = nullptr;
+}
+
+void SoraAudioRecorderImpl::Close() {
+  WithoutGil([this]() { CloseWithoutGil(); });
+}
+
+void SoraAudioRecorderImpl::CloseWithoutGil() {
+  std::lock_guard<std::mutex> lock(close_mtx_);
+  if (closed_) {
+    return;
+  }
+  closed_ = true;
+  if (track_ && track_->GetTrack()) {
+    webrtc::AudioTrackInterface* audio_track =
+        static_cast<webrtc::AudioTrackInterface*>(track_->GetTrack().get());
+    audio_track->RemoveSink(this);
+  }
+  writer_->Stop();
+  if (!header_written_) {
+    // 一度もデータを受け取っていなくても、空の WAV ファイルとして読めるようにする
+    uint64_t before = file_->bytes_written();
+    WriteHeader();
+    bytes_written_.Add(file_->bytes_written() - before);
+  }
+  // 書き終えたので、RIFF と data のチャンクのサイズを書き直す
+  uint32_t data_size =
+      (uint32_t)std::min<uint64_t>(data_bytes_, UINT32_MAX - 36);
+  uint8_t size[4];
+  webrtc::ByteWriter<uint32_t>::WriteLittleEndian(size, 36 + data_size);
+  file_->WriteAt(4, size, 4);
+  webrtc::ByteWriter<uint32_t>::WriteLittleEndian(size, data_size);
+  file_->WriteAt(40, size, 4);
+  if (!file_->Close()) {
+    write_errors_.Add();
+  }
+}
+
+void SoraAudioRecorderImpl::PubliserDisposed() {
+  Close();
+  track_ = nullptr;
+}
+
+void SoraAudioRecorderImpl::OnData(
+    const void* audio_data,
+    int bits_per_sample,
+    int sample_rate,
+    size_t number_of_channels,
+    size_t number_of_frames,
+    absl::optional<int64_t> absolute_capture_timestamp_ms) {
+  frames_in_.Add(number_of_frames);
+  // 指定が無い場合は最初に受け取ったフォーマットで書き込む
+  if (sample_rate_ <= 0) {
+    sample_rate_ = sample_rate;
+  }
+  if (channels_ == 0) {
+    channels_ = number_of_channels;
+  }
+  bool need_resample = sample_rate != sample_rate_;
+  if (need_resample) {
+    int samples_per_channel_int = resampler_.Resample10Msec(
+        static_cast<const int16_t*>(audio_data), sample_rate, sample_rate_,
+        number_of_channels, webrtc::AudioFrame::kMaxDataSizeSamples,
+        audio_frame_->mutable_data());
+    if (samples_per_channel_int < 0) {
+      dropped_frames_.Add(number_of_frames);
+      return;
+    }
+    audio_frame_->samples_per_channel_ =
+        static_cast<size_t>(samples_per_channel_int);
+    audio_frame_->sample_rate_hz_ = sample_rate_;
+    audio_frame_->num_channels_ = number_of_channels;
+    audio_frame_->channel_layout_ =
+        webrtc::GuessChannelLayout(number_of_channels);
+  }
+  bool need_remix = number_of_channels != channels_;
+  if (need_remix) {
+    if (!need_resample) {
+      audio_frame_->UpdateFrame(
+          0, static_cast<const int16_t*>(audio_data), number_of_frames,
+          sample_rate, webrtc::AudioFrame::kNormalSpeech,
+          webrtc::AudioFrame::kVadUnknown, number_of_channels);
+    }
+    webrtc::RemixFrame(channels_, audio_frame_.get());
+  }
+  const int16_t* data = static_cast<const int16_t*>(audio_data);
+  size_t frames = number_of_frames;
+  if (need_resample || need_remix) {
+    data = audio_frame_->data();
+    frames = audio_frame_->samples_per_channel_;
+  }
+  // 書き込みのスレッドが詰まっている場合は待たずに捨てる
+  if (!writer_->Push(std::vector<int16_t>(data, data + frames * channels_))) {
+    dropped_frames_.Add(frames);
+  }
+}
+
+void SoraAudioRecorderImpl::Write(std::vector<int16_t>& samples) {
+  SoraLatencyTimer timer(write_latency_);
+  uint64_t before = file_->bytes_written();
+  if (!header_written_) {
+    WriteHeader();
+  }
+  size_t size = samples.size() * sizeof(int16_t);
+  if (file_->Write(samples.data(), size)) {
+    data_bytes_ += size;
+    frames_written_.Add(samples.size() / channels_);
+  } else {
+    write_errors_.Add();
+  }
+  bytes_written_.Add(file_->bytes_written() - before);
+}
+
+bool SoraAudioRecorderImpl::WriteHeader() {
+  header_written_ = true;
+  int sample_rate = sample_rate_ > 0 ? sample_rate_ : kDefaultSampleRate;
+  size_t channels = channels_ > 0 ? channels_ : kDefaultChannels;
+  uint16_t block_align = (uint16_t)(channels * sizeof(int16_t));
+  // サイズは閉じる時に書き直す
+  uint8_t header[kWavHeaderSize];
+  std::memcpy(header, "RIFF", 4);
+  webrtc::ByteWriter<uint32_t>::WriteLittleEndian(header + 4, 36);
+  std::memcpy(header + 8, "WAVEfmt ", 8);
+  webrtc::ByteWriter<uint32_t>::WriteLittleEndian(header + 16, 16);
+  // WAVE_FORMAT_PCM
+  webrtc::ByteWriter<uint16_t>::WriteLittleEndian(header + 20, 1);
+  webrtc::ByteWriter<uint16_t>::WriteLittleEndian(header + 22,
+                                                  (uint16_t)channels);
+  webrtc::ByteWriter<uint32_t>::WriteLittleEndian(header + 24, sample_rate);
+  webrtc::ByteWriter<uint32_t>::WriteLittleEndian(header + 28,
+                                                  sample_rate * block_align);
+  webrtc::ByteWriter<uint16_t>::WriteLittleEndian(header + 32, block_align);
+  webrtc::ByteWriter<uint16_t>::WriteLittleEndian(header + 34, 16);
+  std::memcpy(header + 36, "data", 4);
+  webrtc::ByteWriter<uint32_t>::WriteLittleEndian(header + 40, 0);
+  if (!file_->Write(header, kWavHeaderSize)) {
+    write_errors_.Add();
+    return false;
+  }
+  return true;
+}
+
+uint64_t SoraAudioRecorderImpl::GetBytesWritten() {
+  return bytes_written_.Get();
+}
+
+uint64_t SoraAudioRecorderImpl::GetDroppedFrames() {
+  return dropped_frames_.Get();
+}
+
+nb::dict SoraAudioRecorderImpl::GetMetrics() {
+  nb::dict metrics;
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_written"] = nb::cast(frames_written_.Get());
+  metrics["dropped_frames"] = nb::cast(dropped_frames_.Get());
+  metrics["bytes_written"] = nb::cast(bytes_written_.Get());
+  metrics["write_errors"] = nb::cast(write_errors_.Get());
+  metrics["queue_depth"] = nb::cast(writer_->size());
+  metrics["write_latency"] = write_latency_.ToDict();
+  return metrics;
+}
+
+SoraVideoRecorderImpl::SoraVideoRecorderImpl(SoraTrackInterface* track,
+                                             const std::string& path,
+                                             const std::string& format,
+                                             float fps,
+                                             size_t queue_size)
+    : track_(track),
+      closed_(false),
+      format_(ParseRecordFormat(format)),
+      width_(0),
+      height_(0) {
+  if (fps <= 0) {
+    throw nb::value_error("fps must be positive");
+  }
+  if (queue_size == 0) {
+    throw nb::value_error("queue_size must be positive");
+  }
+  // 29.97 などを表せるように 1/1000 単位の分数にする
+  int num = (int)std::lround(fps * 1000);
+  int gcd = std::gcd(num, 1000);
+  fps_num_ = num / gcd;
+  fps_den_ = 1000 / gcd;
+  file_.reset(new SoraFileWriter(path, kWriteBufferSize));
+  writer_.reset(
+      new SoraWriterThread<rtc::scoped_refptr<webrtc::VideoFrameBuffer>>(
+          queue_size,
+          [this](rtc::scoped_refptr<webrtc::VideoFrameBuffer>& buffer) {
+            Write(buffer);
+          }));
+  track_->AddSubscriber(this);
+  webrtc::VideoTrackInterface* video_track =
+      static_cast<webrtc::VideoTrackInterface*>(track_->GetTrack().get());
+  video_track->AddOrUpdateSink(this, rtc::VideoSinkWants());
+}
+
+SoraVideoRecorderImpl::~SoraVideoRecorderImpl() {
+  Del();
+}
+
+void SoraVideoRecorderImpl::Del() {
+  if (track_) {
+    track_->RemoveSubscriber(this);
+  }
+  Close();
+  track_ = nullptr;
+}
+
+void SoraVideoRecorderImpl::Close() {
+  WithoutGil([this]() { CloseWithoutGil(); });
+}
+
+void SoraVideoRecorderImpl::CloseWithoutGil() {
+  std::lock_guard<std::mutex> lock(close_mtx_);
+  if (closed_) {
+    return;
+  }
+  closed_ = true;
+  if (track_ && track_->GetTrack()) {
+    webrtc::VideoTrackInterface* video_track =
+        static_cast<webrtc::VideoTrackInterface*>(track_->GetTrack().get());
+    video_track->RemoveSink(this);
+  }
+  writer_->Stop();
+  if (!file_->Close()) {
+    write_errors_.Add();
+  }
+}
+
+void SoraVideoRecorderImpl::PubliserDisposed() {
+  Close();
+  track_ = nullptr;
+}
+
+void SoraVideoRecorderImpl::OnFrame(const webrtc::VideoFrame& frame) {
+  if (frame.width() == 0 || frame.height() == 0)
+    return;
+  frames_in_.Add();
+  // I420 への変換と書き込みは書き込みのスレッドで行い、デコードのスレッドでは参照を積むだけにする
+  if (!writer_->Push(frame.video_frame_buffer())) {
+    dropped_frames_.Add();
+  }
+}
+
+void SoraVideoRecorderImpl::Write(
+    rtc::scoped_refptr<webrtc::VideoFrameBuffer>& buffer) {
+  SoraLatencyTimer timer(write_latency_);
+  uint64_t before = file_->bytes_written();
+  rtc::scoped_refptr<webrtc::I420BufferInterface> i420 = buffer->ToI420();
+  // 元のバッファはデコーダーのバッファプールのものなので、変換したらすぐに返す
+  buffer = nullptr;
+  if (!i420) {
+    write_errors_.Add();
+    return;
+  }
+  if (width_ == 0) {
+    width_ = i420->width();
+    height_ = i420->height();
+    if (format_ == RecordFormat::kY4M) {
+      std::string header = "YUV4MPEG2 W" + std::to_string(width_) + " H" +
+                           std::to_string(height_) + " F" +
+                           std::to_string(fps_num_) + ":" +
+                           std::to_string(fps_den_) + " Ip A1:1 C420\n";
+      file_->Write(header.data(), header.size());
+    }
+  }
+  if (i420->width() != width_ || i420->height() != height_) {
+    if (!scaled_) {
+      scaled_ = webrtc::I420Buffer::Create(width_, height_);
+    }
+    scaled_->ScaleFrom(*i420);
+    i420 = scaled_;
+  }
+  bool ok = format_ != RecordFormat::kY4M || file_->Write("FRAME\n", 6);
+  ok = ok &&
+       WritePlane(i420->DataY(), i420->width(), i420->height(),
+                  i420->StrideY()) &&
+       WritePlane(i420->DataU(), i420->ChromaWidth(), i420->ChromaHeight(),
+                  i420->StrideU()) &&
+       WritePlane(i420->DataV(), i420->ChromaWidth(), i420->ChromaHeight(),
+                  i420->StrideV());
+  if (ok) {
+    frames_written_.Add();
+  } else {
+    write_errors_.Add();
+  }
+  bytes_written_.Add(file_->bytes_written() - before);
+}
+
+bool SoraVideoRecorderImpl::WritePlane(const uint8_t* data,
+                                       int width,
+                                       int height,
+                                       int stride) {
+  if (stride == width) {
+    return file_->Write(data, (size_t)width * height);
+  }
+  for (int y = 0; y < height; y++) {
+    if (!file_->Write(data + (size_t)stride * y, width)) {
+      return false;
+    }
+  }
+  return true;
+}
+
+uint64_t SoraVideoRecorderImpl::GetBytesWritten() {
+  return bytes_written_.Get();
+}
+
+uint64_t SoraVideoRecorderImpl::GetDroppedFrames() {
+  return dropped_frames_.Get();
+}
+
+nb::dict SoraVideoRecorderImpl::GetMetrics() {
+  nb::dict metrics;
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_written"] = nb::cast(frames_written_.Get());
+  metrics["dropped_frames"] = nb::cast(dropped_frames_.Get());
+  metrics["bytes_written"] = nb::cast(bytes_written_.Get());
+  metrics["write_errors"] = nb::cast(write_errors_.Get());
+  metrics["queue_depth"] = nb::cast(writer_->size());
+  metrics["write_latency"] = write_latency_.ToDict();
+  return metrics;
+}
+
+SoraVideoRecorderImpl::RecordFormat SoraVideoRecorderImpl::ParseRecordFormat(
+    const std::string& format) {
+  if (format == "Y4M") {
+    return RecordFormat::kY4M;
+  } else if (format == "I420") {
+    return RecordFormat::kI420;
+  }
+  throw nb::value_error(("Invalid format: " + format).c_str());
+}
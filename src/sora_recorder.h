@@ -0,0 +1,249 @@
+#ifndef SORA_RECORDER_H_
+#define SORA_RECORDER_H_
+
+#include <condition_variable>
+#include <cstdio>
+#include <deque>
+#include <functional>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <thread>
+#include <vector>
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+// WebRTC
+#include <api/audio/audio_frame.h>
+#include <api/media_stream_interface.h>
+#include <api/scoped_refptr.h>
+#include <api/video/i420_buffer.h>
+#include <api/video/video_frame.h>
+#include <api/video/video_frame_buffer.h>
+#include <api/video/video_sink_interface.h>
+#include <modules/audio_coding/acm2/acm_resampler.h>
+
+#include "sora_metrics.h"
+#include "sora_track_interface.h"
+
+namespace nb = nanobind;
+
+/*
+ * 大きなバッファを挟んでファイルに書き込む
+ * 書き込みのスレッドからのみ使う
+ */
+class SoraFileWriter {
+ public:
+  SoraFileWriter(const std::string& path, size_t buffer_size);
+  ~SoraFileWriter();
+
+  // 一度失敗した後は何も書き込まずに false を返す
+  bool Write(const void* data, size_t size);
+  // ヘッダーを書き直すために、位置を指定して書き込む
+  bool WriteAt(long offset, const void* data, size_t size);
+  bool Close();
+
+  uint64_t bytes_written() const { return bytes_written_; }
+  bool failed() const { return failed_; }
+
+ private:
+  FILE* file_;
+  std::unique_ptr<char[]> buffer_;
+  uint64_t bytes_written_;
+  bool failed_;
+};
+
+/*
+ * 上限付きのキューに積んだデータを専用のスレッドで順に write に渡す
+ * キューが一杯の場合は積まずに捨てるので、 Push を呼んだスレッドが待つことはない
+ */
+template <typename T>
+class SoraWriterThread {
+ public:
+  SoraWriterThread(size_t max_queue_size, std::function<void(T&)> write)
+      : max_queue_size_(max_queue_size), write_(write), finished_(false) {
+    thread_.reset(new std::thread([this]() { Process(); }));
+  }
+  ~SoraWriterThread() { Stop(); }
+
+  bool Push(T item) {
+    {
+      std::lock_guard<std::mutex> lock(mtx_);
+      if (finished_ || queue_.size() >= max_queue_size_) {
+        return false;
+      }
+      queue_.push_back(std::move(item));
+    }
+    cond_.notify_one();
+    return true;
+  }
+
+  // キューに残っているデータを全て書き込んでからスレッドを止める
+  void Stop() {
+    {
+      std::lock_guard<std::mutex> lock(mtx_);
+      finished_ = true;
+    }
+    cond_.notify_one();
+    if (thread_) {
+      thread_->join();
+      thread_ = nullptr;
+    }
+  }
+
+  size_t size() {
+    std::lock_guard<std::mutex> lock(mtx_);
+    return queue_.size();
+  }
+
+ private:
+  void Process() {
+    std::unique_lock<std::mutex> lock(mtx_);
+    while (true) {
+      cond_.wait(lock, [this]() { return finished_ || !queue_.empty(); });
+      if (queue_.empty()) {
+        return;
+      }
+      T item = std::move(queue_.front());
+      queue_.pop_front();
+      lock.unlock();
+      write_(item);
+      lock.lock();
+    }
+  }
+
+  const size_t max_queue_size_;
+  std::function<void(T&)> write_;
+  std::mutex mtx_;
+  std::condition_variable cond_;
+  std::deque<T> queue_;
+  bool finished_;
+  std::unique_ptr<std::thread> thread_;
+};
+
+/*
+ * 受信した音声を Python を経由せずに WAV ファイルに書き込む Sink
+ * output_frequency と output_channels を指定しない場合は、最初に受け取った音声のフォーマットで書き込む
+ * 途中でフォーマットが変わった場合は、最初のフォーマットにリサンプリングとチャンネル数の変換をする
+ */
+class SoraAudioRecorderImpl : public webrtc::AudioTrackSinkInterface,
+                              public DisposeSubscriber {
+ public:
+  SoraAudioRecorderImpl(SoraTrackInterface* track,
+                        const std::string& path,
+                        int output_sample_rate,
+                        size_t output_channels,
+                        int max_queue_ms);
+  ~SoraAudioRecorderImpl();
+
+  void Del();
+  // Sink を外し、キューに残っているデータを書き込んでからファイルを閉じる
+  void Close();
+
+  uint64_t GetBytesWritten();
+  uint64_t GetDroppedFrames();
+  nb::dict GetMetrics();
+
+  // webrtc::AudioTrackSinkInterface
+  void OnData(const void* audio_data,
+              int bits_per_sample,
+              int sample_rate,
+              size_t number_of_channels,
+              size_t number_of_frames,
+              absl::optional<int64_t> absolute_capture_timestamp_ms) override;
+
+  // DisposeSubscriber
+  void PubliserDisposed() override;
+
+ private:
+  void CloseWithoutGil();
+  void Write(std::vector<int16_t>& samples);
+  bool WriteHeader();
+
+  SoraTrackInterface* track_;
+  std::mutex close_mtx_;
+  bool closed_;
+  // 最初の OnData で決まり、その後は変わらない
+  // 書き込みのスレッドはキューを経由して受け取った後にしか読まない
+  int sample_rate_;
+  size_t channels_;
+  // 以下は OnData を呼ぶスレッドからのみ触る
+  std::unique_ptr<webrtc::AudioFrame> audio_frame_;
+  webrtc::acm2::ACMResampler resampler_;
+  // 以下は書き込みのスレッドと、それを止めた後の Close からのみ触る
+  std::unique_ptr<SoraFileWriter> file_;
+  bool header_written_;
+  uint64_t data_bytes_;
+  std::unique_ptr<SoraWriterThread<std::vector<int16_t>>> writer_;
+  SoraCounter bytes_written_;
+  SoraCounter frames_in_;
+  SoraCounter frames_written_;
+  SoraCounter dropped_frames_;
+  SoraCounter write_errors_;
+  SoraLatencyHistogram write_latency_;
+};
+
+/*
+ * 受信した映像を Python を経由せずに Y4M か I420 をそのまま並べたファイルに書き込む Sink
+ * 最初のフレームの解像度で書き込み、途中で解像度が変わった場合は最初の解像度に拡大縮小する
+ * Y4M はフレームごとの時刻を持たないので、ヘッダーには fps を書く
+ */
+class SoraVideoRecorderImpl
+    : public rtc::VideoSinkInterface<webrtc::VideoFrame>,
+      public DisposeSubscriber {
+ public:
+  SoraVideoRecorderImpl(SoraTrackInterface* track,
+                        const std::string& path,
+                        const std::string& format,
+                        float fps,
+                        size_t queue_size);
+  ~SoraVideoRecorderImpl();
+
+  void Del();
+  // Sink を外し、キューに残っているフレームを書き込んでからファイルを閉じる
+  void Close();
+
+  uint64_t GetBytesWritten();
+  uint64_t GetDroppedFrames();
+  nb::dict GetMetrics();
+
+  // rtc::VideoSinkInterface
+  void OnFrame(const webrtc::VideoFrame& frame) override;
+
+  // DisposeSubscriber
+  void PubliserDisposed() override;
+
+ private:
+  enum class RecordFormat {
+    kY4M,
+    kI420,
+  };
+  static RecordFormat ParseRecordFormat(const std::string& format);
+  void CloseWithoutGil();
+  void Write(rtc::scoped_refptr<webrtc::VideoFrameBuffer>& buffer);
+  bool WritePlane(const uint8_t* data, int width, int height, int stride);
+
+  SoraTrackInterface* track_;
+  std::mutex close_mtx_;
+  bool closed_;
+  const RecordFormat format_;
+  int fps_num_;
+  int fps_den_;
+  // 以下は書き込みのスレッドと、それを止めた後の Close からのみ触る
+  std::unique_ptr<SoraFileWriter> file_;
+  int width_;
+  int height_;
+  rtc::scoped_refptr<webrtc::I420Buffer> scaled_;
+  std::unique_ptr<
+      SoraWriterThread<rtc::scoped_refptr<webrtc::VideoFrameBuffer>>>
+      writer_;
+  SoraCounter bytes_written_;
+  SoraCounter frames_in_;
+  SoraCounter frames_written_;
+  SoraCounter dropped_frames_;
+  SoraCounter write_errors_;
+  SoraLatencyHistogram write_latency_;
+};
+
+#endif
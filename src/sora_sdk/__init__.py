@@ -1,3 +1,8 @@
+import asyncio
+import functools
+import os
+
+from ._rechunk import AudioRechunker as _AudioRechunker
 from .sora_sdk_ext import *  # noqa: F401,F403
 
 """
@@ -8,21 +13,298 @@ sink はそれぞれ track が必要で参照を保持する必要がある
 """
 
 
+def _call_soon_threadsafe(loop, callback, *args):
+    # コールバックは C++ のスレッドから呼ばれるので、イベントループへは必ずこれで渡す
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # ループが既に閉じられている場合は渡す先がないので捨てる
+        pass
+
+
 class SoraAudioSink(SoraAudioSinkImpl):
-    def __init__(self, track, output_frequency, output_channels):
-        super().__init__(track, output_frequency, output_channels)
+    def __init__(
+        self,
+        track,
+        output_frequency,
+        output_channels,
+        max_buffer_ms=10000,
+        overflow_policy="drop_oldest",
+        output_dtype="int16",
+        chunk_ms=10,
+    ):
+        super().__init__(
+            track,
+            output_frequency,
+            output_channels,
+            max_buffer_ms,
+            overflow_policy,
+            output_dtype,
+            chunk_ms,
+        )
         self.__track = track
+        self.__event = asyncio.Event()
+        self.__loop = None
 
     def __del__(self):
         super().__del__()
         del self.__track
 
+    async def chunks(self, ms):
+        """
+        ms ミリ秒分の音声を ndarray で順に返す非同期イテレーター
+        on_data を経由せず、足りない分が貯まった時に C++ から起こされてバッファから読む
+        """
+        if ms <= 0:
+            raise ValueError("ms must be positive")
+        loop = asyncio.get_running_loop()
+        if self.__loop not in (None, loop):
+            self.__event = asyncio.Event()
+        self.__loop = loop
+        notify = functools.partial(
+            _call_soon_threadsafe, loop, self.__event.set
+        )
+        rechunker = _AudioRechunker()
+        try:
+            while True:
+                success, data = self.read(0)
+                if success:
+                    rechunker.push(data, self.sample_rate)
+                chunks = rechunker.pop(ms)
+                if chunks:
+                    for chunk in chunks:
+                        yield chunk
+                    continue
+                self.__event.clear()
+                # 読んだ後に足りない分が既に貯まっていれば、待たずに読み直す
+                if self.set_notify(notify, rechunker.missing(ms)):
+                    continue
+                await self.__event.wait()
+        finally:
+            self.set_notify(None)
+
 
 class SoraVideoSink(SoraVideoSinkImpl):
-    def __init__(self, track):
-        super().__init__(track)
+    def __init__(
+        self,
+        track,
+        format="BGR",
+        queue_size=0,
+        drop_policy="drop_oldest",
+        max_width=0,
+        max_height=0,
+        max_fps=0,
+        crop=None,
+    ):
+        super().__init__(
+            track,
+            format,
+            queue_size,
+            drop_policy,
+            max_width,
+            max_height,
+            max_fps,
+            None if crop is None else tuple(crop),
+        )
+        self.__track = track
+        self.__event = asyncio.Event()
+        self.__loop = None
+
+    def __del__(self):
+        super().__del__()
+        del self.__track
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        self.__listen()
+        while True:
+            self.__event.clear()
+            success, frame = self.read(timeout=0)
+            if success:
+                return frame
+            await self.__event.wait()
+
+    def __listen(self):
+        # on_frame を経由せず、キューが空でなくなった時だけ C++ から起こしてもらう
+        # queue_size が 0 の場合は、 C++ が最新の 1 フレームだけを保持する
+        loop = asyncio.get_running_loop()
+        if self.__loop is loop:
+            return
+        if self.__loop is not None:
+            self.__event = asyncio.Event()
+        self.__loop = loop
+        self.set_notify(
+            functools.partial(_call_soon_threadsafe, loop, self.__event.set)
+        )
+
+
+class SoraAudioRecorder(SoraAudioRecorderImpl):
+    """
+    受信した音声を C++ のスレッドで WAV ファイルに書き込む
+    """
+
+    def __init__(
+        self,
+        track,
+        path,
+        output_frequency=-1,
+        output_channels=0,
+        max_queue_ms=1000,
+    ):
+        super().__init__(
+            track,
+            os.fspath(path),
+            output_frequency,
+            output_channels,
+            max_queue_ms,
+        )
         self.__track = track
 
     def __del__(self):
         super().__del__()
         del self.__track
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SoraVideoRecorder(SoraVideoRecorderImpl):
+    """
+    受信した映像を C++ のスレッドで Y4M か I420 を並べたファイルに書き込む
+    """
+
+    def __init__(self, track, path, format="Y4M", fps=30, queue_size=30):
+        super().__init__(track, os.fspath(path), format, fps, queue_size)
+        self.__track = track
+
+    def __del__(self):
+        super().__del__()
+        del self.__track
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _ConnectionEvents:
+    """
+    SoraConnection のコールバックをイベントループに渡す
+    インスタンスのメソッドを SoraConnection のコールバックに設定するので、
+    コールバックから取り出して SoraConnection ごとに 1 つだけ作る
+    """
+
+    def __init__(self, conn, loop):
+        self.loop = loop
+        self.offer = loop.create_future()
+        self.disconnect = loop.create_future()
+        self.tracks = []
+        self.track_waiters = []
+        self.on_set_offer_ = conn.on_set_offer
+        self.on_disconnect_ = conn.on_disconnect
+        self.on_track_ = conn.on_track
+        conn.on_set_offer = self.on_set_offer
+        conn.on_disconnect = self.on_disconnect
+        conn.on_track = self.on_track
+
+    @staticmethod
+    def get(conn):
+        events = getattr(conn.on_disconnect, "__self__", None)
+        if isinstance(events, _ConnectionEvents):
+            return events
+        return _ConnectionEvents(conn, asyncio.get_running_loop())
+
+    def on_set_offer(self, offer):
+        _call_soon_threadsafe(self.loop, self._set_offer, offer)
+        if self.on_set_offer_ is not None:
+            self.on_set_offer_(offer)
+
+    def on_disconnect(self, ec, message):
+        _call_soon_threadsafe(self.loop, self._set_disconnect, ec, message)
+        if self.on_disconnect_ is not None:
+            self.on_disconnect_(ec, message)
+
+    def on_track(self, track):
+        _call_soon_threadsafe(self.loop, self._add_track, track)
+        if self.on_track_ is not None:
+            self.on_track_(track)
+
+    def _set_offer(self, offer):
+        if not self.offer.done():
+            self.offer.set_result(offer)
+
+    def _set_disconnect(self, ec, message):
+        if not self.offer.done():
+            self.offer.set_exception(ConnectionError(message))
+            # connect_async を待っていない場合に未取得の例外として警告されないようにする
+            self.offer.exception()
+        if not self.disconnect.done():
+            self.disconnect.set_result((ec, message))
+        for kind, future in self.track_waiters:
+            if not future.done():
+                future.set_exception(ConnectionError(message))
+        self.track_waiters = []
+
+    def _add_track(self, track):
+        for i, (kind, future) in enumerate(self.track_waiters):
+            if not future.done() and (kind is None or kind == track.kind):
+                del self.track_waiters[i]
+                future.set_result(track)
+                return
+        self.tracks.append(track)
+
+
+async def _connect_async(self):
+    """
+    接続して type: offer を受け取るまで待つ
+    その前に切断された場合は ConnectionError を送出する
+    """
+    events = _ConnectionEvents.get(self)
+    self.connect()
+    return await asyncio.shield(events.offer)
+
+
+async def _disconnect_async(self):
+    """
+    切断して on_disconnect が呼ばれるまで待ち、 (ec, message) を返す
+    """
+    events = _ConnectionEvents.get(self)
+    # disconnect はシグナリングのスレッドを join するので executor で呼ぶ
+    await events.loop.run_in_executor(None, self.disconnect)
+    return await asyncio.shield(events.disconnect)
+
+
+async def _wait_disconnect(self):
+    """
+    on_disconnect が呼ばれるまで待ち、 (ec, message) を返す
+    """
+    return await asyncio.shield(_ConnectionEvents.get(self).disconnect)
+
+
+async def _wait_track(self, kind=None):
+    """
+    on_track で受け取った Track を返す、 kind を指定した場合はその種類の Track だけを返す
+    まだ受け取っていない場合は受け取るまで待つ
+    """
+    events = _ConnectionEvents.get(self)
+    for i, track in enumerate(events.tracks):
+        if kind is None or track.kind == kind:
+            return events.tracks.pop(i)
+    if events.disconnect.done():
+        raise ConnectionError("connection is already disconnected")
+    future = events.loop.create_future()
+    events.track_waiters.append((kind, future))
+    return await future
+
+
+# SoraConnection は C++ 側で生成されるため、Wrapper ではなくメソッドを追加する
+SoraConnection.connect_async = _connect_async
+SoraConnection.disconnect_async = _disconnect_async
+SoraConnection.wait_disconnect = _wait_disconnect
+SoraConnection.wait_track = _wait_track
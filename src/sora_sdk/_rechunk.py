@@ -0,0 +1,57 @@
+"""
+SoraAudioSink.chunks で使う、受け取った ndarray を決まったサンプル数ずつに分け直す処理
+
+ネイティブ拡張に依存しないように sora_sdk/__init__.py から分けている
+"""
+
+import numpy
+
+
+class AudioRechunker:
+    """
+    (サンプル数, チャンネル数) の ndarray を貯め、 frames サンプルずつに分け直す
+    サンプリングレートかチャンネル数が変わった場合は、それまでに貯めた分を捨てる
+    """
+
+    def __init__(self):
+        self.format = None
+        self._pending = []
+        self._pending_frames = 0
+
+    def push(self, data, sample_rate):
+        current = (sample_rate, data.shape[1])
+        if current != self.format:
+            self.format = current
+            self._pending = []
+            self._pending_frames = 0
+        if data.shape[0] > 0:
+            self._pending.append(data)
+            self._pending_frames += data.shape[0]
+
+    def missing(self, ms):
+        """
+        次の ms ミリ秒分を返すのに足りないサンプル数を返す、フォーマットが分からない場合は 1 を返す
+        """
+        if self.format is None:
+            return 1
+        frames = max(1, self.format[0] * ms // 1000)
+        return max(1, frames - self._pending_frames)
+
+    def pop(self, ms):
+        """
+        ms ミリ秒分ずつに分けた ndarray のリストを返す、足りない分は次に持ち越す
+        """
+        if self.format is None:
+            return []
+        frames = max(1, self.format[0] * ms // 1000)
+        if self._pending_frames < frames:
+            return []
+        buffer = numpy.concatenate(self._pending)
+        chunks = []
+        pos = 0
+        while self._pending_frames - pos >= frames:
+            chunks.append(buffer[pos : pos + frames])
+            pos += frames
+        self._pending = [buffer[pos:]] if pos < self._pending_frames else []
+        self._pending_frames -= pos
+        return chunks
@@ -0,0 +1,262 @@
+"""
+WAV と Y4M のファイルをメモリマップで読み、 SoraAudioSource と SoraVideoSource に渡す
+
+ファイル全体を Python に読み込まず、フレームごとにメモリマップを参照する ndarray を作って渡す
+Y4M は I420 の ndarray として on_captured(format="I420") に渡すので、 BGR への変換は行わない
+
+実時間に合わせて送る場合は、 create_audio_source(paced=True) と
+create_video_source(queue_policy="block", scheduled=True) で作った Source に渡す
+それ以外の Source に渡した場合はファイルを読める速さで渡し続ける
+
+>>> audio_source = sora.create_audio_source(1, 48000, paced=True)
+>>> video_source = sora.create_video_source(
+...     max_queue_size=30, queue_policy="block", scheduled=True
+... )
+>>> threading.Thread(target=send_wav, args=(audio_source, "input.wav")).start()
+>>> send_y4m(video_source, "input.y4m")
+"""
+
+import mmap
+import struct
+from fractions import Fraction
+
+import numpy
+
+__all__ = ["WavReader", "Y4MReader", "send_wav", "send_y4m"]
+
+_WAVE_FORMAT_PCM = 0x0001
+_WAVE_FORMAT_IEEE_FLOAT = 0x0003
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _map_file(path):
+    with open(path, "rb") as f:
+        # nanobind は書き込みできない ndarray を受け取れないので、
+        # ファイルには書き戻さない ACCESS_COPY で書き込みできるマップにする
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+class _MappedFile:
+    def __init__(self, path):
+        self._mmap = _map_file(path)
+
+    def close(self):
+        """
+        メモリマップを閉じる
+        このファイルから取得した ndarray が残っている場合は BufferError になる
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class WavReader(_MappedFile):
+    """
+    16 bit PCM または 32 bit float の WAV ファイルを (サンプル数, チャンネル数) の ndarray として読む
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        mm = self._mmap
+        if len(mm) < 12 or mm[0:4] != b"RIFF" or mm[8:12] != b"WAVE":
+            raise ValueError("not a WAV file")
+        fmt = None
+        data = None
+        pos = 12
+        while pos + 8 <= len(mm):
+            chunk_id = mm[pos : pos + 4]
+            (chunk_size,) = struct.unpack_from("<I", mm, pos + 4)
+            body = pos + 8
+            if chunk_id == b"fmt ":
+                fmt = struct.unpack_from("<HHIIHH", mm, body)
+                if fmt[0] == _WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                    # SubFormat の GUID の先頭 2 バイトが実際のフォーマット
+                    (format_tag,) = struct.unpack_from("<H", mm, body + 24)
+                    fmt = (format_tag,) + fmt[1:]
+            elif chunk_id == b"data":
+                # 書き込み途中のファイルはサイズが正しくないので、ファイルの末尾までにする
+                data = (body, min(chunk_size, len(mm) - body))
+                break
+            # チャンクは 2 バイト境界に揃えられている
+            pos = body + chunk_size + (chunk_size & 1)
+        if fmt is None or data is None:
+            raise ValueError("WAV file must have fmt and data chunks")
+
+        format_tag, channels, sample_rate, _, _, bits_per_sample = fmt
+        if format_tag == _WAVE_FORMAT_PCM and bits_per_sample == 16:
+            dtype = numpy.dtype("<i2")
+        elif format_tag == _WAVE_FORMAT_IEEE_FLOAT and bits_per_sample == 32:
+            dtype = numpy.dtype("<f4")
+        else:
+            raise ValueError(
+                f"Unsupported WAV format: format_tag={format_tag}, "
+                f"bits_per_sample={bits_per_sample}"
+            )
+        if channels == 0:
+            raise ValueError("Invalid channels: 0")
+
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.dtype = dtype
+        self.frames = data[1] // (dtype.itemsize * channels)
+        self._offset = data[0]
+
+    @property
+    def duration(self):
+        """
+        音声の長さの秒数
+        """
+        return self.frames / self.sample_rate
+
+    def read(self, start, frames):
+        """
+        start サンプル目から最大 frames サンプル分を、コピーせずにメモリマップを参照する ndarray で返す
+        """
+        start = max(0, min(start, self.frames))
+        frames = max(0, min(frames, self.frames - start))
+        return numpy.frombuffer(
+            self._mmap,
+            dtype=self.dtype,
+            count=frames * self.channels,
+            offset=self._offset + start * self.dtype.itemsize * self.channels,
+        ).reshape(frames, self.channels)
+
+    def chunks(self, ms=10):
+        """
+        ms ミリ秒分ずつの ndarray を順に返す、最後の ndarray は ms ミリ秒より短い場合がある
+        """
+        if ms <= 0:
+            raise ValueError("ms must be positive")
+        frames = max(1, self.sample_rate * ms // 1000)
+        for start in range(0, self.frames, frames):
+            yield self.read(start, frames)
+
+
+class Y4MReader(_MappedFile):
+    """
+    4:2:0 の Y4M ファイルのフレームを (height * 3 / 2, width) の I420 の ndarray として読む
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        mm = self._mmap
+        end = mm.find(b"\n")
+        if mm[0:10] != b"YUV4MPEG2 " or end < 0:
+            raise ValueError("not a Y4M file")
+        params = {}
+        for token in mm[10:end].split():
+            params[chr(token[0])] = token[1:].decode()
+        if "W" not in params or "H" not in params:
+            raise ValueError("Y4M header must have W and H")
+        colorspace = params.get("C", "420")
+        # 8 bit の 4:2:0 はサンプリング位置が違っても I420 と同じ並びになる
+        if colorspace not in ("420", "420jpeg", "420paldv", "420mpeg2"):
+            raise ValueError(f"Unsupported Y4M colorspace: {colorspace}")
+        width = int(params["W"])
+        height = int(params["H"])
+        if width <= 0 or height <= 0 or width % 2 or height % 2:
+            raise ValueError(f"Unsupported Y4M size: {width}x{height}")
+        num, _, den = params.get("F", "30:1").partition(":")
+
+        self.width = width
+        self.height = height
+        self.fps = Fraction(int(num), int(den or 1))
+        self._frame_size = width * height * 3 // 2
+        # 各フレームの FRAME ヘッダーの後ろの位置
+        # ヘッダーの行だけを読むので、フレームのデータのページには触れない
+        self._offsets = []
+        pos = end + 1
+        while pos < len(mm):
+            if mm[pos : pos + 5] != b"FRAME":
+                raise ValueError(f"Invalid Y4M frame header at {pos}")
+            header_end = mm.find(b"\n", pos)
+            if header_end < 0 or header_end + 1 + self._frame_size > len(mm):
+                # 書き込み途中の最後のフレームは読まない
+                break
+            self._offsets.append(header_end + 1)
+            pos = header_end + 1 + self._frame_size
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, index):
+        """
+        index 番目のフレームを、コピーせずにメモリマップを参照する ndarray で返す
+        """
+        return numpy.frombuffer(
+            self._mmap,
+            dtype=numpy.uint8,
+            count=self._frame_size,
+            offset=self._offsets[index],
+        ).reshape(self.height * 3 // 2, self.width)
+
+    def __iter__(self):
+        for index in range(len(self._offsets)):
+            yield self[index]
+
+
+def send_wav(source, path, chunk_ms=10, loop=False, stop=None):
+    """
+    WAV ファイルを chunk_ms ミリ秒分ずつ source.on_data に渡す
+    サンプリングレート、チャンネル数、 float32 から int16 への変換は SoraAudioSource が行う
+    loop が True の場合は stop (threading.Event) がセットされるまで繰り返す
+    """
+    if chunk_ms <= 0:
+        raise ValueError("chunk_ms must be positive")
+    with WavReader(path) as reader:
+        if reader.frames == 0:
+            return
+        frames = max(1, reader.sample_rate * chunk_ms // 1000)
+        while True:
+            # ndarray を変数に残すと閉じる時に BufferError になるので、渡したらすぐに解放する
+            for start in range(0, reader.frames, frames):
+                if stop is not None and stop.is_set():
+                    return
+                source.on_data(
+                    reader.read(start, frames), sample_rate=reader.sample_rate
+                )
+            if not loop:
+                return
+
+
+def send_y4m(source, path, loop=False, stop=None):
+    """
+    Y4M ファイルのフレームを、ヘッダーのフレームレートから求めた timestamp と共に
+    source.on_captured に I420 のまま渡す
+    loop が True の場合は stop (threading.Event) がセットされるまで、 timestamp を進めながら繰り返す
+    """
+    with Y4MReader(path) as reader:
+        if len(reader) == 0:
+            return
+        count = 0
+        while True:
+            # ndarray を変数に残すと閉じる時に BufferError になるので、渡したらすぐに解放する
+            for index in range(len(reader)):
+                if stop is not None and stop.is_set():
+                    return
+                source.on_captured(
+                    reader[index], float(count / reader.fps), format="I420"
+                )
+                count += 1
+            if not loop:
+                return
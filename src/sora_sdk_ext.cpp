@@ -9,6 +9,8 @@
 #include "sora_audio_sink.h"
 #include "sora_audio_source.h"
 #include "sora_connection.h"
+#include "sora_loopback.h"
+#include "sora_recorder.h"
 #include "sora_track_interface.h"
 #include "sora_video_sink.h"
 #include "sora_video_source.h"
@@ -35,6 +37,11 @@ int audio_sink_tp_traverse(PyObject* self, visitproc visit, void* arg) {
     Py_VISIT(on_data.ptr());
   }
 
+  if (audio_sink->notify_) {
+    nb::object notify = nb::cast(audio_sink->notify_, nb::rv_policy::none);
+    Py_VISIT(notify.ptr());
+  }
+
   return 0;
 }
 
@@ -50,6 +57,11 @@ int video_sink_tp_traverse(PyObject* self, visitproc visit, void* arg) {
     Py_VISIT(on_frame.ptr());
   }
 
+  if (video_sink->notify_) {
+    nb::object notify = nb::cast(video_sink->notify_, nb::rv_policy::none);
+    Py_VISIT(notify.ptr());
+  }
+
   return 0;
 }
 
@@ -87,6 +99,12 @@ int connection_tp_traverse(PyObject* self, visitproc visit, void* arg) {
     Py_VISIT(on_message.ptr());
   }
 
+  if (conn->on_message_bytes_) {
+    nb::object on_message_bytes =
+        nb::cast(conn->on_message_bytes_, nb::rv_policy::none);
+    Py_VISIT(on_message_bytes.ptr());
+  }
+
   if (conn->on_track_) {
     nb::object on_track = nb::cast(conn->on_track_, nb::rv_policy::none);
     Py_VISIT(on_track.ptr());
@@ -98,6 +116,11 @@ int connection_tp_traverse(PyObject* self, visitproc visit, void* arg) {
     Py_VISIT(on_data_channel.ptr());
   }
 
+  if (conn->on_stats_) {
+    nb::object on_stats = nb::cast(conn->on_stats_, nb::rv_policy::none);
+    Py_VISIT(on_stats.ptr());
+  }
+
   return 0;
 }
 
@@ -140,68 +163,151 @@ NB_MODULE(sora_sdk_ext, m) {
                           &SoraAudioSource::OnData))
       .def("on_data",
            nb::overload_cast<const int16_t*, size_t>(&SoraAudioSource::OnData))
+      // int16 でそのまま渡せる場合は変換のない overload を使うように、暗黙の変換はしない
       .def("on_data",
            nb::overload_cast<nb::ndarray<int16_t, nb::shape<nb::any, nb::any>,
                                          nb::c_contig, nb::device::cpu>,
-                             double>(&SoraAudioSource::OnData))
+                             double>(&SoraAudioSource::OnData),
+           "ndarray"_a.noconvert(), "timestamp"_a)
       .def("on_data",
            nb::overload_cast<nb::ndarray<int16_t, nb::shape<nb::any, nb::any>,
                                          nb::c_contig, nb::device::cpu>>(
-               &SoraAudioSource::OnData));
+               &SoraAudioSource::OnData),
+           "ndarray"_a.noconvert())
+      .def("on_data",
+           nb::overload_cast<nb::ndarray<nb::shape<nb::any, nb::any>,
+                                         nb::c_contig, nb::device::cpu>,
+                             int, std::optional<double>>(
+               &SoraAudioSource::OnData),
+           "ndarray"_a, "sample_rate"_a = 0, "timestamp"_a = nb::none())
+      .def("flush", &SoraAudioSource::Flush)
+      .def_prop_ro("metrics", &SoraAudioSource::GetMetrics);
 
   nb::class_<SoraVideoSource, SoraTrackInterface>(m, "SoraVideoSource")
-      .def(
-          "on_captured",
-          nb::overload_cast<nb::ndarray<uint8_t, nb::shape<nb::any, nb::any, 3>,
-                                        nb::c_contig, nb::device::cpu>>(
-              &SoraVideoSource::OnCaptured))
-      .def(
-          "on_captured",
-          nb::overload_cast<nb::ndarray<uint8_t, nb::shape<nb::any, nb::any, 3>,
-                                        nb::c_contig, nb::device::cpu>,
-                            double>(&SoraVideoSource::OnCaptured))
-      .def(
-          "on_captured",
-          nb::overload_cast<nb::ndarray<uint8_t, nb::shape<nb::any, nb::any, 3>,
-                                        nb::c_contig, nb::device::cpu>,
-                            int64_t>(&SoraVideoSource::OnCaptured));
+      .def("on_captured",
+           nb::overload_cast<nb::ndarray<uint8_t, nb::device::cpu>,
+                             const std::string&>(&SoraVideoSource::OnCaptured),
+           "ndarray"_a, "format"_a = "BGR")
+      .def("on_captured",
+           nb::overload_cast<nb::ndarray<uint8_t, nb::device::cpu>, double,
+                             const std::string&>(&SoraVideoSource::OnCaptured),
+           "ndarray"_a, "timestamp"_a, "format"_a = "BGR")
+      .def("on_captured",
+           nb::overload_cast<nb::ndarray<uint8_t, nb::device::cpu>, int64_t,
+                             const std::string&>(&SoraVideoSource::OnCaptured),
+           "ndarray"_a, "timestamp_us"_a, "format"_a = "BGR")
+      .def_prop_ro("enqueued_frames", &SoraVideoSource::GetEnqueuedFrames)
+      .def_prop_ro("dropped_frames", &SoraVideoSource::GetDroppedFrames)
+      .def_prop_ro("queue_depth", &SoraVideoSource::GetQueueDepth)
+      .def_prop_ro("metrics", &SoraVideoSource::GetMetrics);
+
+  nb::class_<SoraVideoLoopback, SoraTrackInterface>(m, "SoraVideoLoopback")
+      .def_prop_ro("metrics", &SoraVideoLoopback::GetMetrics);
+
+  nb::class_<SoraAudioLoopback, SoraTrackInterface>(m, "SoraAudioLoopback")
+      .def_prop_ro("metrics", &SoraAudioLoopback::GetMetrics);
 
   nb::class_<SoraAudioSinkImpl>(m, "SoraAudioSinkImpl",
                                 nb::type_slots(audio_sink_slots))
-      .def(nb::init<SoraTrackInterface*, int, size_t>(), "track"_a,
-           "output_frequency"_a = -1, "output_channels"_a = 0)
+      .def(nb::init<SoraTrackInterface*, int, size_t, int, const std::string&,
+                    const std::string&, int>(),
+           "track"_a, "output_frequency"_a = -1, "output_channels"_a = 0,
+           "max_buffer_ms"_a = 10000, "overflow_policy"_a = "drop_oldest",
+           "output_dtype"_a = "int16", "chunk_ms"_a = 10)
       .def("__del__", &SoraAudioSinkImpl::Del)
       .def("read", &SoraAudioSinkImpl::Read, "frames"_a = 0, "timeout"_a = 1,
            nb::rv_policy::move)
+      // 変換したコピーに書き込んで呼び出し元の ndarray が変わらないことがないように、暗黙の変換はしない
+      .def("read_into", &SoraAudioSinkImpl::ReadInto, "out"_a.noconvert(),
+           "timeout"_a = 1)
+      .def_prop_ro("sample_rate", &SoraAudioSinkImpl::GetSampleRate)
+      .def_prop_ro("channels", &SoraAudioSinkImpl::GetChannels)
+      .def("set_notify", &SoraAudioSinkImpl::SetNotify, "notify"_a.none(),
+           "frames"_a = 1)
+      .def_prop_ro("overrun_frames", &SoraAudioSinkImpl::GetOverrunFrames)
+      .def_prop_ro("underrun_count", &SoraAudioSinkImpl::GetUnderrunCount)
+      .def_prop_ro("metrics", &SoraAudioSinkImpl::GetMetrics)
       .def_rw("on_data", &SoraAudioSinkImpl::on_data_)
       .def_rw("on_format", &SoraAudioSinkImpl::on_format_);
 
   nb::class_<SoraVideoFrame>(m, "SoraVideoFrame")
-      .def("data", &SoraVideoFrame::Data, nb::rv_policy::reference);
+      .def_prop_ro("width", &SoraVideoFrame::width)
+      .def_prop_ro("height", &SoraVideoFrame::height)
+      .def("data", &SoraVideoFrame::Data, nb::rv_policy::reference)
+      .def("y", &SoraVideoFrame::Y)
+      .def("u", &SoraVideoFrame::U)
+      .def("v", &SoraVideoFrame::V);
 
   nb::class_<SoraVideoSinkImpl>(m, "SoraVideoSinkImpl",
                                 nb::type_slots(video_sink_slots))
-      .def(nb::init<SoraTrackInterface*>())
+      .def(nb::init<SoraTrackInterface*, const std::string&, size_t,
+                    const std::string&, int, int, float, nb::handle>(),
+           "track"_a, "format"_a = "BGR", "queue_size"_a = 0,
+           "drop_policy"_a = "drop_oldest", "max_width"_a = 0,
+           "max_height"_a = 0, "max_fps"_a = 0, "crop"_a = nb::none())
       .def("__del__", &SoraVideoSinkImpl::Del)
+      .def("read", &SoraVideoSinkImpl::Read, "timeout"_a = 1)
+      .def("read_latest", &SoraVideoSinkImpl::ReadLatest, "timeout"_a = 1)
+      .def("set_notify", &SoraVideoSinkImpl::SetNotify, "notify"_a.none())
+      .def_prop_ro("dropped_frames", &SoraVideoSinkImpl::GetDroppedFrames)
+      .def_prop_ro("metrics", &SoraVideoSinkImpl::GetMetrics)
       .def_rw("on_frame", &SoraVideoSinkImpl::on_frame_);
 
+  nb::class_<SoraAudioRecorderImpl>(m, "SoraAudioRecorderImpl")
+      .def(
+          nb::init<SoraTrackInterface*, const std::string&, int, size_t, int>(),
+          "track"_a, "path"_a, "output_frequency"_a = -1,
+          "output_channels"_a = 0, "max_queue_ms"_a = 1000)
+      .def("__del__", &SoraAudioRecorderImpl::Del)
+      .def("close", &SoraAudioRecorderImpl::Close)
+      .def_prop_ro("bytes_written", &SoraAudioRecorderImpl::GetBytesWritten)
+      .def_prop_ro("dropped_frames", &SoraAudioRecorderImpl::GetDroppedFrames)
+      .def_prop_ro("metrics", &SoraAudioRecorderImpl::GetMetrics);
+
+  nb::class_<SoraVideoRecorderImpl>(m, "SoraVideoRecorderImpl")
+      .def(nb::init<SoraTrackInterface*, const std::string&, const std::string&,
+                    float, size_t>(),
+           "track"_a, "path"_a, "format"_a = "Y4M", "fps"_a = 30,
+           "queue_size"_a = 30)
+      .def("__del__", &SoraVideoRecorderImpl::Del)
+      .def("close", &SoraVideoRecorderImpl::Close)
+      .def_prop_ro("bytes_written", &SoraVideoRecorderImpl::GetBytesWritten)
+      .def_prop_ro("dropped_frames", &SoraVideoRecorderImpl::GetDroppedFrames)
+      .def_prop_ro("metrics", &SoraVideoRecorderImpl::GetMetrics);
+
   nb::class_<SoraConnection>(m, "SoraConnection",
                              nb::type_slots(connection_slots))
       .def("connect", &SoraConnection::Connect)
       .def("disconnect", &SoraConnection::Disconnect)
+      .def("get_stats", &SoraConnection::GetStats)
+      .def("send_data", &SoraConnection::SendData, "label"_a, "data"_a)
+      .def_rw("stats_interval", &SoraConnection::stats_interval_)
       .def_rw("on_set_offer", &SoraConnection::on_set_offer_)
       .def_rw("on_disconnect", &SoraConnection::on_disconnect_)
       .def_rw("on_notify", &SoraConnection::on_notify_)
       .def_rw("on_push", &SoraConnection::on_push_)
       .def_rw("on_message", &SoraConnection::on_message_)
+      .def_rw("on_message_bytes", &SoraConnection::on_message_bytes_)
       .def_rw("on_track", &SoraConnection::on_track_)
-      .def_rw("on_data_channel", &SoraConnection::on_data_channel_);
+      .def_rw("on_data_channel", &SoraConnection::on_data_channel_)
+      .def_rw("on_stats", &SoraConnection::on_stats_);
 
   nb::class_<Sora>(m, "Sora")
-      .def(nb::init<bool>(), "use_hardware_encoder"_a = false)
+      .def(nb::init<bool, bool, size_t>(), "use_hardware_encoder"_a = false,
+           "use_callback_thread"_a = false, "io_threads"_a = 0)
       .def("create_connection", &Sora::CreateConnection, "signaling_url"_a,
            "role"_a, "channel_id"_a, "client_id"_a = "", "metadata"_a = "",
-           "audio_source"_a = nb::none(), "video_source"_a = nb::none())
-      .def("create_audio_source", &Sora::CreateAudioSource)
-      .def("create_video_source", &Sora::CreateVideoSource);
+           "audio_source"_a = nb::none(), "video_source"_a = nb::none(),
+           "audio"_a = true, "video"_a = true, "audio_codec_type"_a = "OPUS",
+           "video_codec_type"_a = "VP8", "audio_bit_rate"_a = 0,
+           "video_bit_rate"_a = 0)
+      .def("create_audio_source", &Sora::CreateAudioSource, "channels"_a,
+           "sample_rate"_a, "paced"_a = false, "max_buffer_ms"_a = 1000)
+      .def("create_video_source", &Sora::CreateVideoSource,
+           "max_queue_size"_a = 0, "queue_policy"_a = "drop_oldest",
+           "scheduled"_a = false, "late_frame_policy"_a = "drop")
+      .def("create_video_loopback", &Sora::CreateVideoLoopback, "source"_a,
+           "codec_type"_a = "", "bit_rate"_a = 0)
+      .def("create_audio_loopback", &Sora::CreateAudioLoopback, "source"_a,
+           "codec_type"_a = "", "bit_rate"_a = 0);
 }
\ No newline at end of file
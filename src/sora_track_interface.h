@@ -1,11 +1,14 @@
 #ifndef SORA_TRACK_INTERFACE_H_
 #define SORA_TRACK_INTERFACE_H_
 
+#include <memory>
+
 // WebRTC
 #include <api/media_stream_interface.h>
 #include <api/scoped_refptr.h>
 
 #include "dispose_listener.h"
+#include "sora_callback_dispatcher.h"
 
 class SoraTrackInterface : public DisposePublisher, public DisposeSubscriber {
  public:
@@ -30,6 +33,14 @@ class SoraTrackInterface : public DisposePublisher, public DisposeSubscriber {
   rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> GetTrack() {
     return track_;
   }
+  // この Track に繋いだ Sink のコールバックを呼び出す Dispatcher 、使わない場合は nullptr
+  std::shared_ptr<SoraCallbackDispatcher> GetCallbackDispatcher() {
+    return dispatcher_;
+  }
+  void SetCallbackDispatcher(
+      std::shared_ptr<SoraCallbackDispatcher> dispatcher) {
+    dispatcher_ = dispatcher;
+  }
 
   virtual void Disposed() override {
     DisposePublisher::Disposed();
@@ -41,6 +52,7 @@ class SoraTrackInterface : public DisposePublisher, public DisposeSubscriber {
  protected:
   DisposePublisher* publisher_;
   rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track_;
+  std::shared_ptr<SoraCallbackDispatcher> dispatcher_;
 };
 
 #endif
\ No newline at end of file
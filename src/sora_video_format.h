@@ -0,0 +1,41 @@
+#ifndef SORA_VIDEO_FORMAT_H_
+#define SORA_VIDEO_FORMAT_H_
+
+#include <string>
+
+// nonobind
+#include <nanobind/nanobind.h>
+
+namespace nb = nanobind;
+
+// Python とやり取りする ndarray の画素フォーマット
+enum class SoraVideoFormat {
+  kBGR,
+  kRGB,
+  kRGBA,
+  kBGRA,
+  kGRAY,
+  kI420,
+  kNV12,
+};
+
+inline SoraVideoFormat ParseSoraVideoFormat(const std::string& format) {
+  if (format == "BGR") {
+    return SoraVideoFormat::kBGR;
+  } else if (format == "RGB") {
+    return SoraVideoFormat::kRGB;
+  } else if (format == "RGBA") {
+    return SoraVideoFormat::kRGBA;
+  } else if (format == "BGRA") {
+    return SoraVideoFormat::kBGRA;
+  } else if (format == "GRAY") {
+    return SoraVideoFormat::kGRAY;
+  } else if (format == "I420") {
+    return SoraVideoFormat::kI420;
+  } else if (format == "NV12") {
+    return SoraVideoFormat::kNV12;
+  }
+  throw nb::value_error(("Invalid video format: " + format).c_str());
+}
+
+#endif
@@ -1,33 +1,250 @@
 #include "sora_video_sink.h"
 
+#include <algorithm>
+#include <cmath>
+
 // WebRTC
 #include <api/video/i420_buffer.h>
+#include <rtc_base/time_utils.h>
 #include <third_party/libyuv/include/libyuv.h>
 
 SoraVideoFrame::SoraVideoFrame(
-    rtc::scoped_refptr<webrtc::I420BufferInterface> i420_data)
-    : width_(i420_data->width()), height_(i420_data->height()) {
-  argb_data_ = std::unique_ptr<uint8_t>(new uint8_t[width_ * height_ * 3]);
-  libyuv::ConvertFromI420(
-      i420_data->DataY(), i420_data->StrideY(), i420_data->DataU(),
-      i420_data->StrideU(), i420_data->DataV(), i420_data->StrideV(),
-      argb_data_.get(), width_ * 3, width_, height_, libyuv::FOURCC_24BG);
+    rtc::scoped_refptr<webrtc::VideoFrameBuffer> buffer,
+    SoraVideoFormat format,
+    std::shared_ptr<SoraLatencyHistogram> convert_latency)
+    : width_(buffer->width()),
+      height_(buffer->height()),
+      format_(format),
+      convert_latency_(convert_latency),
+      buffer_(buffer),
+      data_ndim_(0) {}
+
+nb::ndarray<nb::numpy, uint8_t> SoraVideoFrame::Data() {
+  // 変換は data() が呼ばれた時に初めて行い、結果はフレームに保持する
+  if (!data_) {
+    SoraLatencyTimer timer(*convert_latency_);
+    Convert();
+  }
+  return nb::ndarray<nb::numpy, uint8_t>(data_.get(), data_ndim_, data_shape_);
+}
+
+nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>>
+SoraVideoFrame::Y() {
+  if (buffer_->type() == webrtc::VideoFrameBuffer::Type::kNV12) {
+    // NV12 の Y 平面は I420 と同じなので変換せずにそのまま返す
+    const webrtc::NV12BufferInterface* nv12 = buffer_->GetNV12();
+    return Plane(buffer_, nv12->DataY(), width_, height_, nv12->StrideY());
+  }
+  rtc::scoped_refptr<webrtc::I420BufferInterface> i420 = GetI420();
+  return Plane(i420, i420->DataY(), width_, height_, i420->StrideY());
+}
+
+nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>>
+SoraVideoFrame::U() {
+  rtc::scoped_refptr<webrtc::I420BufferInterface> i420 = GetI420();
+  return Plane(i420, i420->DataU(), i420->ChromaWidth(), i420->ChromaHeight(),
+               i420->StrideU());
 }
 
-nb::ndarray<nb::numpy, uint8_t, nb::shape<nb::any, nb::any, 3>>
-SoraVideoFrame::Data() {
-  size_t shape[3] = {static_cast<size_t>(height_), static_cast<size_t>(width_),
-                     3};
-  return nb::ndarray<nb::numpy, uint8_t, nb::shape<nb::any, nb::any, 3>>(
-      argb_data_.get(), 3, shape);
+nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>>
+SoraVideoFrame::V() {
+  rtc::scoped_refptr<webrtc::I420BufferInterface> i420 = GetI420();
+  return Plane(i420, i420->DataV(), i420->ChromaWidth(), i420->ChromaHeight(),
+               i420->StrideV());
 }
 
-SoraVideoSinkImpl::SoraVideoSinkImpl(SoraTrackInterface* track)
-    : track_(track) {
+rtc::scoped_refptr<webrtc::I420BufferInterface> SoraVideoFrame::GetI420() {
+  // デコーダーが I420 を出力している場合 ToI420 はコピーせずに自身を返す
+  if (!i420_buffer_) {
+    i420_buffer_ = buffer_->ToI420();
+  }
+  return i420_buffer_;
+}
+
+void SoraVideoFrame::Convert() {
+  const int chroma_width = (width_ + 1) / 2;
+  const int chroma_height = (height_ + 1) / 2;
+
+  if (format_ == SoraVideoFormat::kGRAY || format_ == SoraVideoFormat::kNV12) {
+    // GRAY と NV12 は Y 平面をそのまま使えるため NV12 のバッファは I420 にしない
+    const uint8_t* src_y;
+    int src_stride_y;
+    const webrtc::NV12BufferInterface* nv12 = nullptr;
+    rtc::scoped_refptr<webrtc::I420BufferInterface> i420;
+    if (buffer_->type() == webrtc::VideoFrameBuffer::Type::kNV12) {
+      nv12 = buffer_->GetNV12();
+      src_y = nv12->DataY();
+      src_stride_y = nv12->StrideY();
+    } else {
+      i420 = GetI420();
+      src_y = i420->DataY();
+      src_stride_y = i420->StrideY();
+    }
+
+    if (format_ == SoraVideoFormat::kGRAY) {
+      data_.reset(new uint8_t[width_ * height_]);
+      libyuv::CopyPlane(src_y, src_stride_y, data_.get(), width_, width_,
+                        height_);
+      data_ndim_ = 2;
+      data_shape_[0] = height_;
+      data_shape_[1] = width_;
+      return;
+    }
+
+    // 奇数幅の場合も UV の 1 行が収まるように、行の幅は UV に合わせる
+    const int stride = chroma_width * 2;
+    data_.reset(new uint8_t[stride * (height_ + chroma_height)]);
+    uint8_t* dst_y = data_.get();
+    uint8_t* dst_uv = data_.get() + stride * height_;
+    if (nv12) {
+      libyuv::CopyPlane(src_y, src_stride_y, dst_y, stride, width_, height_);
+      libyuv::CopyPlane(nv12->DataUV(), nv12->StrideUV(), dst_uv, stride,
+                        chroma_width * 2, chroma_height);
+    } else {
+      libyuv::I420ToNV12(src_y, src_stride_y, i420->DataU(), i420->StrideU(),
+                         i420->DataV(), i420->StrideV(), dst_y, stride, dst_uv,
+                         stride, width_, height_);
+    }
+    data_ndim_ = 2;
+    data_shape_[0] = height_ + chroma_height;
+    data_shape_[1] = stride;
+    return;
+  }
+
+  if (format_ == SoraVideoFormat::kI420) {
+    // 3 つの平面を (height * 3 / 2, width) の 1 枚の ndarray に詰める
+    rtc::scoped_refptr<webrtc::I420BufferInterface> i420 = GetI420();
+    const int stride_uv = chroma_width;
+    data_.reset(new uint8_t[width_ * height_ + stride_uv * chroma_height * 2]);
+    uint8_t* dst_y = data_.get();
+    uint8_t* dst_u = dst_y + width_ * height_;
+    uint8_t* dst_v = dst_u + stride_uv * chroma_height;
+    libyuv::I420Copy(i420->DataY(), i420->StrideY(), i420->DataU(),
+                     i420->StrideU(), i420->DataV(), i420->StrideV(), dst_y,
+                     width_, dst_u, stride_uv, dst_v, stride_uv, width_,
+                     height_);
+    data_ndim_ = 1;
+    data_shape_[0] = width_ * height_ + stride_uv * chroma_height * 2;
+    if (width_ % 2 == 0 && height_ % 2 == 0) {
+      data_ndim_ = 2;
+      data_shape_[0] = height_ * 3 / 2;
+      data_shape_[1] = width_;
+    }
+    return;
+  }
+
+  int channels;
+  uint32_t fourcc;
+  switch (format_) {
+    case SoraVideoFormat::kRGB:
+      channels = 3;
+      fourcc = libyuv::FOURCC_RAW;
+      break;
+    case SoraVideoFormat::kRGBA:
+      // libyuv の ABGR はメモリ上で R, G, B, A の順に並ぶ
+      channels = 4;
+      fourcc = libyuv::FOURCC_ABGR;
+      break;
+    case SoraVideoFormat::kBGRA:
+      // libyuv の ARGB はメモリ上で B, G, R, A の順に並ぶ
+      channels = 4;
+      fourcc = libyuv::FOURCC_ARGB;
+      break;
+    default:
+      channels = 3;
+      fourcc = libyuv::FOURCC_24BG;
+      break;
+  }
+  rtc::scoped_refptr<webrtc::I420BufferInterface> i420 = GetI420();
+  data_.reset(new uint8_t[width_ * height_ * channels]);
+  libyuv::ConvertFromI420(i420->DataY(), i420->StrideY(), i420->DataU(),
+                          i420->StrideU(), i420->DataV(), i420->StrideV(),
+                          data_.get(), width_ * channels, width_, height_,
+                          fourcc);
+  data_ndim_ = 3;
+  data_shape_[0] = height_;
+  data_shape_[1] = width_;
+  data_shape_[2] = channels;
+}
+
+nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>>
+SoraVideoFrame::Plane(rtc::scoped_refptr<webrtc::VideoFrameBuffer> owner,
+                      const uint8_t* data,
+                      int width,
+                      int height,
+                      int stride) {
+  // ndarray が生きている間はバッファを解放しないように参照を capsule に持たせる
+  // バッファは同じ Track の他の Sink や Recorder と共有しているので、書き込みできない ndarray にする
+  auto* ref = new rtc::scoped_refptr<webrtc::VideoFrameBuffer>(owner);
+  nb::capsule deleter(ref, [](void* p) noexcept {
+    delete reinterpret_cast<rtc::scoped_refptr<webrtc::VideoFrameBuffer>*>(p);
+  });
+  size_t shape[2] = {static_cast<size_t>(height), static_cast<size_t>(width)};
+  int64_t strides[2] = {stride, 1};
+  return nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>>(
+      data, 2, shape, deleter, strides);
+}
+
+SoraVideoSinkImpl::SoraVideoSinkImpl(SoraTrackInterface* track,
+                                     const std::string& format,
+                                     size_t queue_size,
+                                     const std::string& drop_policy,
+                                     int max_width,
+                                     int max_height,
+                                     float max_fps,
+                                     nb::handle crop)
+    : track_(track),
+      dispatcher_(track->GetCallbackDispatcher()),
+      format_(ParseSoraVideoFormat(format)),
+      queue_size_(queue_size),
+      drop_policy_(ParseDropPolicy(drop_policy)),
+      max_width_(max_width),
+      max_height_(max_height),
+      frame_interval_us_(max_fps > 0 ? (int64_t)(1000000 / max_fps) : 0),
+      crop_(false),
+      crop_x_(0),
+      crop_y_(0),
+      crop_width_(0),
+      crop_height_(0),
+      next_frame_us_(0),
+      buffer_pool_(false, queue_size + kBufferPoolMargin),
+      dropped_frames_(0),
+      notify_enabled_(false),
+      convert_latency_(std::make_shared<SoraLatencyHistogram>()) {
+  if (max_width < 0 || max_height < 0 || max_fps < 0) {
+    throw nb::value_error(
+        "max_width, max_height and max_fps must not be negative");
+  }
+  if (!crop.is_none()) {
+    // crop は (x, y, width, height) で、入力のフレームの座標で指定する
+    if (!nb::isinstance<nb::tuple>(crop) || nb::len(crop) != 4) {
+      throw nb::value_error("crop must be (x, y, width, height)");
+    }
+    nb::tuple rect = nb::borrow<nb::tuple>(crop);
+    crop_x_ = nb::cast<int>(rect[0]);
+    crop_y_ = nb::cast<int>(rect[1]);
+    crop_width_ = nb::cast<int>(rect[2]);
+    crop_height_ = nb::cast<int>(rect[3]);
+    if (crop_x_ < 0 || crop_y_ < 0 || crop_width_ <= 0 || crop_height_ <= 0) {
+      throw nb::value_error("Invalid crop");
+    }
+    crop_ = true;
+  }
+
   track_->AddSubscriber(this);
   webrtc::VideoTrackInterface* video_track =
       static_cast<webrtc::VideoTrackInterface*>(track_->GetTrack().get());
-  video_track->AddOrUpdateSink(this, rtc::VideoSinkWants());
+  // Source が対応していれば、ここで指定した解像度とフレームレートに落としてから渡してくれる
+  // 切り出す場合は座標が入力の解像度のものなので、解像度は落とさせない
+  // 受信した Track は指定を無視するので、いずれにしても OnFrame で間引いて縮小する
+  rtc::VideoSinkWants wants;
+  if (!crop_ && max_width_ > 0 && max_height_ > 0) {
+    wants.max_pixel_count = max_width_ * max_height_;
+  }
+  if (max_fps > 0) {
+    wants.max_framerate_fps = (int)std::ceil(max_fps);
+  }
+  video_track->AddOrUpdateSink(this, wants);
 }
 
 SoraVideoSinkImpl::~SoraVideoSinkImpl() {
@@ -39,6 +256,10 @@ void SoraVideoSinkImpl::Del() {
     track_->RemoveSubscriber(this);
   }
   Disposed();
+  if (dispatcher_) {
+    // Sink を外した後なので、これ以上コールバックが積まれることはない
+    dispatcher_->Cancel(this);
+  }
 }
 
 void SoraVideoSinkImpl::Disposed() {
@@ -48,6 +269,8 @@ void SoraVideoSinkImpl::Disposed() {
     video_track->RemoveSink(this);
   }
   track_ = nullptr;
+  std::lock_guard<std::mutex> lock(queue_mtx_);
+  queue_.clear();
 }
 
 void SoraVideoSinkImpl::PubliserDisposed() {
@@ -57,9 +280,210 @@ void SoraVideoSinkImpl::PubliserDisposed() {
 void SoraVideoSinkImpl::OnFrame(const webrtc::VideoFrame& frame) {
   if (frame.width() == 0 || frame.height() == 0)
     return;
+  frames_in_.Add();
+  if (!on_frame_ && queue_size_ == 0 && !notify_enabled_)
+    return;
+  // 捨てるフレームは縮小も SoraVideoFrame の生成もしない
+  if (SkipFrame(frame)) {
+    skipped_frames_.Add();
+    return;
+  }
+  // ここでは出力のフォーマットへの変換はせず、切り出しと縮小だけを行って SoraVideoFrame に渡す
+  auto video_frame = std::make_shared<SoraVideoFrame>(
+      CropAndScale(frame.video_frame_buffer()), format_, convert_latency_);
+  // キューと on_frame の両方に渡しても 1 フレームとして数える
+  frames_out_.Add();
+  if (queue_size_ > 0 || notify_enabled_) {
+    // キューに積むだけで Python は呼ばないので、デコードのスレッドが GIL を待つのは
+    // キューが空でなくなって notify を呼ぶ時だけになる
+    bool notify = false;
+    {
+      std::lock_guard<std::mutex> lock(queue_mtx_);
+      notify = notify_enabled_ && queue_.empty();
+      const size_t queue_size = queue_size_ > 0 ? queue_size_ : 1;
+      const DropPolicy drop_policy =
+          queue_size_ > 0 ? drop_policy_ : DropPolicy::kKeepLatest;
+      if (drop_policy == DropPolicy::kKeepLatest) {
+        dropped_frames_ += queue_.size();
+        queue_.clear();
+        queue_.push_back(video_frame);
+      } else if (queue_.size() < queue_size) {
+        queue_.push_back(video_frame);
+      } else if (drop_policy == DropPolicy::kDropOldest) {
+        dropped_frames_++;
+        queue_.pop_front();
+        queue_.push_back(video_frame);
+      } else {
+        dropped_frames_++;
+      }
+    }
+    queue_cond_.notify_all();
+    if (notify) {
+      CallNotify();
+    }
+  }
   if (on_frame_) {
-    rtc::scoped_refptr<webrtc::I420BufferInterface> i420_data =
-        frame.video_frame_buffer()->ToI420();
-    on_frame_(std::make_shared<SoraVideoFrame>(i420_data));
+    if (dispatcher_) {
+      dispatcher_->Post(this,
+                        [this, video_frame]() { CallOnFrame(video_frame); });
+    } else {
+      CallOnFrame(video_frame);
+    }
+  }
+}
+
+bool SoraVideoSinkImpl::SkipFrame(const webrtc::VideoFrame& frame) {
+  if (frame_interval_us_ == 0) {
+    return false;
+  }
+  int64_t now_us =
+      frame.timestamp_us() != 0 ? frame.timestamp_us() : rtc::TimeMicros();
+  // 入力のフレームの間隔の揺らぎで間引きすぎないように、間隔の 1/4 までは早くても通す
+  if (next_frame_us_ != 0 && now_us < next_frame_us_ - frame_interval_us_ / 4) {
+    return true;
+  }
+  if (next_frame_us_ == 0 || now_us > next_frame_us_ + frame_interval_us_) {
+    // 最初のフレームと、間が空いた後は今のフレームから数え直す
+    next_frame_us_ = now_us + frame_interval_us_;
+  } else {
+    next_frame_us_ += frame_interval_us_;
+  }
+  return false;
+}
+
+rtc::scoped_refptr<webrtc::VideoFrameBuffer> SoraVideoSinkImpl::CropAndScale(
+    rtc::scoped_refptr<webrtc::VideoFrameBuffer> buffer) {
+  int x = 0;
+  int y = 0;
+  int width = buffer->width();
+  int height = buffer->height();
+  if (crop_) {
+    // フレームからはみ出す分は切り詰める
+    x = std::min(crop_x_, buffer->width() - 1);
+    y = std::min(crop_y_, buffer->height() - 1);
+    width = std::min(crop_width_, buffer->width() - x);
+    height = std::min(crop_height_, buffer->height() - y);
+  }
+  // アスペクト比を保ったまま max_width, max_height に収まるように縮小する、拡大はしない
+  double scale = 1.0;
+  if (max_width_ > 0 && width > max_width_) {
+    scale = std::min(scale, (double)max_width_ / width);
+  }
+  if (max_height_ > 0 && height > max_height_) {
+    scale = std::min(scale, (double)max_height_ / height);
+  }
+  int scaled_width = std::max(1, (int)(width * scale));
+  int scaled_height = std::max(1, (int)(height * scale));
+  if (x == 0 && y == 0 && width == buffer->width() &&
+      height == buffer->height() && scaled_width == width &&
+      scaled_height == height) {
+    return buffer;
+  }
+
+  SoraLatencyTimer timer(scale_latency_);
+  if (buffer->type() != webrtc::VideoFrameBuffer::Type::kI420) {
+    // NV12 などは VideoFrameBuffer がそれぞれのフォーマットのまま切り出しと縮小を行う
+    return buffer->CropAndScale(x, y, width, height, scaled_width,
+                                scaled_height);
+  }
+  // I420 はプールしたバッファに libyuv の I420Scale で直接切り出して縮小する
+  rtc::scoped_refptr<webrtc::I420Buffer> scaled =
+      buffer_pool_.CreateI420Buffer(scaled_width, scaled_height);
+  if (!scaled) {
+    // Python がフレームを保持していてプールが枯渇した場合は新たに確保する
+    scaled = webrtc::I420Buffer::Create(scaled_width, scaled_height);
+  }
+  scaled->CropAndScaleFrom(*buffer->GetI420(), x, y, width, height);
+  return scaled;
+}
+
+void SoraVideoSinkImpl::CallOnFrame(std::shared_ptr<SoraVideoFrame> frame) {
+  if (!on_frame_) {
+    return;
+  }
+  // GIL の取得を待つ時間も含めて記録する
+  SoraLatencyTimer timer(callback_latency_);
+  on_frame_(frame);
+}
+
+void SoraVideoSinkImpl::SetNotify(std::function<void()> notify) {
+  notify_ = std::move(notify);
+  notify_enabled_ = (bool)notify_;
+}
+
+void SoraVideoSinkImpl::CallNotify() {
+  auto call = [this]() {
+    if (notify_) {
+      notify_();
+    }
+  };
+  if (dispatcher_) {
+    dispatcher_->Post(this, std::move(call));
+  } else {
+    // notify_ は Python から差し替えられるので、 GIL を取ってから触る
+    nb::gil_scoped_acquire acquire;
+    call();
+  }
+}
+
+nb::tuple SoraVideoSinkImpl::Read(float timeout) {
+  std::unique_lock<std::mutex> lock(queue_mtx_);
+  if (!WaitFrame(lock, timeout)) {
+    return nb::make_tuple(false, nb::none());
+  }
+  std::shared_ptr<SoraVideoFrame> frame = std::move(queue_.front());
+  queue_.pop_front();
+  return nb::make_tuple(true, frame);
+}
+
+nb::tuple SoraVideoSinkImpl::ReadLatest(float timeout) {
+  std::unique_lock<std::mutex> lock(queue_mtx_);
+  if (!WaitFrame(lock, timeout)) {
+    return nb::make_tuple(false, nb::none());
+  }
+  // 最新のフレーム以外は読まずに捨てる
+  std::shared_ptr<SoraVideoFrame> frame = std::move(queue_.back());
+  dropped_frames_ += queue_.size() - 1;
+  queue_.clear();
+  return nb::make_tuple(true, frame);
+}
+
+uint64_t SoraVideoSinkImpl::GetDroppedFrames() {
+  std::lock_guard<std::mutex> lock(queue_mtx_);
+  return dropped_frames_;
+}
+
+nb::dict SoraVideoSinkImpl::GetMetrics() {
+  nb::dict metrics;
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_out"] = nb::cast(frames_out_.Get());
+  metrics["skipped_frames"] = nb::cast(skipped_frames_.Get());
+  {
+    std::lock_guard<std::mutex> lock(queue_mtx_);
+    metrics["dropped_frames"] = nb::cast(dropped_frames_);
+    metrics["queue_depth"] = nb::cast(queue_.size());
+  }
+  metrics["convert_latency"] = convert_latency_->ToDict();
+  metrics["scale_latency"] = scale_latency_.ToDict();
+  metrics["callback_latency"] = callback_latency_.ToDict();
+  return metrics;
+}
+
+bool SoraVideoSinkImpl::WaitFrame(std::unique_lock<std::mutex>& lock,
+                                  float timeout) {
+  // 待っている間は GIL を解放し、他の Python スレッドを止めないようにする
+  return WaitWithGilReleased(lock, queue_cond_, timeout,
+                             [&] { return !queue_.empty(); });
+}
+
+SoraVideoSinkImpl::DropPolicy SoraVideoSinkImpl::ParseDropPolicy(
+    const std::string& drop_policy) {
+  if (drop_policy == "drop_oldest") {
+    return DropPolicy::kDropOldest;
+  } else if (drop_policy == "drop_newest") {
+    return DropPolicy::kDropNewest;
+  } else if (drop_policy == "keep_latest") {
+    return DropPolicy::kKeepLatest;
   }
+  throw nb::value_error(("Invalid drop_policy: " + drop_policy).c_str());
 }
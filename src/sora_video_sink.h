@@ -1,7 +1,11 @@
 #ifndef SORA_VIDEO_SINK_H_
 #define SORA_VIDEO_SINK_H_
 
+#include <atomic>
+#include <condition_variable>
+#include <deque>
 #include <memory>
+#include <mutex>
 
 // nonobind
 #include <nanobind/nanobind.h>
@@ -12,33 +16,77 @@
 #include <api/media_stream_interface.h>
 #include <api/scoped_refptr.h>
 #include <api/video/video_frame.h>
+#include <api/video/video_frame_buffer.h>
 #include <api/video/video_sink_interface.h>
+#include <common_video/include/video_frame_buffer_pool.h>
 
+#include "gil_wait.h"
+#include "sora_metrics.h"
 #include "sora_track_interface.h"
+#include "sora_video_format.h"
 
 namespace nb = nanobind;
 
 class SoraVideoFrame {
  public:
-  SoraVideoFrame(rtc::scoped_refptr<webrtc::I420BufferInterface> i420_data);
+  SoraVideoFrame(rtc::scoped_refptr<webrtc::VideoFrameBuffer> buffer,
+                 SoraVideoFormat format,
+                 std::shared_ptr<SoraLatencyHistogram> convert_latency);
 
-  nb::ndarray<nb::numpy, uint8_t, nb::shape<nb::any, nb::any, 3>> Data();
+  int width() const { return width_; }
+  int height() const { return height_; }
+
+  nb::ndarray<nb::numpy, uint8_t> Data();
+  nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>> Y();
+  nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>> U();
+  nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>> V();
 
  private:
+  rtc::scoped_refptr<webrtc::I420BufferInterface> GetI420();
+  void Convert();
+  nb::ndarray<nb::numpy, const uint8_t, nb::shape<nb::any, nb::any>> Plane(
+      rtc::scoped_refptr<webrtc::VideoFrameBuffer> owner,
+      const uint8_t* data,
+      int width,
+      int height,
+      int stride);
+
   const int width_;
   const int height_;
-  std::unique_ptr<uint8_t> argb_data_;
+  const SoraVideoFormat format_;
+  // Sink が先に破棄されても記録できるように shared_ptr で持つ
+  std::shared_ptr<SoraLatencyHistogram> convert_latency_;
+  rtc::scoped_refptr<webrtc::VideoFrameBuffer> buffer_;
+  rtc::scoped_refptr<webrtc::I420BufferInterface> i420_buffer_;
+  std::unique_ptr<uint8_t[]> data_;
+  size_t data_ndim_;
+  size_t data_shape_[3];
 };
 
 class SoraVideoSinkImpl : public rtc::VideoSinkInterface<webrtc::VideoFrame>,
                           public DisposeSubscriber {
  public:
-  SoraVideoSinkImpl(SoraTrackInterface* track);
+  SoraVideoSinkImpl(SoraTrackInterface* track,
+                    const std::string& format,
+                    size_t queue_size,
+                    const std::string& drop_policy,
+                    int max_width,
+                    int max_height,
+                    float max_fps,
+                    nb::handle crop);
   ~SoraVideoSinkImpl();
 
   void Del();
   void Disposed();
 
+  nb::tuple Read(float timeout);
+  nb::tuple ReadLatest(float timeout);
+  uint64_t GetDroppedFrames();
+  nb::dict GetMetrics();
+  // キューが空でなくなった時に notify を呼ぶ、フレームは渡さないので read で読む
+  // queue_size が 0 の場合は、 notify を設定している間だけ最新の 1 フレームを保持する
+  void SetNotify(std::function<void()> notify);
+
   // rtc::VideoSinkInterface
   void OnFrame(const webrtc::VideoFrame& frame) override;
 
@@ -47,9 +95,55 @@ class SoraVideoSinkImpl : public rtc::VideoSinkInterface<webrtc::VideoFrame>,
 
   // このコールバックは shared_ptr にしないとリークする
   std::function<void(std::shared_ptr<SoraVideoFrame>)> on_frame_;
+  // GIL を持っている間だけ触る
+  std::function<void()> notify_;
 
  private:
+  enum class DropPolicy {
+    kDropOldest,
+    kDropNewest,
+    kKeepLatest,
+  };
+  static DropPolicy ParseDropPolicy(const std::string& drop_policy);
+  bool WaitFrame(std::unique_lock<std::mutex>& lock, float timeout);
+  void CallOnFrame(std::shared_ptr<SoraVideoFrame> frame);
+  void CallNotify();
+  bool SkipFrame(const webrtc::VideoFrame& frame);
+  rtc::scoped_refptr<webrtc::VideoFrameBuffer> CropAndScale(
+      rtc::scoped_refptr<webrtc::VideoFrameBuffer> buffer);
+
+  // 出力したフレームを Python が保持している間も次のフレームを変換できるように余裕を持たせる
+  static constexpr int kBufferPoolMargin = 4;
+
   SoraTrackInterface* track_;
+  std::shared_ptr<SoraCallbackDispatcher> dispatcher_;
+  const SoraVideoFormat format_;
+  const size_t queue_size_;
+  const DropPolicy drop_policy_;
+  const int max_width_;
+  const int max_height_;
+  // max_fps から求めたフレームの間隔、0 の場合は間引かない
+  const int64_t frame_interval_us_;
+  bool crop_;
+  int crop_x_;
+  int crop_y_;
+  int crop_width_;
+  int crop_height_;
+  // 以下はデコードのスレッドからのみ触る
+  int64_t next_frame_us_;
+  webrtc::VideoFrameBufferPool buffer_pool_;
+  std::mutex queue_mtx_;
+  std::condition_variable queue_cond_;
+  std::deque<std::shared_ptr<SoraVideoFrame>> queue_;
+  uint64_t dropped_frames_;
+  std::atomic<bool> notify_enabled_;
+  SoraCounter frames_in_;
+  // 間引かずにキューか on_frame に渡したフレーム数
+  SoraCounter frames_out_;
+  SoraCounter skipped_frames_;
+  std::shared_ptr<SoraLatencyHistogram> convert_latency_;
+  SoraLatencyHistogram scale_latency_;
+  SoraLatencyHistogram callback_latency_;
 };
 
-#endif
\ No newline at end of file
+#endif
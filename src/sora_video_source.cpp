@@ -1,7 +1,8 @@
 #include "sora_video_source.h"
 
+#include "gil_wait.h"
+
 // WebRTC
-#include <api/video/i420_buffer.h>
 #include <rtc_base/helpers.h>
 #include <rtc_base/time_utils.h>
 #include <third_party/libyuv/include/libyuv.h>
@@ -9,8 +10,24 @@
 SoraVideoSource::SoraVideoSource(
     DisposePublisher* publisher,
     rtc::scoped_refptr<sora::ScalableVideoTrackSource> source,
-    rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track)
-    : SoraTrackInterface(publisher, track), source_(source), finished_(false) {
+    rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
+    size_t max_queue_size,
+    const std::string& queue_policy,
+    bool scheduled,
+    const std::string& late_frame_policy)
+    : SoraTrackInterface(publisher, track),
+      source_(source),
+      // 変換で全画素を上書きするのでバッファをゼロで初期化する必要はない
+      buffer_pool_(false, max_queue_size + kBufferPoolMargin),
+      max_queue_size_(max_queue_size),
+      queue_policy_(ParseQueuePolicy(queue_policy)),
+      scheduled_(scheduled),
+      late_frame_policy_(ParseLateFramePolicy(late_frame_policy)),
+      schedule_started_(false),
+      schedule_origin_us_(0),
+      enqueued_frames_(0),
+      dropped_frames_(0),
+      finished_(false) {
   publisher_->AddSubscriber(this);
   thread_.reset(new std::thread([this]() {
     while (SendFrameProcess()) {
@@ -24,7 +41,13 @@ void SoraVideoSource::Disposed() {
     finished_ = true;
     lock.unlock();
     queue_cond_.notify_all();
-    thread_->join();
+    // 送信のスレッドが Sink のコールバックで GIL を待っているかもしれないので、解放してから待つ
+    if (PyGILState_Check()) {
+      nb::gil_scoped_release release;
+      thread_->join();
+    } else {
+      thread_->join();
+    }
     thread_ = nullptr;
   }
   SoraTrackInterface::Disposed();
@@ -34,40 +57,225 @@ void SoraVideoSource::PubliserDisposed() {
   Disposed();
 }
 
-void SoraVideoSource::OnCaptured(nb::ndarray<uint8_t,
-                                             nb::shape<nb::any, nb::any, 3>,
-                                             nb::c_contig,
-                                             nb::device::cpu> ndarray) {
-  OnCaptured(ndarray, rtc::TimeMicros());
+bool SoraVideoSource::OnCaptured(nb::ndarray<uint8_t, nb::device::cpu> ndarray,
+                                 const std::string& format) {
+  return OnCaptured(ndarray, rtc::TimeMicros(), format);
 }
 
-void SoraVideoSource::OnCaptured(nb::ndarray<uint8_t,
-                                             nb::shape<nb::any, nb::any, 3>,
-                                             nb::c_contig,
-                                             nb::device::cpu> ndarray,
-                                 double timestamp) {
-  OnCaptured(ndarray, (int64_t)(timestamp * 1000000));
+bool SoraVideoSource::OnCaptured(nb::ndarray<uint8_t, nb::device::cpu> ndarray,
+                                 double timestamp,
+                                 const std::string& format) {
+  return OnCaptured(ndarray, (int64_t)(timestamp * 1000000), format);
 }
 
-void SoraVideoSource::OnCaptured(nb::ndarray<uint8_t,
-                                             nb::shape<nb::any, nb::any, 3>,
-                                             nb::c_contig,
-                                             nb::device::cpu> ndarray,
-                                 int64_t timestamp_us) {
+bool SoraVideoSource::OnCaptured(nb::ndarray<uint8_t, nb::device::cpu> ndarray,
+                                 int64_t timestamp_us,
+                                 const std::string& format) {
+  frames_in_.Add();
+  SoraVideoFormat video_format = ParseSoraVideoFormat(format);
+  int channels = 0;
+  switch (video_format) {
+    case SoraVideoFormat::kBGR:
+    case SoraVideoFormat::kRGB:
+      channels = 3;
+      break;
+    case SoraVideoFormat::kRGBA:
+    case SoraVideoFormat::kBGRA:
+      channels = 4;
+      break;
+    default:
+      break;
+  }
+  // 行ごとのストライドを使って変換するので、行の中で画素が詰まっていれば
+  // 切り出した ndarray のように行の間が空いていてもよい
+  if (channels > 0) {
+    if (ndarray.ndim() != 3 || (int)ndarray.shape(2) != channels ||
+        ndarray.stride(1) != channels || ndarray.stride(2) != 1) {
+      throw nb::value_error(("ndarray must have shape (height, width, " +
+                             std::to_string(channels) +
+                             ") with contiguous pixels for " + format)
+                                .c_str());
+    }
+  } else if (ndarray.ndim() != 2 || ndarray.stride(1) != 1) {
+    throw nb::value_error(
+        ("ndarray must be 2 dimensional with contiguous rows for " + format)
+            .c_str());
+  }
+
   int width = ndarray.shape(1);
   int height = ndarray.shape(0);
-  std::unique_ptr<uint8_t> data(new uint8_t[width * height * 3]);
-  memcpy(data.get(), ndarray.data(), width * height * 3);
+  if (video_format == SoraVideoFormat::kI420 ||
+      video_format == SoraVideoFormat::kNV12) {
+    // YUV は (height * 3 / 2, width) の ndarray で受け取る
+    if (ndarray.shape(0) % 3 != 0 || width % 2 != 0) {
+      throw nb::value_error(
+          "I420 and NV12 ndarray must have shape (height * 3 / 2, width)");
+    }
+    if (video_format == SoraVideoFormat::kI420 && ndarray.stride(0) != width) {
+      // U と V の平面は Y の 1 行に 2 行ずつ詰まっているので行の間が空いていてはいけない
+      throw nb::value_error("I420 ndarray must be C-contiguous");
+    }
+    height = ndarray.shape(0) * 2 / 3;
+  }
+  rtc::scoped_refptr<webrtc::I420Buffer> i420_buffer =
+      CreateI420Buffer(width, height);
+  {
+    // ndarray から直接 I420 に変換するので中間のコピーは作らない
+    // ndarray は呼び出し元が保持しているので GIL を解放しても参照できる
+    nb::gil_scoped_release release;
+    SoraLatencyTimer timer(convert_latency_);
+    if (!ConvertToI420(ndarray, video_format, width, height,
+                       i420_buffer.get())) {
+      return false;
+    }
+  }
+
+  return Enqueue(std::make_unique<Frame>(i420_buffer, timestamp_us));
+}
 
+bool SoraVideoSource::ConvertToI420(
+    const nb::ndarray<uint8_t, nb::device::cpu>& ndarray,
+    SoraVideoFormat format,
+    int width,
+    int height,
+    webrtc::I420Buffer* i420_buffer) {
+  const uint8_t* src = ndarray.data();
+  const int src_stride = (int)ndarray.stride(0);
+  uint8_t* dst_y = i420_buffer->MutableDataY();
+  uint8_t* dst_u = i420_buffer->MutableDataU();
+  uint8_t* dst_v = i420_buffer->MutableDataV();
+  const int dst_stride_y = i420_buffer->StrideY();
+  const int dst_stride_u = i420_buffer->StrideU();
+  const int dst_stride_v = i420_buffer->StrideV();
+
+  int ret;
+  switch (format) {
+    case SoraVideoFormat::kBGR:
+      // libyuv の RGB24 はメモリ上で B, G, R の順に並ぶ
+      ret =
+          libyuv::RGB24ToI420(src, src_stride, dst_y, dst_stride_y, dst_u,
+                              dst_stride_u, dst_v, dst_stride_v, width, height);
+      break;
+    case SoraVideoFormat::kRGB:
+      ret = libyuv::RAWToI420(src, src_stride, dst_y, dst_stride_y, dst_u,
+                              dst_stride_u, dst_v, dst_stride_v, width, height);
+      break;
+    case SoraVideoFormat::kRGBA:
+      ret =
+          libyuv::ABGRToI420(src, src_stride, dst_y, dst_stride_y, dst_u,
+                             dst_stride_u, dst_v, dst_stride_v, width, height);
+      break;
+    case SoraVideoFormat::kBGRA:
+      ret =
+          libyuv::ARGBToI420(src, src_stride, dst_y, dst_stride_y, dst_u,
+                             dst_stride_u, dst_v, dst_stride_v, width, height);
+      break;
+    case SoraVideoFormat::kGRAY:
+      ret =
+          libyuv::I400ToI420(src, src_stride, dst_y, dst_stride_y, dst_u,
+                             dst_stride_u, dst_v, dst_stride_v, width, height);
+      break;
+    case SoraVideoFormat::kI420: {
+      const uint8_t* src_u = src + width * height;
+      const uint8_t* src_v = src_u + (width / 2) * (height / 2);
+      ret = libyuv::I420Copy(src, width, src_u, width / 2, src_v, width / 2,
+                             dst_y, dst_stride_y, dst_u, dst_stride_u, dst_v,
+                             dst_stride_v, width, height);
+      break;
+    }
+    case SoraVideoFormat::kNV12: {
+      const uint8_t* src_uv = src + src_stride * height;
+      ret = libyuv::NV12ToI420(src, src_stride, src_uv, src_stride, dst_y,
+                               dst_stride_y, dst_u, dst_stride_u, dst_v,
+                               dst_stride_v, width, height);
+      break;
+    }
+    default:
+      return false;
+  }
+  return ret == 0;
+}
+
+rtc::scoped_refptr<webrtc::I420Buffer> SoraVideoSource::CreateI420Buffer(
+    int width,
+    int height) {
+  rtc::scoped_refptr<webrtc::I420Buffer> buffer;
   {
-    std::lock_guard<std::mutex> lock(queue_mtx_);
-    if (finished_) {
-      return;
+    // プールは解像度ごとにバッファを使い回し、解像度が変わると作り直される
+    std::lock_guard<std::mutex> lock(pool_mtx_);
+    buffer = buffer_pool_.CreateI420Buffer(width, height);
+  }
+  if (!buffer) {
+    // エンコーダーなどがバッファを保持していてプールが枯渇した場合は新たに確保する
+    buffer = webrtc::I420Buffer::Create(width, height);
+  }
+  return buffer;
+}
+
+bool SoraVideoSource::Enqueue(std::unique_ptr<Frame> frame) {
+  std::unique_lock<std::mutex> lock(queue_mtx_);
+  if (finished_) {
+    return false;
+  }
+  if (max_queue_size_ > 0 && queue_.size() >= max_queue_size_) {
+    if (queue_policy_ == QueuePolicy::kDropOldest) {
+      queue_.pop();
+      dropped_frames_++;
+    } else if (queue_policy_ == QueuePolicy::kDropNewest) {
+      dropped_frames_++;
+      return false;
+    } else {
+      // 送信スレッドがキューを空けるまで GIL を解放して待つ
+      // 待っている間に Ctrl+C などで例外が投げられた場合は、フレームを積まずにそのまま送出する
+      while (!WaitWithGilReleased(lock, queue_cond_, 1.0f, [&] {
+        return queue_.size() < max_queue_size_ || finished_;
+      })) {
+      }
+      if (finished_) {
+        return false;
+      }
     }
-    queue_.push(
-        std::make_unique<Frame>(std::move(data), width, height, timestamp_us));
   }
+  queue_.push(std::move(frame));
+  enqueued_frames_++;
+  lock.unlock();
   queue_cond_.notify_all();
+  return true;
+}
+
+uint64_t SoraVideoSource::GetEnqueuedFrames() {
+  std::lock_guard<std::mutex> lock(queue_mtx_);
+  return enqueued_frames_;
+}
+
+uint64_t SoraVideoSource::GetDroppedFrames() {
+  std::lock_guard<std::mutex> lock(queue_mtx_);
+  return dropped_frames_;
+}
+
+size_t SoraVideoSource::GetQueueDepth() {
+  std::lock_guard<std::mutex> lock(queue_mtx_);
+  return queue_.size();
+}
+
+nb::dict SoraVideoSource::GetMetrics() {
+  nb::dict metrics;
+  metrics["frames_in"] = nb::cast(frames_in_.Get());
+  metrics["frames_sent"] = nb::cast(frames_sent_.Get());
+  {
+    std::lock_guard<std::mutex> lock(queue_mtx_);
+    metrics["enqueued_frames"] = nb::cast(enqueued_frames_);
+    metrics["dropped_frames"] = nb::cast(dropped_frames_);
+    metrics["queue_depth"] = nb::cast(queue_.size());
+  }
+  metrics["convert_latency"] = convert_latency_.ToDict();
+  metrics["queue_latency"] = queue_latency_.ToDict();
+  metrics["send_latency"] = send_latency_.ToDict();
+  if (scheduled_) {
+    metrics["late_frames"] = nb::cast(late_frames_.Get());
+    metrics["schedule_lateness"] = schedule_lateness_.ToDict();
+  }
+  return metrics;
 }
 
 bool SoraVideoSource::SendFrameProcess() {
@@ -83,30 +291,66 @@ bool SoraVideoSource::SendFrameProcess() {
     frame = std::move(queue_.front());
     queue_.pop();
   }
+  // キューが空くのを待っている on_captured を起こす
+  queue_cond_.notify_all();
   if (frame) {
-    SendFrame(frame->data.get(), frame->width, frame->height,
-              frame->timestamp_us);
+    queue_latency_.Record(std::chrono::steady_clock::now() -
+                          frame->enqueued_at);
+    int64_t timestamp_us = frame->timestamp_us;
+    if (scheduled_) {
+      // timestamp_us を最初のフレームからの表示時刻とみなし、その時刻まで待ってから送る
+      std::chrono::steady_clock::time_point deadline =
+          ScheduleDeadline(frame->timestamp_us);
+      if (!WaitSchedule(deadline)) {
+        return false;
+      }
+      auto lateness = std::chrono::steady_clock::now() - deadline;
+      schedule_lateness_.Record(lateness);
+      if (lateness > kLateFrameThreshold) {
+        late_frames_.Add();
+        if (late_frame_policy_ == LateFramePolicy::kDrop) {
+          std::lock_guard<std::mutex> lock(queue_mtx_);
+          dropped_frames_++;
+          return true;
+        }
+      }
+      // 送る時刻を合わせたので、 WebRTC には実際に送った時刻を渡す
+      timestamp_us = rtc::TimeMicros();
+    }
+    SoraLatencyTimer timer(send_latency_);
+    SendFrame(frame->buffer, timestamp_us);
+    frames_sent_.Add();
   }
   return true;
 }
 
-bool SoraVideoSource::SendFrame(const uint8_t* argb_data,
-                                const int width,
-                                const int height,
-                                const int64_t timestamp_us) {
-  rtc::scoped_refptr<webrtc::I420Buffer> i420_buffer(
-      webrtc::I420Buffer::Create(width, height));
-  i420_buffer->InitializeData();
-  int ret = libyuv::ConvertToI420(
-      argb_data, width * height * 3, i420_buffer.get()->MutableDataY(),
-      i420_buffer.get()->StrideY(), i420_buffer.get()->MutableDataU(),
-      i420_buffer.get()->StrideU(), i420_buffer.get()->MutableDataV(),
-      i420_buffer.get()->StrideV(), 0, 0, width, height, width, height,
-      libyuv::kRotate0, libyuv::FOURCC_24BG);
-  if (ret != 0) {
-    return false;
+std::chrono::steady_clock::time_point SoraVideoSource::ScheduleDeadline(
+    int64_t timestamp_us) {
+  auto now = std::chrono::steady_clock::now();
+  auto deadline = schedule_origin_ +
+                  std::chrono::microseconds(timestamp_us - schedule_origin_us_);
+  // 最初のフレーム、タイムスタンプが戻った場合、大きく遅れた場合はこのフレームを今の時刻に合わせる
+  if (!schedule_started_ || timestamp_us < schedule_origin_us_ ||
+      now - deadline > kScheduleResetThreshold) {
+    schedule_started_ = true;
+    schedule_origin_us_ = timestamp_us;
+    schedule_origin_ = now;
+    deadline = now;
   }
+  return deadline;
+}
 
+bool SoraVideoSource::WaitSchedule(
+    std::chrono::steady_clock::time_point deadline) {
+  std::unique_lock<std::mutex> lock(queue_mtx_);
+  // on_captured からの通知でも起きるので、時刻になるか終了するまで待ち直す
+  queue_cond_.wait_until(lock, deadline, [&] { return finished_; });
+  return !finished_;
+}
+
+void SoraVideoSource::SendFrame(
+    rtc::scoped_refptr<webrtc::I420Buffer> i420_buffer,
+    const int64_t timestamp_us) {
   webrtc::VideoFrame video_frame =
       webrtc::VideoFrame::Builder()
           .set_video_frame_buffer(i420_buffer)
@@ -116,5 +360,27 @@ bool SoraVideoSource::SendFrame(const uint8_t* argb_data,
           .set_rotation(webrtc::kVideoRotation_0)
           .build();
   source_->OnCapturedFrame(video_frame);
-  return true;
-}
\ No newline at end of file
+}
+
+SoraVideoSource::QueuePolicy SoraVideoSource::ParseQueuePolicy(
+    const std::string& queue_policy) {
+  if (queue_policy == "drop_oldest") {
+    return QueuePolicy::kDropOldest;
+  } else if (queue_policy == "drop_newest") {
+    return QueuePolicy::kDropNewest;
+  } else if (queue_policy == "block") {
+    return QueuePolicy::kBlock;
+  }
+  throw nb::value_error(("Invalid queue_policy: " + queue_policy).c_str());
+}
+
+SoraVideoSource::LateFramePolicy SoraVideoSource::ParseLateFramePolicy(
+    const std::string& late_frame_policy) {
+  if (late_frame_policy == "drop") {
+    return LateFramePolicy::kDrop;
+  } else if (late_frame_policy == "send") {
+    return LateFramePolicy::kSend;
+  }
+  throw nb::value_error(
+      ("Invalid late_frame_policy: " + late_frame_policy).c_str());
+}
@@ -1,10 +1,12 @@
 #ifndef SORA_VIDEO_SOURCE_H_
 #define SORA_VIDEO_SOURCE_H_
 
+#include <chrono>
 #include <condition_variable>
 #include <memory>
 #include <mutex>
 #include <queue>
+#include <string>
 #include <thread>
 
 // nonobind
@@ -13,12 +15,16 @@
 // WebRTC
 #include <api/peer_connection_interface.h>
 #include <api/scoped_refptr.h>
+#include <api/video/i420_buffer.h>
+#include <common_video/include/video_frame_buffer_pool.h>
 
 // Sora
 #include <sora/scalable_track_source.h>
 
 #include "sora_connection.h"
+#include "sora_metrics.h"
 #include "sora_track_interface.h"
+#include "sora_video_format.h"
 
 namespace nb = nanobind;
 
@@ -26,49 +32,101 @@ class SoraVideoSource : public SoraTrackInterface {
  public:
   SoraVideoSource(DisposePublisher* publisher,
                   rtc::scoped_refptr<sora::ScalableVideoTrackSource> source,
-                  rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track);
+                  rtc::scoped_refptr<webrtc::MediaStreamTrackInterface> track,
+                  size_t max_queue_size,
+                  const std::string& queue_policy,
+                  bool scheduled,
+                  const std::string& late_frame_policy);
 
   void Disposed() override;
   void PubliserDisposed() override;
-  void OnCaptured(nb::ndarray<uint8_t,
-                              nb::shape<nb::any, nb::any, 3>,
-                              nb::c_contig,
-                              nb::device::cpu> ndarray);
-  void OnCaptured(nb::ndarray<uint8_t,
-                              nb::shape<nb::any, nb::any, 3>,
-                              nb::c_contig,
-                              nb::device::cpu> ndarray,
-                  double timestamp);
-  void OnCaptured(nb::ndarray<uint8_t,
-                              nb::shape<nb::any, nb::any, 3>,
-                              nb::c_contig,
-                              nb::device::cpu> ndarray,
-                  int64_t timestamp_us);
+  bool OnCaptured(nb::ndarray<uint8_t, nb::device::cpu> ndarray,
+                  const std::string& format);
+  bool OnCaptured(nb::ndarray<uint8_t, nb::device::cpu> ndarray,
+                  double timestamp,
+                  const std::string& format);
+  bool OnCaptured(nb::ndarray<uint8_t, nb::device::cpu> ndarray,
+                  int64_t timestamp_us,
+                  const std::string& format);
+
+  uint64_t GetEnqueuedFrames();
+  uint64_t GetDroppedFrames();
+  size_t GetQueueDepth();
+  nb::dict GetMetrics();
 
  private:
+  enum class QueuePolicy {
+    kDropOldest,
+    kDropNewest,
+    kBlock,
+  };
+  enum class LateFramePolicy {
+    kDrop,
+    kSend,
+  };
+
   struct Frame {
-    Frame(std::unique_ptr<uint8_t> d, int w, int h, int64_t t)
-        : data(std::move(d)), width(w), height(h), timestamp_us(t) {}
+    Frame(rtc::scoped_refptr<webrtc::I420Buffer> b, int64_t t)
+        : buffer(b),
+          timestamp_us(t),
+          enqueued_at(std::chrono::steady_clock::now()) {}
 
-    const std::unique_ptr<uint8_t> data;
-    const int32_t width;
-    const int32_t height;
+    const rtc::scoped_refptr<webrtc::I420Buffer> buffer;
     const int64_t timestamp_us;
+    // キューで待った時間を計測するため、 timestamp_us とは別に積んだ時刻を持つ
+    const std::chrono::steady_clock::time_point enqueued_at;
   };
 
+  static QueuePolicy ParseQueuePolicy(const std::string& queue_policy);
+  static LateFramePolicy ParseLateFramePolicy(
+      const std::string& late_frame_policy);
+  rtc::scoped_refptr<webrtc::I420Buffer> CreateI420Buffer(int width,
+                                                          int height);
+  static bool ConvertToI420(
+      const nb::ndarray<uint8_t, nb::device::cpu>& ndarray,
+      SoraVideoFormat format,
+      int width,
+      int height,
+      webrtc::I420Buffer* i420_buffer);
+  bool Enqueue(std::unique_ptr<Frame> frame);
   bool SendFrameProcess();
-  bool SendFrame(const uint8_t* argb_data,
-                 const int width,
-                 const int height,
+  std::chrono::steady_clock::time_point ScheduleDeadline(int64_t timestamp_us);
+  bool WaitSchedule(std::chrono::steady_clock::time_point deadline);
+  void SendFrame(rtc::scoped_refptr<webrtc::I420Buffer> i420_buffer,
                  const int64_t timestamp_us);
 
   const int kMsToRtpTimestamp = 90;
+  // キューの上限に加えて、エンコーダーなどが保持している分としてプールに確保するバッファ数
+  static constexpr int kBufferPoolMargin = 8;
+  // scheduled の場合に、これ以上遅れたフレームを late_frame_policy に従って扱う
+  static constexpr std::chrono::milliseconds kLateFrameThreshold{20};
+  // これ以上遅れた場合は一時停止などで間が空いたとみなし、そのフレームから時計を合わせ直す
+  static constexpr std::chrono::seconds kScheduleResetThreshold{1};
   rtc::scoped_refptr<sora::ScalableVideoTrackSource> source_;
+  std::mutex pool_mtx_;
+  webrtc::VideoFrameBufferPool buffer_pool_;
   std::unique_ptr<std::thread> thread_;
   std::mutex queue_mtx_;
   std::condition_variable queue_cond_;
   std::queue<std::unique_ptr<Frame>> queue_;
+  const size_t max_queue_size_;
+  const QueuePolicy queue_policy_;
+  const bool scheduled_;
+  const LateFramePolicy late_frame_policy_;
+  // 以下の 3 つは送信のスレッドからのみ触る
+  bool schedule_started_;
+  int64_t schedule_origin_us_;
+  std::chrono::steady_clock::time_point schedule_origin_;
+  uint64_t enqueued_frames_;
+  uint64_t dropped_frames_;
   bool finished_;
+  SoraCounter frames_in_;
+  SoraCounter frames_sent_;
+  SoraLatencyHistogram convert_latency_;
+  SoraLatencyHistogram queue_latency_;
+  SoraLatencyHistogram send_latency_;
+  SoraCounter late_frames_;
+  SoraLatencyHistogram schedule_lateness_;
 };
 
 #endif
\ No newline at end of file
@@ -0,0 +1,21 @@
+"""
+ネイティブ拡張をビルドしなくても動くように、 sora_sdk を import せずにファイルから直接読み込む
+"""
+
+import importlib.util
+import pathlib
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def load_module():
+    def load(name, path):
+        spec = importlib.util.spec_from_file_location(name, ROOT / path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return load
@@ -0,0 +1,64 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def benchmark_compare(load_module):
+    return load_module("benchmark_compare", "benchmarks/compare.py")
+
+
+def report(*results):
+    return {
+        "results": [
+            {"name": name, "params": params, "throughput_per_sec": value}
+            for name, params, value in results
+        ]
+    }
+
+
+def test_compare_detects_regression(benchmark_compare):
+    baseline = report(
+        ("video", {"resolution": "720p"}, 100.0),
+        ("video", {"resolution": "1080p"}, 50.0),
+        ("audio", {}, 1000.0),
+    )
+    current = report(
+        ("video", {"resolution": "720p"}, 80.0),
+        ("video", {"resolution": "1080p"}, 46.0),
+        ("audio", {}, 2000.0),
+    )
+    regressions = benchmark_compare.compare(baseline, current, 0.1)
+    assert len(regressions) == 1
+    (r,) = regressions
+    assert r["name"] == "video"
+    assert r["params"] == {"resolution": "720p"}
+    assert (r["baseline"], r["current"]) == (100.0, 80.0)
+    assert r["ratio"] == pytest.approx(0.8)
+
+
+def test_compare_threshold(benchmark_compare):
+    baseline = report(("video", {}, 100.0))
+    current = report(("video", {}, 92.0))
+    assert benchmark_compare.compare(baseline, current, 0.1) == []
+    assert len(benchmark_compare.compare(baseline, current, 0.05)) == 1
+
+
+def test_compare_skips_missing_and_empty(benchmark_compare):
+    baseline = report(
+        ("video", {"resolution": "720p"}, 100.0),
+        ("audio", {}, None),
+        ("loopback", {}, 0),
+    )
+    current = report(
+        # params が違うものは別のベンチマークとして扱う
+        ("video", {"resolution": "1080p"}, 1.0),
+        ("audio", {}, 1.0),
+        ("loopback", {}, 1.0),
+        ("new", {}, 1.0),
+    )
+    assert benchmark_compare.compare(baseline, current, 0.1) == []
+
+
+def test_result_key_ignores_params_order(benchmark_compare):
+    a = {"name": "x", "params": {"a": 1, "b": 2}}
+    b = {"name": "x", "params": {"b": 2, "a": 1}}
+    assert benchmark_compare.result_key(a) == benchmark_compare.result_key(b)
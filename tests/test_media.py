@@ -0,0 +1,157 @@
+import struct
+from fractions import Fraction
+
+import numpy
+import pytest
+
+
+@pytest.fixture(scope="module")
+def media(load_module):
+    return load_module("sora_sdk_media", "src/sora_sdk/media.py")
+
+
+def wav_bytes(
+    samples, sample_rate, format_tag=1, bits_per_sample=16, data_size=None
+):
+    channels = samples.shape[1]
+    data = samples.tobytes()
+    block_align = channels * bits_per_sample // 8
+    fmt = struct.pack(
+        "<HHIIHH",
+        format_tag,
+        channels,
+        sample_rate,
+        sample_rate * block_align,
+        block_align,
+        bits_per_sample,
+    )
+    if data_size is None:
+        data_size = len(data)
+    body = (
+        b"WAVE"
+        + b"fmt "
+        + struct.pack("<I", len(fmt))
+        + fmt
+        + b"data"
+        + struct.pack("<I", data_size)
+        + data
+    )
+    return b"RIFF" + struct.pack("<I", len(body)) + body
+
+
+def y4m_bytes(frames, width, height, params="F30:1"):
+    header = f"YUV4MPEG2 W{width} H{height} {params}\n".encode()
+    return header + b"".join(b"FRAME\n" + frame.tobytes() for frame in frames)
+
+
+def test_wav_int16(media, tmp_path):
+    samples = numpy.arange(960 * 2, dtype="<i2").reshape(960, 2)
+    path = tmp_path / "a.wav"
+    path.write_bytes(wav_bytes(samples, 48000))
+    with media.WavReader(path) as reader:
+        assert reader.sample_rate == 48000
+        assert reader.channels == 2
+        assert reader.dtype == numpy.dtype("<i2")
+        assert reader.frames == 960
+        assert reader.duration == pytest.approx(0.02)
+        numpy.testing.assert_array_equal(reader.read(100, 3), samples[100:103])
+        # 範囲外は末尾までに切り詰める
+        assert reader.read(950, 100).shape == (10, 2)
+        assert reader.read(2000, 10).shape == (0, 2)
+        assert [c.shape[0] for c in reader.chunks(ms=15)] == [720, 240]
+
+
+def test_wav_float32(media, tmp_path):
+    samples = numpy.linspace(-1, 1, 480, dtype="<f4").reshape(480, 1)
+    path = tmp_path / "a.wav"
+    path.write_bytes(
+        wav_bytes(samples, 48000, format_tag=3, bits_per_sample=32)
+    )
+    with media.WavReader(path) as reader:
+        assert reader.dtype == numpy.dtype("<f4")
+        assert reader.frames == 480
+        numpy.testing.assert_array_equal(reader.read(0, 480), samples)
+
+
+def test_wav_truncated_data(media, tmp_path):
+    # 書き込み途中のファイルのように data チャンクのサイズが実際より大きい
+    samples = numpy.arange(100 * 2, dtype="<i2").reshape(100, 2)
+    data = wav_bytes(samples, 16000, data_size=0xFFFFFFFF)
+    path = tmp_path / "a.wav"
+    # 最後のサンプルの途中で切る
+    path.write_bytes(data[:-3])
+    with media.WavReader(path) as reader:
+        assert reader.frames == 99
+        numpy.testing.assert_array_equal(reader.read(0, 99), samples[:99])
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"RIFF\x00\x00\x00\x00AVI ",
+        b"RIFF\x04\x00\x00\x00WAVE",
+    ],
+)
+def test_wav_invalid(media, tmp_path, data):
+    path = tmp_path / "a.wav"
+    path.write_bytes(data + b"\x00" * 8)
+    with pytest.raises(ValueError):
+        media.WavReader(path)
+
+
+def test_wav_unsupported_format(media, tmp_path):
+    samples = numpy.zeros((10, 1), dtype="<i4")
+    path = tmp_path / "a.wav"
+    path.write_bytes(wav_bytes(samples, 48000, bits_per_sample=32))
+    with pytest.raises(ValueError, match="Unsupported WAV format"):
+        media.WavReader(path)
+
+
+def test_y4m(media, tmp_path):
+    frames = [
+        numpy.full((3, 4), i, dtype=numpy.uint8) + numpy.arange(4, dtype="u1")
+        for i in range(3)
+    ]
+    path = tmp_path / "a.y4m"
+    path.write_bytes(y4m_bytes(frames, 4, 2, "F30000:1001 Ip C420jpeg"))
+    with media.Y4MReader(path) as reader:
+        assert (reader.width, reader.height) == (4, 2)
+        assert reader.fps == Fraction(30000, 1001)
+        assert len(reader) == 3
+        numpy.testing.assert_array_equal(reader[1], frames[1])
+        for actual, expected in zip(reader, frames):
+            numpy.testing.assert_array_equal(actual, expected)
+            del actual
+
+
+def test_y4m_truncated_last_frame(media, tmp_path):
+    frames = [numpy.full((3, 4), i, dtype=numpy.uint8) for i in range(2)]
+    path = tmp_path / "a.y4m"
+    path.write_bytes(y4m_bytes(frames, 4, 2)[:-1])
+    with media.Y4MReader(path) as reader:
+        assert len(reader) == 1
+        numpy.testing.assert_array_equal(reader[0], frames[0])
+
+
+@pytest.mark.parametrize(
+    "header",
+    [
+        b"YUV4MPEG2 W4 H2 C444\n",
+        b"YUV4MPEG2 W3 H2\n",
+        b"YUV4MPEG2 H2\n",
+        b"NOTY4M W4 H2\n",
+    ],
+)
+def test_y4m_invalid_header(media, tmp_path, header):
+    path = tmp_path / "a.y4m"
+    path.write_bytes(header + b"FRAME\n" + b"\x00" * 12)
+    with pytest.raises(ValueError):
+        media.Y4MReader(path)
+
+
+def test_y4m_invalid_frame_header(media, tmp_path):
+    path = tmp_path / "a.y4m"
+    path.write_bytes(b"YUV4MPEG2 W4 H2\nFRAMX\n" + b"\x00" * 12)
+    with pytest.raises(ValueError, match="Invalid Y4M frame header"):
+        media.Y4MReader(path)
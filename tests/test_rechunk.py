@@ -0,0 +1,66 @@
+import numpy
+import pytest
+
+
+@pytest.fixture(scope="module")
+def rechunk(load_module):
+    return load_module("sora_sdk_rechunk", "src/sora_sdk/_rechunk.py")
+
+
+def frames(start, count, channels=1):
+    return (
+        numpy.arange(start, start + count, dtype=numpy.int16)
+        .repeat(channels)
+        .reshape(count, channels)
+    )
+
+
+def test_pop_before_push(rechunk):
+    assert rechunk.AudioRechunker().pop(10) == []
+
+
+def test_rechunk_carries_remainder(rechunk):
+    r = rechunk.AudioRechunker()
+    r.push(frames(0, 1200), 48000)
+    chunks = r.pop(10)
+    assert [c.shape for c in chunks] == [(480, 1), (480, 1)]
+    numpy.testing.assert_array_equal(numpy.concatenate(chunks), frames(0, 960))
+    # 足りない分は次に持ち越す
+    r.push(frames(1200, 100), 48000)
+    assert r.pop(10) == []
+    r.push(frames(1300, 200), 48000)
+    (chunk,) = r.pop(10)
+    numpy.testing.assert_array_equal(chunk, frames(960, 480))
+
+
+def test_rechunk_non_integer_rate(rechunk):
+    r = rechunk.AudioRechunker()
+    r.push(frames(0, 1000, channels=2), 44100)
+    chunks = r.pop(10)
+    assert [c.shape for c in chunks] == [(441, 2), (441, 2)]
+
+
+def test_rechunk_resets_on_format_change(rechunk):
+    r = rechunk.AudioRechunker()
+    r.push(frames(0, 300), 48000)
+    # サンプリングレートが変わったら貯めた分は捨てる
+    r.push(frames(1000, 160), 16000)
+    (chunk,) = r.pop(10)
+    numpy.testing.assert_array_equal(chunk, frames(1000, 160))
+    # チャンネル数が変わった場合も同じ
+    r.push(frames(0, 100), 16000)
+    r.push(frames(2000, 160, channels=2), 16000)
+    (chunk,) = r.pop(10)
+    numpy.testing.assert_array_equal(chunk, frames(2000, 160, channels=2))
+
+
+def test_missing(rechunk):
+    r = rechunk.AudioRechunker()
+    # フォーマットが分からない間は 1 サンプルで起こしてもらう
+    assert r.missing(10) == 1
+    r.push(frames(0, 300), 48000)
+    assert r.missing(10) == 180
+    r.push(frames(300, 180), 48000)
+    assert r.missing(10) == 1
+    assert len(r.pop(10)) == 1
+    assert r.missing(10) == 480